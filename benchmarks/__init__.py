@@ -0,0 +1,2 @@
+"""Benchmarks of the mocked endpoints, run with `python -m benchmarks`
+"""
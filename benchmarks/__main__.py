@@ -0,0 +1,227 @@
+"""Benchmarks every route of the mocked endpoints through the recurly client.
+
+For each dataset size, a mocurly context is seeded with that many accounts
+(see `scenarios.seed_dataset`), and each route is requested `--iterations`
+times. The throughput, median and 99th percentile latencies, and the memory
+allocated per request are reported as JSON, which can be saved as a baseline
+and compared against on later runs:
+
+    python -m benchmarks --output benchmarks/baselines/baseline.json
+    python -m benchmarks --compare benchmarks/baselines/baseline.json
+
+The comparison exits with a non zero status when the median latency of a
+route regressed by more than the tolerance.
+
+The cost of moving the virtual clock forward, which renews the subscriptions
+of the dataset, is benchmarked along with the routes (see
+`scenarios.ClockScenario`), and reported per renewal as well.
+"""
+import argparse
+import json
+import platform
+import sys
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import recurly
+
+import mocurly
+from mocurly.core import _get_router
+
+from mocurly.backend import invoices_backend
+
+from .scenarios import SCENARIOS, CLOCK_SCENARIOS, Dataset, seed_dataset
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+DEFAULT_ITERATIONS = 100
+WARMUP_ITERATIONS = 5
+# The client creates a new SSL context for every HTTPS request, which would
+# dwarf the time spent in mocurly itself
+BASE_URI = 'http://%s.recurly.com/v2/'
+HEADERS = {'content-type': 'application/xml; charset=utf-8'}
+# Regressions of the median latency smaller than this, in milliseconds, are
+# considered noise however large they are relatively
+MIN_REGRESSION_MS = 0.1
+
+
+def request(scenario, dataset, i):
+    """Prepares and sends a request of the scenario, returning the time it took
+    and its status
+    """
+    path, body = scenario.prepare(dataset, i)
+    url = recurly.base_uri() + path
+    start = default_timer()
+    response = recurly.Resource.http_request(url, scenario.method, body, HEADERS)
+    response.read()
+    return default_timer() - start, response.status
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_scenario(scenario, dataset, iterations):
+    for i in range(WARMUP_ITERATIONS):
+        request(scenario, dataset, i)
+
+    timings = []
+    statuses = {}
+    for i in range(iterations):
+        seconds, status = request(scenario, dataset, i)
+        timings.append(seconds)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    if any(int(status) >= 500 for status in statuses):
+        raise RuntimeError('{0} failed with statuses {1}'.format(scenario.route, statuses))
+
+    timings.sort()
+    return {
+        'ops_per_sec': len(timings) / sum(timings),
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'allocated_bytes': measure_allocations(scenario, dataset, iterations),
+        'statuses': statuses
+    }
+
+
+def measure_allocations(scenario, dataset, iterations):
+    """Returns the median peak of memory allocated while handling a request,
+    measured separately since tracing slows down the requests. Peaks can only
+    be reset from Python 3.9 on, otherwise this returns None.
+    """
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(min(iterations, 20)):
+            path, body = scenario.prepare(dataset, i)
+            url = recurly.base_uri() + path
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            recurly.Resource.http_request(url, scenario.method, body, HEADERS).read()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    peaks.sort()
+    return peaks[len(peaks) // 2]
+
+
+def run_clock_scenario(scenario, iterations):
+    """Moves the clock forward `iterations` times (at most
+    `scenario.max_iterations`), timing each move and the renewals it made,
+    counted as the invoices it created
+    """
+    timings = []
+    renewals = 0
+    for i in range(min(iterations, scenario.max_iterations)):
+        invoices = len(invoices_backend.datastore)
+        start = default_timer()
+        mocurly.advance(**scenario.delta)
+        timings.append(default_timer() - start)
+        renewals += len(invoices_backend.datastore) - invoices
+
+    total = sum(timings)
+    timings.sort()
+    return {
+        'ops_per_sec': len(timings) / total,
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'renewals': renewals,
+        'us_per_renewal': total / renewals * 1000000 if renewals else None
+    }
+
+
+def run(sizes, iterations, routes=None, log=sys.stderr):
+    scenarios = [scenario for scenario in SCENARIOS if routes is None or scenario.route in routes]
+    clock_scenarios = [scenario for scenario in CLOCK_SCENARIOS if routes is None or scenario.route in routes]
+    results = {}
+    original_base_uri = recurly.BASE_URI
+    recurly.BASE_URI = BASE_URI
+    try:
+        for size in sizes:
+            results[str(size)] = size_results = {}
+            with mocurly.mocurly():
+                start = default_timer()
+                seed_dataset(size)
+                dataset = Dataset(size)
+                log.write('Seeded {0} accounts in {1:.1f}s\n'.format(size, default_timer() - start))
+                for scenario in scenarios:
+                    size_results[scenario.route] = result = run_scenario(scenario, dataset, iterations)
+                    log.write('{0:>7} {1:<40} {2:>9.1f} ops/s  p50 {3:.3f} ms  p99 {4:.3f} ms\n'.format(
+                        size, scenario.route, result['ops_per_sec'], result['p50_ms'], result['p99_ms']))
+                for scenario in clock_scenarios:
+                    size_results[scenario.route] = result = run_clock_scenario(scenario, iterations)
+                    log.write('{0:>7} {1:<40} {2:>9.1f} ops/s  p50 {3:.3f} ms  {4} renewals\n'.format(
+                        size, scenario.route, result['ops_per_sec'], result['p50_ms'], result['renewals']))
+    finally:
+        recurly.BASE_URI = original_base_uri
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'recurly': recurly.__version__,
+            'iterations': iterations
+        },
+        'results': results
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Returns the descriptions of the routes whose median latency regressed
+    by more than `tolerance` (a fraction) compared to the baseline
+    """
+    regressions = []
+    for size, size_results in sorted(report['results'].items()):
+        for route, result in sorted(size_results.items()):
+            base = baseline['results'].get(size, {}).get(route)
+            if base is None:
+                continue
+            delta = result['p50_ms'] - base['p50_ms']
+            if delta > MIN_REGRESSION_MS and delta > base['p50_ms'] * tolerance:
+                regressions.append('{0} at {1}: p50 {2:.3f} ms -> {3:.3f} ms'.format(
+                    route, size, base['p50_ms'], result['p50_ms']))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks the mocked recurly endpoints')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated numbers of accounts in the datasets')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='Requests per route and dataset')
+    parser.add_argument('--route', action='append', dest='routes',
+                        help='Only benchmark the given route, e.g "GET /accounts/:pk" (can be repeated)')
+    parser.add_argument('--output', help='File to write the results to, instead of stdout')
+    parser.add_argument('--compare', help='Baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Relative regression of the median latency that fails the comparison')
+    args = parser.parse_args(args)
+    recurly.API_KEY = 'benchmark'
+
+    missing = set(route.name for route in _get_router().routes.values()) - set(scenario.route for scenario in SCENARIOS)
+    if missing:
+        parser.error('No benchmark scenario for {0}'.format(', '.join(sorted(missing))))
+
+    report = run([int(size) for size in args.sizes.split(',')], args.iterations, args.routes)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write('Regression: {0}\n'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
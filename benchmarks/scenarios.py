@@ -0,0 +1,260 @@
+"""Datasets and the benchmark scenario of each route
+
+Each scenario prepares one request at a time, outside of the timed section:
+scenarios that consume their target (e.g deleting an account) create a fresh
+one for every request, while the others reuse the objects of the dataset.
+
+Clock scenarios benchmark moving the virtual clock forward instead, which
+renews the subscriptions of the dataset without going through any route.
+"""
+import itertools
+
+import mocurly
+from mocurly.endpoints import (BaseRecurlyEndpoint, accounts_endpoint, adjustments_endpoint, coupons_endpoint, invoices_endpoint,
+                                plans_endpoint, subscriptions_endpoint, transactions_endpoint)
+
+PLAN_COUNT = 10
+COUPON_COUNT = 10
+
+_fresh_ids = itertools.count()
+
+
+def seed_dataset(size):
+    """Creates `size` accounts, each with billing info, a coupon redemption and
+    a subscription (along with its invoice, transaction and adjustments), on
+    top of a few plans with an add-on each and a few coupons.
+    """
+    mocurly.seed(
+        accounts=[_account_data('account{0}'.format(i)) for i in range(size)],
+        plans=[{'plan_code': 'plan{0}'.format(i), 'name': 'Plan', 'unit_amount_in_cents': {'USD': 1000}}
+               for i in range(PLAN_COUNT)],
+        add_ons=[{'plan_code': 'plan{0}'.format(i), 'add_on_code': 'extra', 'name': 'Extra', 'unit_amount_in_cents': {'USD': 100}}
+                 for i in range(PLAN_COUNT)],
+        coupons=[{'coupon_code': 'coupon{0}'.format(i), 'name': 'Coupon', 'discount_type': 'percent', 'discount_percent': 10}
+                 for i in range(COUPON_COUNT)],
+        subscriptions=[{'plan_code': 'plan{0}'.format(i % PLAN_COUNT), 'account': {'account_code': 'account{0}'.format(i)}, 'currency': 'USD'}
+                       for i in range(size)])
+    for i in range(size):
+        _redeem('coupon{0}'.format(i % COUPON_COUNT), 'account{0}'.format(i))
+
+
+class Dataset(object):
+    """The primary keys of the objects of the seeded dataset
+    """
+    def __init__(self, size):
+        self.size = size
+        self.transactions = _keys(transactions_endpoint)
+        self.invoices = _keys(invoices_endpoint)
+        self.adjustments = _keys(adjustments_endpoint)
+        self.subscriptions = _keys(subscriptions_endpoint)
+
+    def account(self, i):
+        return 'account{0}'.format(i % self.size)
+
+
+def _keys(endpoint):
+    return [str(obj[endpoint.pk_attr]) for obj in endpoint.backend.list_objects()]
+
+
+def _account_data(account_code):
+    return {'account_code': account_code,
+            'email': 'foo@bar.com',
+            'first_name': 'Foo',
+            'last_name': 'Bar',
+            'billing_info': {'first_name': 'Foo', 'last_name': 'Bar', 'number': '4111-1111-1111-1111', 'currency': 'USD'}}
+
+
+def _fresh(prefix):
+    return '{0}-{1}'.format(prefix, next(_fresh_ids))
+
+
+def _fresh_account():
+    account_code = _fresh('account')
+    accounts_endpoint.create(mocurly.seeding._encode(_account_data(account_code)), format=BaseRecurlyEndpoint.RAW)
+    return account_code
+
+
+def _fresh_subscription():
+    subscription = subscriptions_endpoint.create(
+        {'plan_code': 'plan0', 'account': {'account_code': _fresh_account()}, 'currency': 'USD'},
+        format=BaseRecurlyEndpoint.RAW)
+    return subscription['uuid']
+
+
+def _redeem(coupon_code, account_code):
+    return coupons_endpoint.redeem_coupon(coupon_code, {'account_code': account_code, 'currency': 'USD'},
+                                          format=BaseRecurlyEndpoint.RAW)
+
+
+def _xml(tag, **fields):
+    return '<{0}>{1}</{0}>'.format(tag, ''.join('<{0}>{1}</{0}>'.format(k, v) for k, v in sorted(fields.items())))
+
+
+class Scenario(object):
+    """Benchmark of a route. `prepare` is called with the dataset and the index
+    of the request, and returns the path (relative to the base URI) and body of
+    the request.
+    """
+    def __init__(self, route, prepare):
+        self.route = route
+        self.method = route.split(' ', 1)[0]
+        self.prepare = prepare
+
+
+def _get(path):
+    return lambda dataset, i: (path(dataset, i), None)
+
+
+def _list(resource):
+    return _get(lambda dataset, i: resource)
+
+
+SCENARIOS = [
+    # Accounts
+    Scenario('GET /accounts', _list('accounts')),
+    Scenario('HEAD /accounts', _list('accounts')),
+    Scenario('POST /accounts', lambda dataset, i: ('accounts', _xml('account', account_code=_fresh('new-account'), email='foo@bar.com'))),
+    Scenario('GET /accounts/:pk', _get(lambda dataset, i: 'accounts/' + dataset.account(i))),
+    Scenario('PUT /accounts/:pk', lambda dataset, i: ('accounts/' + dataset.account(i), _xml('account', email='bar@foo.com'))),
+    Scenario('DELETE /accounts/:pk', lambda dataset, i: ('accounts/' + _fresh_account(), None)),
+    Scenario('GET /accounts/:pk/billing_info', _get(lambda dataset, i: 'accounts/{0}/billing_info'.format(dataset.account(i)))),
+    Scenario('PUT /accounts/:pk/billing_info', lambda dataset, i: (
+        'accounts/{0}/billing_info'.format(dataset.account(i)),
+        _xml('billing_info', first_name='Bar', last_name='Foo', number='4111-1111-1111-1111', currency='USD'))),
+    Scenario('DELETE /accounts/:pk/billing_info', lambda dataset, i: ('accounts/{0}/billing_info'.format(_fresh_account()), None)),
+    Scenario('GET /accounts/:pk/invoices', _get(lambda dataset, i: 'accounts/{0}/invoices'.format(dataset.account(i)))),
+    Scenario('HEAD /accounts/:pk/invoices', _get(lambda dataset, i: 'accounts/{0}/invoices'.format(dataset.account(i)))),
+    Scenario('GET /accounts/:pk/transactions', _get(lambda dataset, i: 'accounts/{0}/transactions'.format(dataset.account(i)))),
+    Scenario('HEAD /accounts/:pk/transactions', _get(lambda dataset, i: 'accounts/{0}/transactions'.format(dataset.account(i)))),
+    Scenario('GET /accounts/:pk/subscriptions', _get(lambda dataset, i: 'accounts/{0}/subscriptions'.format(dataset.account(i)))),
+    Scenario('HEAD /accounts/:pk/subscriptions', _get(lambda dataset, i: 'accounts/{0}/subscriptions'.format(dataset.account(i)))),
+    Scenario('GET /accounts/:pk/redemptions', _get(lambda dataset, i: 'accounts/{0}/redemptions'.format(dataset.account(i)))),
+    Scenario('HEAD /accounts/:pk/redemptions', _get(lambda dataset, i: 'accounts/{0}/redemptions'.format(dataset.account(i)))),
+    Scenario('DELETE /accounts/:pk/redemptions/:pk', lambda dataset, i: _fresh_redemption_path()),
+
+    # Transactions
+    Scenario('GET /transactions', _list('transactions')),
+    Scenario('HEAD /transactions', _list('transactions')),
+    Scenario('POST /transactions', lambda dataset, i: ('transactions', '<transaction><account><account_code>{0}</account_code></account>'
+                                                                       '<amount_in_cents>100</amount_in_cents><currency>USD</currency></transaction>'.format(dataset.account(i)))),
+    Scenario('GET /transactions/:pk', _get(lambda dataset, i: 'transactions/' + dataset.transactions[i % len(dataset.transactions)])),
+    Scenario('PUT /transactions/:pk', lambda dataset, i: ('transactions/' + dataset.transactions[i % len(dataset.transactions)], _xml('transaction', description='Updated'))),
+    Scenario('DELETE /transactions/:pk', _get(lambda dataset, i: 'transactions/' + dataset.transactions[i % len(dataset.transactions)])),
+
+    # Adjustments
+    Scenario('GET /adjustments', _list('adjustments')),
+    Scenario('HEAD /adjustments', _list('adjustments')),
+    Scenario('POST /adjustments', lambda dataset, i: ('adjustments', _xml('adjustment', account_code=dataset.account(i), unit_amount_in_cents=100,
+                                                                          currency='USD', description='Charge', invoice=dataset.invoices[0]))),
+    Scenario('GET /adjustments/:pk', _get(lambda dataset, i: 'adjustments/' + dataset.adjustments[i % len(dataset.adjustments)])),
+    Scenario('PUT /adjustments/:pk', lambda dataset, i: ('adjustments/' + dataset.adjustments[i % len(dataset.adjustments)], _xml('adjustment', description='Updated'))),
+    Scenario('DELETE /adjustments/:pk', lambda dataset, i: ('adjustments/' + _fresh_adjustment(dataset, i), None)),
+
+    # Invoices
+    Scenario('GET /invoices', _list('invoices')),
+    Scenario('HEAD /invoices', _list('invoices')),
+    Scenario('POST /invoices', lambda dataset, i: ('invoices', _xml('invoice', invoice_number=invoices_endpoint.generate_invoice_number(),
+                                                                        account=dataset.account(i), currency='USD'))),
+    Scenario('GET /invoices/:pk', _get(lambda dataset, i: 'invoices/' + dataset.invoices[i % len(dataset.invoices)])),
+    Scenario('PUT /invoices/:pk', lambda dataset, i: ('invoices/' + dataset.invoices[i % len(dataset.invoices)], _xml('invoice', po_number='1'))),
+    Scenario('DELETE /invoices/:pk', lambda dataset, i: ('invoices/' + _fresh_invoice(), None)),
+    Scenario('POST /invoices/:pk/refund', lambda dataset, i: ('invoices/{0}/refund'.format(dataset.invoices[i % len(dataset.invoices)]),
+                                                              _xml('invoice', amount_in_cents=1))),
+
+    # Coupons
+    Scenario('GET /coupons', _list('coupons')),
+    Scenario('HEAD /coupons', _list('coupons')),
+    Scenario('POST /coupons', lambda dataset, i: ('coupons', _xml('coupon', coupon_code=_fresh('new-coupon'), name='Coupon',
+                                                                  discount_type='percent', discount_percent=10))),
+    Scenario('GET /coupons/:pk', _get(lambda dataset, i: 'coupons/coupon{0}'.format(i % COUPON_COUNT))),
+    Scenario('PUT /coupons/:pk', lambda dataset, i: ('coupons/coupon{0}'.format(i % COUPON_COUNT), _xml('coupon', name='Updated'))),
+    Scenario('DELETE /coupons/:pk', lambda dataset, i: ('coupons/' + _fresh_coupon(), None)),
+    Scenario('GET /coupons/:pk/redemptions', _get(lambda dataset, i: 'coupons/coupon{0}/redemptions'.format(i % COUPON_COUNT))),
+    Scenario('HEAD /coupons/:pk/redemptions', _get(lambda dataset, i: 'coupons/coupon{0}/redemptions'.format(i % COUPON_COUNT))),
+    Scenario('POST /coupons/:pk/redeem', lambda dataset, i: ('coupons/coupon{0}/redeem'.format(i % COUPON_COUNT),
+                                                             _xml('redemption', account_code=_fresh_account(), currency='USD'))),
+
+    # Plans
+    Scenario('GET /plans', _list('plans')),
+    Scenario('HEAD /plans', _list('plans')),
+    Scenario('POST /plans', lambda dataset, i: ('plans', '<plan><plan_code>{0}</plan_code><name>Plan</name>'
+                                                         '<unit_amount_in_cents><USD>1000</USD></unit_amount_in_cents></plan>'.format(_fresh('new-plan')))),
+    Scenario('GET /plans/:pk', _get(lambda dataset, i: 'plans/plan{0}'.format(i % PLAN_COUNT))),
+    Scenario('PUT /plans/:pk', lambda dataset, i: ('plans/plan{0}'.format(i % PLAN_COUNT), _xml('plan', name='Updated'))),
+    Scenario('DELETE /plans/:pk', lambda dataset, i: ('plans/' + _fresh_plan(), None)),
+    Scenario('GET /plans/:pk/add_ons', _get(lambda dataset, i: 'plans/plan{0}/add_ons'.format(i % PLAN_COUNT))),
+    Scenario('HEAD /plans/:pk/add_ons', _get(lambda dataset, i: 'plans/plan{0}/add_ons'.format(i % PLAN_COUNT))),
+    Scenario('POST /plans/:pk/add_ons', lambda dataset, i: ('plans/plan{0}/add_ons'.format(i % PLAN_COUNT),
+                                                            '<add_on><add_on_code>{0}</add_on_code><name>Add-on</name>'
+                                                            '<unit_amount_in_cents><USD>100</USD></unit_amount_in_cents></add_on>'.format(_fresh('add-on')))),
+
+    # Subscriptions
+    Scenario('GET /subscriptions', _list('subscriptions')),
+    Scenario('HEAD /subscriptions', _list('subscriptions')),
+    Scenario('POST /subscriptions', lambda dataset, i: ('subscriptions', '<subscription><plan_code>plan{0}</plan_code><currency>USD</currency>'
+                                                                         '<account><account_code>{1}</account_code></account></subscription>'.format(i % PLAN_COUNT, dataset.account(i)))),
+    Scenario('GET /subscriptions/:pk', _get(lambda dataset, i: 'subscriptions/' + dataset.subscriptions[i % len(dataset.subscriptions)])),
+    Scenario('PUT /subscriptions/:pk', lambda dataset, i: ('subscriptions/' + dataset.subscriptions[i % len(dataset.subscriptions)], _xml('subscription', quantity=1))),
+    Scenario('DELETE /subscriptions/:pk', lambda dataset, i: ('subscriptions/' + _fresh_subscription(), None)),
+    Scenario('PUT /subscriptions/:pk/cancel', lambda dataset, i: ('subscriptions/{0}/cancel'.format(_fresh_subscription()), None)),
+    Scenario('PUT /subscriptions/:pk/reactivate', lambda dataset, i: ('subscriptions/{0}/reactivate'.format(_fresh_canceled_subscription()), None)),
+    Scenario('PUT /subscriptions/:pk/terminate', lambda dataset, i: ('subscriptions/{0}/terminate?refund=none'.format(_fresh_subscription()), None)),
+]
+
+
+class ClockScenario(object):
+    """Benchmark of moving the virtual clock forward by `delta` (the keyword
+    arguments of `mocurly.advance`). Each run moves the clock further, and
+    renews the subscriptions that fall due on the way, e.g every subscription
+    of the dataset for a month. Runs are costly on large datasets, so there
+    are at most `max_iterations` of them, and since they add invoices to the
+    dataset they run after the scenarios of the routes.
+    """
+    max_iterations = 3
+
+    def __init__(self, **delta):
+        self.route = 'advance({0})'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(delta.items())))
+        self.delta = delta
+
+
+CLOCK_SCENARIOS = [
+    ClockScenario(months=1),
+]
+
+
+def _fresh_redemption_path():
+    account_code = _fresh_account()
+    _redeem('coupon0', account_code)
+    return 'accounts/{0}/redemptions/{1}'.format(account_code, coupons_endpoint.generate_coupon_redemption_uuid('coupon0', account_code)), None
+
+
+def _fresh_adjustment(dataset, i):
+    adjustment = adjustments_endpoint.create({'account_code': dataset.account(i), 'unit_amount_in_cents': '100', 'currency': 'USD',
+                                              'invoice': dataset.invoices[0]},
+                                             format=BaseRecurlyEndpoint.RAW)
+    return adjustment['uuid']
+
+
+def _fresh_invoice():
+    invoice = invoices_endpoint.create({'invoice_number': str(invoices_endpoint.generate_invoice_number()),
+                                        'account': _fresh_account(), 'currency': 'USD'}, format=BaseRecurlyEndpoint.RAW)
+    return str(invoice['invoice_number'])
+
+
+def _fresh_coupon():
+    coupon_code = _fresh('coupon')
+    coupons_endpoint.create({'coupon_code': coupon_code, 'name': 'Coupon', 'discount_type': 'percent', 'discount_percent': '10'},
+                            format=BaseRecurlyEndpoint.RAW)
+    return coupon_code
+
+
+def _fresh_plan():
+    plan_code = _fresh('plan')
+    plans_endpoint.create({'plan_code': plan_code, 'name': 'Plan', 'unit_amount_in_cents': {'USD': '1000'}}, format=BaseRecurlyEndpoint.RAW)
+    return plan_code
+
+
+def _fresh_canceled_subscription():
+    uuid = _fresh_subscription()
+    subscriptions_endpoint.cancel_subscription(uuid, {}, format=BaseRecurlyEndpoint.RAW)
+    return uuid
@@ -1,4 +1,6 @@
-from .core import mocurly
+from .core import mocurly, install, uninstall, reset, set_base_layer, clear_base_layer, advance
+from .snapshot import save_snapshot, load_snapshot
+from .seeding import seed
 
 from .errors import *
 from .backend import *
@@ -0,0 +1,62 @@
+"""Command line interface of mocurly
+
+    python -m mocurly serve [--host HOST] [--port PORT]
+"""
+import argparse
+
+from .utils import SERIALIZERS
+from .journal import DEFAULT_JOURNAL_SIZE
+from .network import NetworkModel, LogNormal
+from .ratelimit import RateLimiter, DEFAULT_PERIOD
+from .server import serve
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m mocurly')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    serve_parser = subparsers.add_parser('serve', help='serve the mocked recurly API over HTTP')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    serve_parser.add_argument('--port', type=int, default=8000, help='port to listen on (default: %(default)s)')
+    serve_parser.add_argument('--copy-on-write', action='store_true', help='store records as copy-on-write snapshots')
+    serve_parser.add_argument('--serializer', choices=SERIALIZERS, default='jinja2', help='XML serializer (default: %(default)s)')
+    serve_parser.add_argument('--xml-cache', action='store_true', help='cache the XML of retrieved and listed objects')
+    serve_parser.add_argument('--columnar', action='store_true',
+                              help='store invoices, transactions and adjustments in columns (requires numpy)')
+    serve_parser.add_argument('--journal-size', type=int, default=DEFAULT_JOURNAL_SIZE,
+                              help='number of most recent requests kept in the journal (default: %(default)s)')
+    serve_parser.add_argument('--latency', type=float, default=0,
+                              help='median latency added to each response, in seconds (default: %(default)s)')
+    serve_parser.add_argument('--latency-sigma', type=float, default=0,
+                              help='standard deviation of the logarithm of the latency, which is log-normally distributed '
+                                   'when positive, or fixed otherwise (default: %(default)s)')
+    serve_parser.add_argument('--bandwidth', type=int, help='throughput of the response bodies, in bytes per second')
+    serve_parser.add_argument('--seed', type=int, help='seed of the random latencies')
+    serve_parser.add_argument('--rate-limit', type=int, help='requests allowed per API key and period')
+    serve_parser.add_argument('--rate-limit-period', type=float, default=DEFAULT_PERIOD,
+                              help='period of the rate limit, in seconds (default: %(default)s)')
+    serve_parser.add_argument('--verbose', action='store_true', help='log every request')
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        network = None
+        if args.latency or args.bandwidth:
+            latency = LogNormal(args.latency, args.latency_sigma) if args.latency and args.latency_sigma > 0 else args.latency
+            network = NetworkModel(latency=latency, bandwidth=args.bandwidth, seed=args.seed)
+        rate_limiter = None
+        if args.rate_limit:
+            rate_limiter = RateLimiter(args.rate_limit, args.rate_limit_period)
+        serve(args.host, args.port,
+              verbose=args.verbose,
+              copy_on_write=args.copy_on_write,
+              serializer=args.serializer,
+              xml_cache=args.xml_cache,
+              columnar=args.columnar,
+              journal_size=args.journal_size,
+              network=network,
+              rate_limiter=rate_limiter)
+
+
+if __name__ == '__main__':
+    main()
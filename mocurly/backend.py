@@ -1,13 +1,415 @@
 """In-memory database backends for each recurly resource
 """
+import bisect
+import datetime
+import functools
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+import dateutil.parser
 import six
+from dateutil.tz import tzutc
+
+from .columnar import ColumnStore, INTEGER, TIME, BOOLEAN, CATEGORY, OBJECT, sum_records
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:  # python 2
+    from collections import Mapping, MutableMapping
+
+
+# Versions are drawn from a single counter shared by all backends, so that a
+# version is never handed out twice, even after the backends are cleared
+_version_counter = itertools.count(1)
+
+# State of the current thread: the reads recorded by `record_reads`, and the
+# objects looked up within an `identity_map` scope
+_context = threading.local()
+
+
+class record_reads(object):
+    """Context manager that records the objects read from any backend in the
+    current thread, as a set of (backend, uuid, version) tuples. The version is
+    None for objects that were looked up but do not exist.
+
+    ::
+
+        with record_reads() as reads:
+            ...
+    """
+    def __enter__(self):
+        self.previous_reads = getattr(_context, 'reads', None)
+        self.reads = _context.reads = set()
+        return self.reads
+
+    def __exit__(self, type, value, tb):
+        _context.reads = self.previous_reads
+
+
+class identity_map(object):
+    """Context manager within which `BaseBackend.lookup_object` returns the
+    same object for every lookup of an unchanged object, so that objects
+    related to many others (e.g the account of all the listed transactions)
+    are only copied and hydrated once. Nested scopes share the outermost map.
+    """
+    def __enter__(self):
+        self.outermost = getattr(_context, 'identity_map', None) is None
+        if self.outermost:
+            _context.identity_map = {}
+
+    def __exit__(self, type, value, tb):
+        if self.outermost:
+            _context.identity_map = None
+
+
+class LockTable(object):
+    """Reentrant locks keyed by any hashable value (e.g an account code), which
+    are created the first time they are used.
+    """
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the lock of the key
+        """
+        try:
+            return self.locks[key]
+        except KeyError:
+            with self.lock:
+                return self.locks.setdefault(key, threading.RLock())
+
+
+def _synchronized(method):
+    """Decorator for backend methods, which holds the lock of the backend
+    while the method runs.
+    """
+    @functools.wraps(method)
+    def synchronized_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return synchronized_method
+
+
+class RecordView(MutableMapping):
+    """Copy-on-write view of a record stored in a backend.
+
+    Reading through the view does not copy anything. The first write made
+    through the view copies the record, so that the stored version is never
+    modified by the caller.
+    """
+    __slots__ = ('_record', '_owned')
+
+    def __init__(self, record):
+        self._record = record
+        self._owned = False
+
+    def _own(self):
+        if not self._owned:
+            self._record = dict(self._record)
+            self._owned = True
+
+    def __getitem__(self, key):
+        return self._record[key]
+
+    def __setitem__(self, key, value):
+        self._own()
+        self._record[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        del self._record[key]
+
+    def __contains__(self, key):
+        return key in self._record
+
+    def __iter__(self):
+        return iter(self._record)
+
+    def __len__(self):
+        return len(self._record)
+
+    def __repr__(self):
+        return 'RecordView({0!r})'.format(self._record)
+
+    def copy(self):
+        return dict(self._record)
+
+
+class LayeredDict(MutableMapping):
+    """Mapping that layers writes over a read-only base mapping.
+
+    Reads fall through to the base, writes are kept in the layer and deleting
+    a key of the base leaves a tombstone that hides it. The base is never
+    modified, so it can be shared. Keys are iterated in the order of the base,
+    followed by the keys that were added to the layer.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.local = OrderedDict()
+        self.tombstones = set()
+
+    def __getitem__(self, key):
+        try:
+            return self.local[key]
+        except KeyError:
+            pass
+        if key in self.tombstones:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+
+    def __delitem__(self, key):
+        if key in self.local:
+            del self.local[key]
+            if key in self.base:
+                self.tombstones.add(key)
+        elif key in self.base and key not in self.tombstones:
+            self.tombstones.add(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.local or (key not in self.tombstones and key in self.base)
+
+    def __iter__(self):
+        base, local, tombstones = self.base, self.local, self.tombstones
+        for key in base:
+            if key not in tombstones:
+                yield key
+        for key in local:
+            if key in tombstones or key not in base:
+                yield key
+
+    def __len__(self):
+        added = sum(1 for key in self.local if key in self.tombstones or key not in self.base)
+        return len(self.base) - len(self.tombstones) + added
+
+    def is_local(self, key):
+        """Whether the value of the key is stored in the layer itself
+        """
+        return key in self.local
+
+
+class LayeredIndexes(dict):
+    """Indexes layered over read-only base indexes. The index of each field is
+    a `LayeredDict` over the base index of that field, created the first time
+    the field is used.
+    """
+    def __init__(self, base):
+        super(LayeredIndexes, self).__init__()
+        self.base = base
+
+    def __missing__(self, field):
+        index = self[field] = LayeredDict(self.base[field])
+        return index
+
+
+class ConstantMapping(Mapping):
+    """Read-only mapping of the keys of another mapping to a single value
+    """
+    def __init__(self, keys, value):
+        self.keys_mapping = keys
+        self.value = value
+
+    def __getitem__(self, key):
+        if key not in self.keys_mapping:
+            raise KeyError(key)
+        return self.value
+
+    def __contains__(self, key):
+        return key in self.keys_mapping
+
+    def __iter__(self):
+        return iter(self.keys_mapping)
+
+    def __len__(self):
+        return len(self.keys_mapping)
+
+
+class Page(object):
+    """A page of a list of objects, as requested through the `per_page` and
+    `cursor` parameters of the list endpoints.
+
+    Every object is given a position in its backend when it is first added,
+    and the cursor is the position of the last object of the previous page.
+    Since positions are never reused, pages stay stable while objects are added
+    or deleted in between requests.
+
+    Listing a page fills in `total`, the number of objects matching the
+    listing, and `next_cursor`, the cursor of the next page (or None if this is
+    the last page).
+    """
+    default_per_page = 50
+    max_per_page = 200
+
+    def __init__(self, per_page=default_per_page, cursor=None):
+        self.per_page = per_page
+        self.cursor = cursor
+        self.total = 0
+        self.next_cursor = None
+
+
+class Query(object):
+    """Filters and order of a list of objects, as requested through the
+    `state`, `sort`, `order`, `begin_time` and `end_time` parameters of the
+    list endpoints.
+
+    `states` limits the list to the objects in any of the given states, as
+    stored in the state field of the backend. When `sort` is set (to
+    `created_at` or `updated_at`), the objects are listed in the order of that
+    field, ascending or descending depending on `order`, and limited to the
+    objects whose field is between `begin_time` and `end_time` (inclusive, and
+    either can be None). Otherwise, they are listed in the order they were
+    added.
+    """
+    sort_fields = ('created_at', 'updated_at')
+    orders = ('asc', 'desc')
+
+    def __init__(self, states=None, sort=None, order='desc', begin_time=None, end_time=None):
+        self.states = states
+        self.sort = sort
+        self.order = order
+        self.begin_key = time_key(begin_time) if begin_time is not None else None
+        self.end_key = time_key(end_time) if end_time is not None else None
+
+
+def time_key(value):
+    """Returns a key ordering the given time (a datetime or ISO 8601 string)
+    along with the times stored by the endpoints, which are in UTC, without
+    parsing them.
+    """
+    if value is None or value == '':
+        return ''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(tzutc()).replace(tzinfo=None)
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    value = six.text_type(value)
+    rest = value[19:]
+    fraction = ''
+    if rest.startswith('.'):
+        rest = rest[1:]
+        digits = len(rest) - len(rest.lstrip('0123456789'))
+        fraction, rest = rest[:digits], rest[digits:]
+    if len(value) < 19 or rest not in ('', 'Z', '+00:00', '-00:00', '+0000'):
+        # Not in UTC, or not a full timestamp
+        return time_key(dateutil.parser.parse(value))
+    return value[:19] + '.' + fraction[:6].ljust(6, '0')
+
+
+class SortedIndex(object):
+    """Objects of a backend ordered by a time field, as a sorted list of
+    (time key, position, id) entries, the position breaking the ties.
+
+    Records without a time in the `updated_at` field are ordered by their
+    `created_at` field.
+    """
+    def __init__(self, field, records, positions):
+        self.field = field
+        self.keys = {}
+        # Key of each object at the time it was last indexed, by position,
+        # which are kept after the object is deleted, so that paging through
+        # a list can resume after the last object of the previous page
+        self.cursor_keys = {}
+        entries = []
+        for uuid, record in records.items():
+            key = self.key_of(record)
+            position = positions[uuid]
+            entries.append((key, position, uuid))
+            self.keys[uuid] = key
+            self.cursor_keys[position] = key
+        entries.sort()
+        self.entries = entries
+
+    def key_of(self, record):
+        value = record.get(self.field)
+        if value is None and self.field == 'updated_at':
+            value = record.get('created_at')
+        return time_key(value)
+
+    def add(self, uuid, position, record):
+        key = self.key_of(record)
+        previous_key = self.keys.get(uuid)
+        if previous_key == key:
+            return
+        if previous_key is not None:
+            del self.entries[bisect.bisect_left(self.entries, (previous_key, position, uuid))]
+        bisect.insort(self.entries, (key, position, uuid))
+        self.keys[uuid] = key
+        self.cursor_keys[position] = key
+
+    def remove(self, uuid, position):
+        key = self.keys.pop(uuid, None)
+        if key is not None:
+            del self.entries[bisect.bisect_left(self.entries, (key, position, uuid))]
+
+    def range(self, begin_key, end_key):
+        """Returns the entries whose keys are between the given keys (either
+        can be None), in ascending order
+        """
+        low = 0 if begin_key is None else bisect.bisect_left(self.entries, (begin_key,))
+        high = len(self.entries) if end_key is None else bisect.bisect_left(self.entries, (end_key, float('inf')))
+        return self.entries[low:high]
+
+
+def _match_all(record):
+    return True
 
 
 class BaseBackend(object):
     """Datastore to store resource objects in memory throughout the recurly context.
+
+    Subclasses can list foreign key fields in `indexed_fields` to maintain a
+    secondary index on them, so that looking up related objects (e.g all
+    invoices of an account) only costs as much as the number of matches.
+
+    By default, every read returns a copy of the stored record. When
+    `copy_on_write` is enabled, stored records are treated as immutable
+    snapshots instead: reads return a `RecordView` of the record and writes
+    store a new version of it, so that reads no longer pay for the copy.
+
+    Subclasses can describe the fields of their records in `columns`, in which
+    case the records are stored in a `mocurly.columnar.ColumnStore` instead of
+    a dictionary each while `columnar` is enabled (see `set_columnar`).
+
+    Objects are listed in the order they were first added, which is tracked
+    by their position so that lists can be paged through (see `Page`).
+
+    Every write to an object gives it a new version, which is used to tell
+    whether anything derived from the object (e.g its cached XML) is stale,
+    and sets its `updated_at` field.
+
+    Lists can be filtered and sorted with a `Query`. The state filter is
+    answered from the index of the `state_field`, which subclasses with
+    states list in `indexed_fields`, and sorting from a `SortedIndex` of the
+    sort field, which is built the first time a list is sorted by the field
+    and kept up to date from then on.
+
+    Each operation on the datastore holds the lock of the backend, so that
+    backends can be used from several threads at once. Operations spanning
+    several objects or backends need their own locking (see the account
+    sections of the endpoints).
     """
-    def __init__(self):
-        self.datastore = {}
+    indexed_fields = ()
+    # Field holding the state of the objects, filtered by `Query.states`
+    state_field = 'state'
+    # Attributes that are saved along with the records in snapshots and base
+    # layers
+    snapshot_attributes = ()
+    # Kind of column of each field, for the backends that support the columnar
+    # storage
+    columns = None
+    columnar = False
+
+    def __init__(self, copy_on_write=False):
+        self.copy_on_write = copy_on_write
+        self.lock = threading.RLock()
+        self.clear_all()
 
     def empty(self):
         """Whether or not the datastore is empty
@@ -17,47 +419,371 @@ class BaseBackend(object):
     def has_object(self, uuid):
         """Whether or not the datastore has an object with the requested id
         """
+        self._record_read(uuid)
         return uuid in self.datastore
 
+    @_synchronized
     def add_object(self, uuid, obj):
         """Add the provided object into the datastore
         """
+        if uuid in self.datastore:
+            self._unindex_object(uuid, self.datastore[uuid], self.indexed_fields)
+        else:
+            self.positions[uuid] = next(self.position_counter)
+        self.versions[uuid] = next(_version_counter)
         self.datastore[uuid] = obj.copy()
+        self._index_object(uuid, obj, self.indexed_fields)
+        self._sort_object(uuid)
         return obj
 
-    def list_objects(self, filter_pred=lambda x: True):
+    @_synchronized
+    def list_objects(self, filter_pred=_match_all, page=None, query=None):
         """List the objects in the datastore.
 
         You can pass in a filter function that returns a boolean given a
-        resource object to limit the number of objects to return.
+        resource object to limit the number of objects to return. The filter
+        function is given the stored record, so it must not modify it.
+
+        If a `Page` is passed in, only the objects on that page are returned,
+        and the page is filled in with the total and the next cursor. If a
+        `Query` is passed in, the objects are filtered and ordered by it.
         """
-        return list(six.moves.filter(filter_pred, [v.copy() for v in self.datastore.values()]))
+        if query is None:
+            return self._list(self.datastore, filter_pred, page)
+        return self._query(None, filter_pred, page, query)
+
+    @_synchronized
+    def list_objects_by(self, field, value, filter_pred=_match_all, page=None, query=None):
+        """List the objects whose indexed `field` is equal to `value`.
 
+        Like `list_objects`, an additional filter function, page and query can
+        be passed in to further limit the objects to return. Only the matching
+        objects are visited, so this should be preferred over `list_objects`
+        whenever the field is indexed.
+        """
+        uuids = self.indexes[field].get(value, ())
+        if query is None:
+            return self._list(sorted(uuids, key=self.positions.__getitem__), filter_pred, page)
+        return self._query(uuids, filter_pred, page, query)
+
+    @_synchronized
     def get_object(self, uuid):
         """Retrieve the object with the given id from the datastore
         """
-        return self.datastore[uuid].copy()
+        self._record_read(uuid)
+        return self._read(self.datastore[uuid])
+
+    def lookup_object(self, uuid):
+        """Retrieve the object with the given id, to hydrate a foreign key.
+
+        Within an `identity_map` scope, repeated lookups of the same version
+        of the object return the same object, so callers must not modify it
+        other than adding the hydrated fields. Outside of it, this is the same
+        as `get_object`.
+        """
+        objects = getattr(_context, 'identity_map', None)
+        if objects is None:
+            return self.get_object(uuid)
+        with self.lock:
+            # Recorded along with the read, so that the version matches it
+            self._record_read(uuid)
+            version = self.versions.get(uuid)
+            found = objects.get((self, uuid), None)
+            if found is not None and found[0] == version:
+                return found[1]
+            obj = self._read(self.datastore[uuid])
+        objects[(self, uuid)] = (version, obj)
+        return obj
 
+    @_synchronized
     def update_object(self, uuid, updated_data):
         """Update the object with the given id with the new information
         """
         obj = self.datastore[uuid]
+        if 'updated_at' not in updated_data:
+            from .utils import current_time
+            updated_data = dict(updated_data, updated_at=current_time().isoformat())
+        reindexed_fields = [field for field in self.indexed_fields if field in updated_data]
+        self._unindex_object(uuid, obj, reindexed_fields)
+        if self.copy_on_write or self._is_shared(uuid):
+            obj = dict(obj)
+            self.datastore[uuid] = obj
         obj.update(updated_data)
-        return obj.copy()
+        if self.columnar:
+            # The record was decoded from the columns
+            self.datastore[uuid] = obj
+        self.versions[uuid] = next(_version_counter)
+        self._index_object(uuid, obj, reindexed_fields)
+        self._sort_object(uuid)
+        return self._read(obj)
 
+    @_synchronized
     def delete_object(self, uuid):
         """Delete the object with the given id from the datastore
         """
+        self._unindex_object(uuid, self.datastore[uuid], self.indexed_fields)
+        for sorted_index in self.sorted_indexes.values():
+            sorted_index.remove(uuid, self.positions[uuid])
         del self.datastore[uuid]
+        del self.positions[uuid]
+        del self.versions[uuid]
 
+    @_synchronized
     def clear_all(self):
         """Clear all objects from the datastore
         """
-        self.datastore = {}
+        self.datastore = ColumnStore(self.columns) if self.columnar else OrderedDict()
+        self.indexes = dict((field, {}) for field in self.indexed_fields)
+        self.positions = {}
+        self.position_counter = itertools.count()
+        self.versions = {}
+        self.sorted_indexes = {}
+
+    @_synchronized
+    def load_records(self, records, positions, indexes, next_position=None):
+        """Replaces the contents of the datastore with an empty layer over the
+        given read-only records, e.g the records of a snapshot. Writes stay in
+        the layer, and deletes hide the records of the base behind tombstones,
+        so that the records are never modified and can be shared.
+
+        Accepts:
+            records - Mapping of the ids to the records, in order
+            positions - Mapping of the ids of the records to their positions,
+                in the order of the records
+            indexes - The indexes of the records, as a dictionary of each
+                indexed field to the set of ids per value
+            next_position - The position of the next object to be added, which
+                defaults to the number of records
+        """
+        if next_position is None:
+            next_position = len(positions)
+        self.datastore = LayeredDict(records)
+        self.indexes = LayeredIndexes(indexes)
+        self.positions = LayeredDict(positions)
+        self.position_counter = itertools.count(next_position)
+        self.versions = LayeredDict(ConstantMapping(records, next(_version_counter)))
+        self.sorted_indexes = {}
+
+    @_synchronized
+    def set_columnar(self, enabled):
+        """Switches between storing the records in columns (which requires
+        numpy) and storing a dictionary per record, moving over the records
+        that are stored. Records layered over read-only records (see
+        `load_records`) stay where they are.
+        """
+        if self.columns is None or enabled == self.columnar:
+            return
+        if enabled and isinstance(self.datastore, OrderedDict):
+            self.datastore = ColumnStore(self.columns, self.datastore.items())
+        elif not enabled and isinstance(self.datastore, ColumnStore):
+            self.datastore = OrderedDict(self.datastore.items())
+        self.columnar = enabled
+
+    @_synchronized
+    def totals(self, field, by=None, states=None):
+        """Sums the integer `field` of the objects, e.g the amounts of the
+        transactions, in total or per value of the `by` field (e.g per account
+        or currency), limited to the objects in the given states if any.
+
+        Columnar datastores sum whole columns at once.
+
+        Returns:
+            The total, or a dictionary of the total per value of `by`
+        """
+        filter_field = self.state_field if states is not None else None
+        if isinstance(self.datastore, ColumnStore):
+            return self.datastore.totals(field, by, filter_field, states)
+        return sum_records(six.itervalues(self.datastore), field, by, filter_field, states)
+
+    @_synchronized
+    def freeze(self):
+        """Freezes the contents of the datastore into read-only records, and
+        replaces the datastore with an empty layer over them (see
+        `load_records`). Returns the arguments to pass to `load_records` to
+        layer another datastore over the same records.
+        """
+        if isinstance(self.datastore, LayeredDict):
+            # Flatten the layers, so that reads never go through more than one
+            records = OrderedDict(self.datastore.items())
+            positions = dict(self.positions.items())
+            indexes = dict((field, dict(self.indexes[field].items())) for field in self.indexed_fields)
+        else:
+            records, positions, indexes = self.datastore, self.positions, self.indexes
+        frozen = (records, positions, indexes, next(self.position_counter))
+        self.load_records(*frozen)
+        return frozen
+
+    def _is_shared(self, uuid):
+        """Whether the stored record comes from read-only records, and thus
+        must not be modified in place
+        """
+        return isinstance(self.datastore, LayeredDict) and not self.datastore.is_local(uuid)
+
+    def _record_read(self, uuid):
+        reads = getattr(_context, 'reads', None)
+        if reads is not None:
+            reads.add((self, uuid, self.versions.get(uuid)))
+
+    def _sort_object(self, uuid):
+        for sorted_index in self.sorted_indexes.values():
+            sorted_index.add(uuid, self.positions[uuid], self.datastore[uuid])
+
+    def _sorted_index(self, field):
+        sorted_index = self.sorted_indexes.get(field)
+        if sorted_index is None:
+            sorted_index = self.sorted_indexes[field] = SortedIndex(field, self.datastore, self.positions)
+        return sorted_index
+
+    def _query(self, uuids, filter_pred, page, query):
+        """Lists the objects with the given ids (or all objects if None) that
+        match the query and pass the filter, limited to the given page if any.
+        """
+        if query.states is not None:
+            if self.state_field in self.indexes:
+                state_index = self.indexes[self.state_field]
+                in_states = set()
+                for state in query.states:
+                    in_states.update(state_index.get(state, ()))
+                uuids = in_states if uuids is None else in_states.intersection(uuids)
+            else:
+                states, state_field = frozenset(query.states), self.state_field
+                other_pred = filter_pred
+                filter_pred = lambda record: record.get(state_field) in states and other_pred(record)
+        if query.sort is None:
+            if uuids is None:
+                return self._list(self.datastore, filter_pred, page)
+            return self._list(sorted(uuids, key=self.positions.__getitem__), filter_pred, page)
+
+        sorted_index = self._sorted_index(query.sort)
+        begin_key, end_key = query.begin_key, query.end_key
+        if uuids is None:
+            entries = sorted_index.range(begin_key, end_key)
+        elif len(uuids) * 4 > len(sorted_index.entries):
+            # Walking the range is cheaper than sorting the objects
+            entries = [entry for entry in sorted_index.range(begin_key, end_key) if entry[2] in uuids]
+        else:
+            keys, positions = sorted_index.keys, self.positions
+            entries = sorted((keys[uuid], positions[uuid], uuid) for uuid in uuids
+                             if (begin_key is None or keys[uuid] >= begin_key) and
+                             (end_key is None or keys[uuid] <= end_key))
+        descending = query.order == 'desc'
+
+        if page is None or filter_pred is not _match_all:
+            if descending:
+                entries.reverse()
+            after_cursor = None
+            if page is not None and page.cursor is not None:
+                cursor = (sorted_index.cursor_keys.get(page.cursor, ''), page.cursor)
+                if descending:
+                    after_cursor = lambda uuid: (sorted_index.keys[uuid], self.positions[uuid]) < cursor
+                else:
+                    after_cursor = lambda uuid: (sorted_index.keys[uuid], self.positions[uuid]) > cursor
+            return self._list([entry[2] for entry in entries], filter_pred, page, after_cursor)
+
+        # Without a filter function, the page is sliced out of the entries
+        page.total = len(entries)
+        page.next_cursor = None
+        start, end = 0, len(entries)
+        if page.cursor is not None:
+            cursor_key = sorted_index.cursor_keys.get(page.cursor, '')
+            if descending:
+                end = bisect.bisect_left(entries, (cursor_key, page.cursor))
+            else:
+                start = bisect.bisect_left(entries, (cursor_key, page.cursor + 0.5))
+        if descending:
+            selected = entries[max(end - page.per_page, 0):end][::-1]
+            more = end - page.per_page > 0
+        else:
+            selected = entries[start:start + page.per_page]
+            more = start + page.per_page < len(entries)
+        if more and selected:
+            page.next_cursor = selected[-1][1]
+        return [self._read(self.datastore[entry[2]]) for entry in selected]
+
+    def _list(self, uuids, filter_pred, page, after_cursor=None):
+        """Reads the objects with the given ids that pass the filter, in order,
+        limited to the given page if any. `after_cursor` tells whether an
+        object comes after the cursor of the page, which defaults to comparing
+        the position of the object with the cursor.
+        """
+        if page is None:
+            records = (self.datastore[uuid] for uuid in uuids)
+            return [self._read(v) for v in records if filter_pred(v)]
+
+        out = []
+        page.total = 0
+        page.next_cursor = None
+        last_position = page.cursor
+        for uuid in uuids:
+            record = self.datastore[uuid]
+            if not filter_pred(record):
+                continue
+            page.total += 1
+            position = self.positions[uuid]
+            if page.cursor is not None:
+                if after_cursor is None:
+                    if position <= page.cursor:
+                        continue
+                elif not after_cursor(uuid):
+                    continue
+            if len(out) < page.per_page:
+                out.append(self._read(record))
+                last_position = position
+            elif page.next_cursor is None:
+                page.next_cursor = last_position
+        return out
+
+    def _read(self, record):
+        if self.copy_on_write:
+            return RecordView(record)
+        return record.copy()
+
+    def _index_object(self, uuid, obj, fields):
+        for field in fields:
+            if field not in obj:
+                continue
+            index = self.indexes[field]
+            try:
+                bucket = index.get(obj[field], None)
+            except TypeError:
+                # Unhashable values (e.g hydrated objects) can not be looked
+                # up by value, so they are left out of the index
+                continue
+            if bucket is None:
+                index[obj[field]] = set([uuid])
+            elif self._is_shared_bucket(index, obj[field]):
+                index[obj[field]] = bucket | set([uuid])
+            else:
+                bucket.add(uuid)
+
+    def _unindex_object(self, uuid, obj, fields):
+        for field in fields:
+            if field not in obj:
+                continue
+            index = self.indexes[field]
+            try:
+                bucket = index.get(obj[field], None)
+            except TypeError:
+                continue
+            if bucket is None or uuid not in bucket:
+                continue
+            if len(bucket) == 1:
+                del index[obj[field]]
+            elif self._is_shared_bucket(index, obj[field]):
+                index[obj[field]] = bucket - set([uuid])
+            else:
+                bucket.discard(uuid)
+
+    @staticmethod
+    def _is_shared_bucket(index, value):
+        """Whether the set of ids of the value comes from read-only indexes,
+        and thus must not be modified in place
+        """
+        return isinstance(index, LayeredDict) and not index.is_local(value)
 
 
 class AccountBackend(BaseBackend):
-    pass
+    indexed_fields = ('state',)
 
 
 class BillingInfoBackend(BaseBackend):
@@ -77,15 +803,64 @@ class BillingInfoBackend(BaseBackend):
 
 
 class InvoiceBackend(BaseBackend):
-    pass
+    """Invoice datastore, which also allocates the invoice numbers.
+
+    Invoice numbers are handed out from a counter that always stays above the
+    largest invoice number in the datastore, so that allocating one does not
+    need to scan the stored invoices.
+    """
+    indexed_fields = ('account', 'state')
+    snapshot_attributes = ('next_invoice_number',)
+    columns = {'uuid': OBJECT,
+               'invoice_number': OBJECT,
+               'account': CATEGORY,
+               'subscription': CATEGORY,
+               'original_invoice': CATEGORY,
+               'state': CATEGORY,
+               'currency': CATEGORY,
+               'collection_method': CATEGORY,
+               'tax_type': CATEGORY,
+               'net_terms': INTEGER,
+               'subtotal_in_cents': INTEGER,
+               'tax_in_cents': INTEGER,
+               'tax_rate': INTEGER,
+               'total_in_cents': INTEGER,
+               'created_at': TIME,
+               'updated_at': TIME,
+               'line_items': OBJECT,
+               'transactions': OBJECT}
+    first_invoice_number = 1000
+
+    def __init__(self, *args, **kwargs):
+        self.invoice_number_lock = threading.Lock()
+        super(InvoiceBackend, self).__init__(*args, **kwargs)
+
+    def allocate_invoice_number(self):
+        """Returns a new invoice number, which is never handed out twice
+        """
+        with self.invoice_number_lock:
+            invoice_number = self.next_invoice_number
+            self.next_invoice_number += 1
+        return str(invoice_number)
+
+    def add_object(self, uuid, obj):
+        if obj.get('invoice_number', None) is not None:
+            with self.invoice_number_lock:
+                self.next_invoice_number = max(self.next_invoice_number, int(obj['invoice_number']) + 1)
+        return super(InvoiceBackend, self).add_object(uuid, obj)
+
+    def clear_all(self):
+        super(InvoiceBackend, self).clear_all()
+        with self.invoice_number_lock:
+            self.next_invoice_number = self.first_invoice_number
 
 
 class CouponBackend(BaseBackend):
-    pass
+    indexed_fields = ('state',)
 
 
 class CouponRedemptionBackend(BaseBackend):
-    pass
+    indexed_fields = ('account_code', 'coupon')
 
 
 class PlanBackend(BaseBackend):
@@ -93,47 +868,317 @@ class PlanBackend(BaseBackend):
 
 
 class PlanAddOnBackend(BaseBackend):
-    pass
+    indexed_fields = ('plan',)
 
 
 class SubscriptionBackend(BaseBackend):
-    pass
+    """Subscription datastore, which also schedules the changes that happen to
+    the subscriptions with the passing of time: renewing active subscriptions
+    (including the end of their trial) at the end of their current period,
+    expiring canceled subscriptions, and activating future subscriptions.
+
+    The next event of each subscription is kept in a heap keyed by its time,
+    so that finding the due events does not visit the other subscriptions.
+    Entries are not removed from the heap when a subscription changes, but are
+    skipped when they no longer match the next event of the subscription.
+    """
+    indexed_fields = ('account', 'state')
+    # Field holding the time of the next event of the subscriptions, by state
+    event_fields = {'active': 'current_period_ends_at',
+                    'canceled': 'expires_at',
+                    'future': 'activated_at'}
+
+    def add_object(self, uuid, obj):
+        with self.lock:
+            obj = super(SubscriptionBackend, self).add_object(uuid, obj)
+            self._schedule(uuid)
+        return obj
+
+    def update_object(self, uuid, updated_data):
+        with self.lock:
+            obj = super(SubscriptionBackend, self).update_object(uuid, updated_data)
+            self._schedule(uuid)
+        return obj
+
+    def delete_object(self, uuid):
+        with self.lock:
+            super(SubscriptionBackend, self).delete_object(uuid)
+            if self.event_keys is not None:
+                self.event_keys.pop(uuid, None)
+
+    def clear_all(self):
+        with self.lock:
+            super(SubscriptionBackend, self).clear_all()
+            self.events = []
+            self.event_keys = {}
+
+    def load_records(self, *args, **kwargs):
+        with self.lock:
+            super(SubscriptionBackend, self).load_records(*args, **kwargs)
+            # The events of the records are scheduled when first needed
+            self.events = None
+            self.event_keys = None
+
+    @_synchronized
+    def next_event(self, until):
+        """Removes the earliest event due at or before the given time (a
+        datetime or ISO 8601 string) from the schedule.
+
+        Returns:
+            The id of the subscription of the event, or None if no event is due
+        """
+        if self.events is None:
+            self._schedule_all()
+        until_key = time_key(until)
+        events, event_keys = self.events, self.event_keys
+        while events and events[0][0] <= until_key:
+            key, position, uuid = heapq.heappop(events)
+            if event_keys.get(uuid) == key:
+                del event_keys[uuid]
+                return uuid
+        return None
+
+    def _event_key(self, record):
+        field = self.event_fields.get(record.get('state'))
+        value = record.get(field) if field is not None else None
+        return time_key(value) if value else None
+
+    def _schedule(self, uuid):
+        if self.event_keys is None:
+            return
+        key = self._event_key(self.datastore[uuid])
+        if key == self.event_keys.get(uuid):
+            return
+        if key is None:
+            del self.event_keys[uuid]
+        else:
+            self.event_keys[uuid] = key
+            heapq.heappush(self.events, (key, self.positions[uuid], uuid))
+
+    def _schedule_all(self):
+        self.event_keys = {}
+        events = []
+        for uuid, record in self.datastore.items():
+            key = self._event_key(record)
+            if key is not None:
+                self.event_keys[uuid] = key
+                events.append((key, self.positions[uuid], uuid))
+        heapq.heapify(events)
+        self.events = events
 
 
 class TransactionBackend(BaseBackend):
-    pass
+    indexed_fields = ('account', 'subscription', 'status')
+    state_field = 'status'
+    columns = {'uuid': OBJECT,
+               'account': CATEGORY,
+               'invoice': CATEGORY,
+               'subscription': CATEGORY,
+               'action': CATEGORY,
+               'status': CATEGORY,
+               'currency': CATEGORY,
+               'payment_method': CATEGORY,
+               'description': CATEGORY,
+               'amount_in_cents': INTEGER,
+               'tax_in_cents': INTEGER,
+               'test': BOOLEAN,
+               'voidable': BOOLEAN,
+               'refundable': BOOLEAN,
+               'created_at': TIME,
+               'updated_at': TIME}
 
 
 class AdjustmentBackend(BaseBackend):
-    pass
+    indexed_fields = ('state',)
+    columns = {'uuid': OBJECT,
+               'account_code': CATEGORY,
+               'invoice': CATEGORY,
+               'state': CATEGORY,
+               'type': CATEGORY,
+               'origin': CATEGORY,
+               'currency': CATEGORY,
+               'product_code': CATEGORY,
+               'description': CATEGORY,
+               'unit_amount_in_cents': INTEGER,
+               'quantity': INTEGER,
+               'discount_in_cents': INTEGER,
+               'tax_in_cents': INTEGER,
+               'total_in_cents': INTEGER,
+               'tax_exempt': BOOLEAN,
+               'created_at': TIME,
+               'updated_at': TIME,
+               'start_date': OBJECT,
+               'end_date': OBJECT}
+
+
+class State(object):
+    """The mocked state of a mocurly context: a complete set of the resource
+    backends, along with the XML cache, the serializer, the locks of the
+    account sections, the transaction failures registered with the endpoints
+    and the virtual clock.
+
+    Each mocurly context has its own state, so that contexts are isolated
+    from each other, even when they are active at the same time in different
+    threads.
+    """
+    backend_classes = (('accounts_backend', AccountBackend),
+                       ('billing_info_backend', BillingInfoBackend),
+                       ('invoices_backend', InvoiceBackend),
+                       ('coupons_backend', CouponBackend),
+                       ('coupon_redemptions_backend', CouponRedemptionBackend),
+                       ('plans_backend', PlanBackend),
+                       ('plan_add_ons_backend', PlanAddOnBackend),
+                       ('subscriptions_backend', SubscriptionBackend),
+                       ('transactions_backend', TransactionBackend),
+                       ('adjustments_backend', AdjustmentBackend))
+
+    def __init__(self):
+        from .cache import XMLCache
+        self.backends = []
+        for name, backend_class in self.backend_classes:
+            backend = backend_class()
+            setattr(self, name, backend)
+            self.backends.append(backend)
+        self.xml_cache = XMLCache()
+        self.serializer = 'jinja2'
+        self.account_locks = LockTable()
+        self.registered_errors = {}
+        # The virtual clock of the endpoints runs this far ahead of the wall
+        # clock, unless it is stopped at `frozen_time`
+        self.clock_offset = datetime.timedelta(0)
+        self.frozen_time = None
+
+
+# The state used by threads that are not within a `using_state` scope, which
+# is the state of the most recently started mocurly context
+_default_state = None
+_default_state_lock = threading.Lock()
+
+
+def current_state():
+    """Returns the state that the backends resolve to in the current thread
+    """
+    state = getattr(_context, 'state', None)
+    if state is not None:
+        return state
+    if _default_state is None:
+        set_default_state(None)
+    return _default_state
+
+
+def set_default_state(state):
+    """Sets the state used by threads that are not within a `using_state`
+    scope. None sets a new, empty state.
+    """
+    global _default_state
+    with _default_state_lock:
+        _default_state = state if state is not None else State()
+
+
+class using_state(object):
+    """Context manager within which the backends resolve to the given state in
+    the current thread.
+    """
+    def __init__(self, state):
+        self.state = state
+
+    def __enter__(self):
+        self.previous_state = getattr(_context, 'state', None)
+        _context.state = self.state
+        return self.state
+
+    def __exit__(self, type, value, tb):
+        _context.state = self.previous_state
+
+
+class StateProxy(object):
+    """Stands in for an attribute of the current state (e.g one of its
+    backends), forwarding all attribute access to it.
+    """
+    __slots__ = ('_name',)
+
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    def __getattr__(self, attr):
+        return getattr(getattr(current_state(), self._name), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(getattr(current_state(), self._name), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(getattr(current_state(), self._name), attr)
+
+    def __repr__(self):
+        return 'StateProxy({0!r})'.format(self._name)
 
 
 # Provide public access to each resource backend, so that users can do low
 # level object checking in their tests (e.g query objects that were created as
-# a side effect of an action)
-accounts_backend = AccountBackend()
-billing_info_backend = BillingInfoBackend()
-invoices_backend = InvoiceBackend()
-coupons_backend = CouponBackend()
-coupon_redemptions_backend = CouponRedemptionBackend()
-plans_backend = PlanBackend()
-plan_add_ons_backend = PlanAddOnBackend()
-subscriptions_backend = SubscriptionBackend()
-transactions_backend = TransactionBackend()
-adjustments_backend = AdjustmentBackend()
+# a side effect of an action). These stand in for the backends of the current
+# state.
+accounts_backend = StateProxy('accounts_backend')
+billing_info_backend = StateProxy('billing_info_backend')
+invoices_backend = StateProxy('invoices_backend')
+coupons_backend = StateProxy('coupons_backend')
+coupon_redemptions_backend = StateProxy('coupon_redemptions_backend')
+plans_backend = StateProxy('plans_backend')
+plan_add_ons_backend = StateProxy('plan_add_ons_backend')
+subscriptions_backend = StateProxy('subscriptions_backend')
+transactions_backend = StateProxy('transactions_backend')
+adjustments_backend = StateProxy('adjustments_backend')
+backends = [accounts_backend,
+            billing_info_backend,
+            invoices_backend,
+            coupons_backend,
+            coupon_redemptions_backend,
+            plans_backend,
+            plan_add_ons_backend,
+            subscriptions_backend,
+            transactions_backend,
+            adjustments_backend]
 
 
 def clear_backends():
     """Clears all resource datastores. This ensures that no residual state
     carries over across mocurly contexts.
     """
-    accounts_backend.clear_all()
-    billing_info_backend.clear_all()
-    invoices_backend.clear_all()
-    coupons_backend.clear_all()
-    coupon_redemptions_backend.clear_all()
-    plans_backend.clear_all()
-    plan_add_ons_backend.clear_all()
-    subscriptions_backend.clear_all()
-    transactions_backend.clear_all()
-    adjustments_backend.clear_all()
+    for backend in backends:
+        backend.clear_all()
+
+
+def freeze_backends():
+    """Freezes the contents of all resource datastores into read-only records,
+    which any number of datastores can then be layered over using
+    `overlay_backends`.
+    """
+    return [(backend.freeze(), dict((name, getattr(backend, name)) for name in backend.snapshot_attributes))
+            for backend in backends]
+
+
+def overlay_backends(frozen):
+    """Replaces all resource datastores with empty layers over the records
+    frozen by `freeze_backends`. This only costs as much as the number of
+    backends, regardless of the number of records.
+    """
+    for backend, (records, attributes) in zip(backends, frozen):
+        backend.load_records(*records)
+        for name, value in attributes.items():
+            setattr(backend, name, value)
+
+
+def set_columnar(enabled):
+    """Switches the datastores of the backends that support it (invoices,
+    transactions and adjustments) between storing the records in columns and
+    storing a dictionary per record. The columnar storage requires numpy.
+    """
+    for backend in backends:
+        backend.set_columnar(enabled)
+
+
+def set_copy_on_write(enabled):
+    """Switches the storage mode of all resource datastores between copying
+    records on every read and handing out copy-on-write views of them.
+    """
+    for backend in backends:
+        backend.copy_on_write = enabled
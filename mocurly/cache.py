@@ -0,0 +1,88 @@
+"""Cache of the XML generated for resource objects
+
+Serializing an object hydrates its foreign keys, builds its URIs and renders
+its template, all of which can be skipped if neither the object nor anything it
+embeds has changed since it was last serialized. Each cached entry remembers
+the version of every object that was read from the backends while generating
+it, and is only used as long as all of them are still at that version.
+
+The cache is bounded: once full, caching an entry evicts the least recently
+used one.
+"""
+import threading
+from collections import OrderedDict
+
+from .backend import record_reads, StateProxy
+
+# Number of XML fragments kept by the XML cache of a mocurly context
+DEFAULT_XML_CACHE_SIZE = 10000
+
+
+class XMLCache(object):
+    """Cache of XML fragments, keyed by the resource template and the primary
+    key of the object, holding at most `max_entries` of them.
+    """
+    def __init__(self, max_entries=DEFAULT_XML_CACHE_SIZE):
+        self.enabled = False
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached XML for the key, or None if there is none or if
+        any of the objects it was generated from has changed since.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            reads, xml = entry
+            for backend, uuid, version in reads:
+                if backend.versions.get(uuid) != version:
+                    return None
+            # Most recently used
+            self.entries[key] = entry
+            return xml
+
+    def generate(self, key, backend, uuid, generate_xml, obj):
+        """Returns the cached XML for the key, generating and caching it using
+        `generate_xml` if it is missing or stale.
+
+        `obj` is the object as the caller read it from `backend` under `uuid`.
+        Since it may have been written to since, it is read again along with
+        its version, and `generate_xml` is given that object, so that the XML
+        is never cached under a newer version than it was generated from. If
+        the object has been deleted since, the XML of `obj` is returned without
+        being cached.
+        """
+        xml = self.get(key)
+        if xml is not None:
+            return xml
+        with record_reads() as reads:
+            try:
+                obj = backend.get_object(uuid)
+            except KeyError:
+                return generate_xml(obj)
+            xml = generate_xml(obj)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (frozenset(reads), xml)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return xml
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+
+# The XML cache of the current state
+xml_cache = StateProxy('xml_cache')
+
+
+def set_xml_cache(enabled):
+    """Enables or disables the XML cache of the current state. The cache is
+    emptied either way.
+    """
+    xml_cache.enabled = enabled
+    xml_cache.clear()
@@ -0,0 +1,379 @@
+"""Columnar storage of the records of a backend
+
+A `ColumnStore` keeps the records of a backend in typed NumPy arrays, one per
+field, instead of a dictionary per record: integers and times in 64 bit
+integer arrays, booleans in boolean arrays, repeated strings (e.g currencies,
+states and foreign keys) dictionary encoded as integer codes, and any other
+value in object arrays. Values that do not fit the type of their column, and
+fields without a column, are kept in a sparse dictionary of extra fields per
+record, so that every record reads back exactly as it was written.
+
+The store is a mapping of the ids to the records like the datastore of the
+backends, decoding a new dictionary on every read, and computes aggregates
+(see `ColumnStore.totals`) over whole columns at once.
+
+NumPy is an optional dependency, only needed when the columnar storage is
+enabled with the `columnar` option of the mocurly context.
+"""
+import sys
+import datetime
+from collections import OrderedDict
+
+import six
+import pytz
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # python 2
+    from collections import MutableMapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Kinds of columns
+INTEGER = 'integer'
+TIME = 'time'
+BOOLEAN = 'boolean'
+CATEGORY = 'category'
+OBJECT = 'object'
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+# Marks a value that does not fit its column
+_MISFIT = object()
+
+# Dictionaries keep the order of their keys from python 3.7 on, and take less
+# memory than ordered dictionaries
+_ordered_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+
+class Column(object):
+    """Values of a single field, with a mask of the records that have it
+    """
+    dtype = object
+
+    def __init__(self, capacity):
+        self.values = numpy.zeros(capacity, dtype=self.dtype)
+        self.present = numpy.zeros(capacity, dtype=bool)
+
+    def grow(self, capacity):
+        values = numpy.zeros(capacity, dtype=self.dtype)
+        values[:len(self.values)] = self.values
+        present = numpy.zeros(capacity, dtype=bool)
+        present[:len(self.present)] = self.present
+        self.values, self.present = values, present
+
+    def set(self, row, value):
+        """Stores the value of the record in the given row, and returns whether
+        it fits the column
+        """
+        encoded = self.encode(value)
+        if encoded is _MISFIT:
+            self.present[row] = False
+            return False
+        self.values[row] = encoded
+        self.present[row] = True
+        return True
+
+    def get(self, row):
+        return self.decode(self.values[row])
+
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+
+class IntegerColumn(Column):
+    """Integers, including those written as text (e.g amounts parsed from a
+    request), which read back as text
+    """
+    dtype = 'int64'
+
+    def __init__(self, capacity):
+        super(IntegerColumn, self).__init__(capacity)
+        self.text = numpy.zeros(capacity, dtype=bool)
+
+    def grow(self, capacity):
+        super(IntegerColumn, self).grow(capacity)
+        text = numpy.zeros(capacity, dtype=bool)
+        text[:len(self.text)] = self.text
+        self.text = text
+
+    def set(self, row, value):
+        is_text = isinstance(value, six.string_types)
+        if is_text:
+            try:
+                number = int(value)
+            except ValueError:
+                number = None
+            if number is None or str(number) != value:
+                self.present[row] = False
+                return False
+            value = number
+        elif isinstance(value, bool) or not isinstance(value, six.integer_types) or not -2 ** 63 <= value < 2 ** 63:
+            self.present[row] = False
+            return False
+        self.values[row] = value
+        self.text[row] = is_text
+        self.present[row] = True
+        return True
+
+    def get(self, row):
+        value = self.values.item(row)
+        return str(value) if self.text.item(row) else value
+
+
+class TimeColumn(Column):
+    """Times in the format written by the endpoints (`isoformat` of a time in
+    UTC), as microseconds since the epoch
+    """
+    dtype = 'int64'
+
+    def encode(self, value):
+        if not isinstance(value, six.string_types) or not value.endswith('+00:00') or _fromisoformat is None:
+            return _MISFIT
+        try:
+            delta = _fromisoformat(value) - _EPOCH
+        except (ValueError, TypeError):
+            return _MISFIT
+        microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        if self.decode(microseconds) != value:
+            return _MISFIT
+        return microseconds
+
+    def get(self, row):
+        return self.decode(self.values.item(row))
+
+    def decode(self, value):
+        return (_EPOCH + datetime.timedelta(microseconds=value)).isoformat()
+
+
+class BooleanColumn(Column):
+    dtype = bool
+
+    def encode(self, value):
+        return value if isinstance(value, bool) else _MISFIT
+
+    def get(self, row):
+        return self.values.item(row)
+
+
+class CategoryColumn(Column):
+    """Strings that repeat across the records, stored as integer codes into
+    the list of the distinct strings
+    """
+    dtype = 'int32'
+
+    def __init__(self, capacity):
+        super(CategoryColumn, self).__init__(capacity)
+        self.categories = []
+        self.codes = {}
+
+    def encode(self, value):
+        if not isinstance(value, six.string_types):
+            return _MISFIT
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def get(self, row):
+        return self.categories[self.values.item(row)]
+
+
+class ObjectColumn(Column):
+    """Any other value, e.g unique strings or lists of ids
+    """
+    def set(self, row, value):
+        self.values[row] = value
+        self.present[row] = True
+        return True
+
+    def get(self, row):
+        return self.values[row]
+
+    def clear(self, row):
+        self.values[row] = None
+
+
+COLUMN_CLASSES = {INTEGER: IntegerColumn,
+                  TIME: TimeColumn,
+                  BOOLEAN: BooleanColumn,
+                  CATEGORY: CategoryColumn,
+                  OBJECT: ObjectColumn}
+
+
+class ColumnStore(MutableMapping):
+    """Mapping of the ids to the records of a backend, stored in columns.
+
+    Accepts:
+        schema - Dictionary of the kind of column of each field
+        records - Records to store, as (id, record) pairs in order
+    """
+    initial_capacity = 64
+
+    def __init__(self, schema, records=()):
+        if numpy is None:
+            raise ImportError('The columnar storage requires numpy')
+        self.schema = schema
+        self.capacity = self.initial_capacity
+        self.columns = [(field, COLUMN_CLASSES[kind](self.capacity)) for field, kind in sorted(schema.items())]
+        self.columns_by_field = dict(self.columns)
+        # Row of each record, in the order the records were added
+        self.rows = _ordered_dict()
+        # Id of the record in each row
+        self.row_uuids = []
+        # Rows left behind by deleted records, reused by new records
+        self.free_rows = []
+        # Fields of each row that are not stored in the columns
+        self.extras = {}
+        for uuid, record in records:
+            self[uuid] = record
+
+    def __getitem__(self, uuid):
+        row = self.rows[uuid]
+        record = {}
+        for field, column in self.columns:
+            if column.present.item(row):
+                record[field] = column.get(row)
+        extras = self.extras.get(row)
+        if extras is not None:
+            record.update(extras)
+        return record
+
+    def __setitem__(self, uuid, record):
+        row = self.rows.get(uuid)
+        if row is None:
+            row = self._allocate_row()
+            self.rows[uuid] = row
+            self.row_uuids[row] = uuid
+        extras = {}
+        for field, column in self.columns:
+            if field in record:
+                if not column.set(row, record[field]):
+                    extras[field] = record[field]
+            elif column.present.item(row):
+                self._clear(column, row)
+        for field, value in record.items():
+            if field not in self.columns_by_field:
+                extras[field] = value
+        if extras:
+            self.extras[row] = extras
+        else:
+            self.extras.pop(row, None)
+
+    def __delitem__(self, uuid):
+        row = self.rows.pop(uuid)
+        for field, column in self.columns:
+            self._clear(column, row)
+        self.extras.pop(row, None)
+        self.row_uuids[row] = None
+        self.free_rows.append(row)
+
+    def __contains__(self, uuid):
+        return uuid in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def totals(self, field, by=None, filter_field=None, filter_values=None):
+        """Sums the integer `field` of the records, in total or per value of
+        the `by` field, limited to the records whose `filter_field` is one of
+        the `filter_values` if given. Records without the field are skipped,
+        and records without the `by` field are totaled under None.
+
+        Returns:
+            The total, or a dictionary of the total per value of `by`
+        """
+        value_column = self.columns_by_field.get(field)
+        by_column = self.columns_by_field.get(by) if by is not None else None
+        filter_column = self.columns_by_field.get(filter_field) if filter_field is not None else None
+        if not isinstance(value_column, IntegerColumn) or \
+                (by is not None and not isinstance(by_column, CategoryColumn)) or \
+                (filter_field is not None and not isinstance(filter_column, CategoryColumn)):
+            return sum_records(six.itervalues(self), field, by, filter_field, filter_values)
+
+        # Records with any of the fields outside of the columns are totaled one
+        # by one, and all other records at once
+        mask = value_column.present.copy()
+        extra_rows = [row for row, extras in self.extras.items()
+                      if field in extras or by in extras or filter_field in extras]
+        mask[extra_rows] = False
+        if filter_field is not None:
+            codes = [filter_column.codes[value] for value in filter_values if value in filter_column.codes]
+            mask &= filter_column.present & numpy.isin(filter_column.values, codes)
+        extra_records = (self[self.row_uuids[row]] for row in extra_rows)
+        extra_totals = sum_records(extra_records, field, by, filter_field, filter_values)
+
+        values = value_column.values[mask]
+        if by is None:
+            return int(values.sum()) + extra_totals
+
+        grouped = by_column.present[mask]
+        group_codes = by_column.values[mask][grouped]
+        sums = numpy.bincount(group_codes, weights=values[grouped], minlength=len(by_column.categories))
+        counts = numpy.bincount(group_codes, minlength=len(by_column.categories))
+        out = dict((by_column.categories[code], int(round(sums[code]))) for code in numpy.nonzero(counts)[0])
+        if not grouped.all():
+            out[None] = int(values[~grouped].sum())
+        for value, total in extra_totals.items():
+            out[value] = out.get(value, 0) + total
+        return out
+
+    def nbytes(self):
+        """Returns the number of bytes taken by the arrays of the columns
+        """
+        total = 0
+        for field, column in self.columns:
+            total += column.values.nbytes + column.present.nbytes
+            if isinstance(column, IntegerColumn):
+                total += column.text.nbytes
+        return total
+
+    def _allocate_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        row = len(self.row_uuids)
+        self.row_uuids.append(None)
+        if row >= self.capacity:
+            self.capacity *= 2
+            for field, column in self.columns:
+                column.grow(self.capacity)
+        return row
+
+    def _clear(self, column, row):
+        column.present[row] = False
+        if isinstance(column, ObjectColumn):
+            # Let go of the value
+            column.clear(row)
+
+
+def sum_records(records, field, by, filter_field, filter_values):
+    """Sums the integer `field` of the records like `ColumnStore.totals`, one
+    record at a time
+    """
+    if filter_field is not None:
+        filter_values = frozenset(filter_values)
+    total = 0
+    totals = {}
+    for record in records:
+        if field not in record:
+            continue
+        if filter_field is not None and record.get(filter_field) not in filter_values:
+            continue
+        value = int(record[field])
+        if by is None:
+            total += value
+        else:
+            key = record.get(by)
+            totals[key] = totals.get(key, 0) + value
+    return total if by is None else totals
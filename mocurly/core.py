@@ -7,12 +7,41 @@ import recurly
 import re
 import ssl
 import functools
-from six.moves.urllib.parse import urlparse, parse_qs, unquote
+import threading
+import dateutil.relativedelta
 from httpretty import HTTPretty
 
-from .utils import deserialize
 from .errors import ResponseError
-from .backend import clear_backends
+from .metrics import Metrics, UNMATCHED_ROUTE, process_metrics, timing_request, set_route
+from .ratelimit import RATE_LIMITED_BODY, api_key_of
+from .journal import Journal, DEFAULT_JOURNAL_SIZE
+from .backend import State, using_state, set_default_state
+from .backend import clear_backends, freeze_backends, overlay_backends, set_copy_on_write, set_columnar
+from .utils import set_serializer
+from .cache import xml_cache, set_xml_cache
+from .router import Router
+
+# The router and its registration to HTTPretty are set up once per process,
+# while the mocurly context that the requests are handled in changes as
+# contexts are started and stopped.
+_router = None
+_installed = False
+_session_instance = None
+_active_instance = None
+_base_layer = None
+# The started mocurly contexts of all threads, in the order they were started,
+# the last one being the `_active_instance`. Each thread also keeps track of
+# the context that it started last, in `_local.instance`.
+_started_instances = []
+_started_instances_lock = threading.Lock()
+_local = threading.local()
+# HTTPretty calls the callbacks from a helper thread, and shares the matched
+# route between the requests of all threads. The requests made by the recurly
+# client are therefore handled one at a time, each with the binding of the
+# mocurly context of the requesting thread.
+_request_lock = threading.RLock()
+_request_binding = None
+_original_http_request = None
 
 
 class mocurly(object):
@@ -21,17 +50,68 @@ class mocurly(object):
     This can be used as a decorator, as a context manager, or manually. In all
     three cases, the guarded context will route all recurly requests to the
     mocked callback functions defined in endpoints.py.
+
+    Options for the context can be passed in as keyword arguments, in which
+    case the decorator form becomes `@mocurly(option=value)`:
+        `copy_on_write` -> when True, the backends store records as immutable
+            snapshots and hand out copy-on-write views of them on reads,
+            instead of copying each record on every read.
+        `serializer` -> `jinja2` (the default) to render the resource
+            templates, or `native` to write the XML directly, which is faster
+            and generates the same XML.
+        `xml_cache` -> when True, the XML of objects that are retrieved or
+            listed is cached, and reused until the object or any object it
+            embeds is written to.
+        `journal_size` -> the number of most recent requests kept in the
+            journal of the context (see `mocurly.journal.Journal`), 1000 by
+            default. 0 disables the journal.
+        `network` -> a `mocurly.network.NetworkModel` delaying the responses,
+            to simulate the latency and bandwidth of the network (see
+            `start_latency`).
+        `rate_limiter` -> a `mocurly.ratelimit.RateLimiter` limiting the
+            requests of each API key (see `start_rate_limit`).
+        `columnar` -> when True, the invoices, transactions and adjustments
+            are stored in typed columns instead of a dictionary each, which
+            takes less memory and sums amounts faster (see
+            `mocurly.columnar`). Requires numpy.
+
+    Each context has its own state (see `mocurly.backend.State`), so contexts
+    that are active at the same time in different threads are isolated from
+    each other. The module level backends resolve to the state of the context
+    started in the current thread, or else of the most recently started
+    context, and the requests of the recurly client are handled in the
+    context of the requesting thread. Contexts can also be nested, in which
+    case the requests are handled in the context of the innermost one, and in
+    the outer one again once the inner one is stopped. HTTPretty is disabled
+    when the last started context is stopped, unless mocurly is installed.
     """
-    def __init__(self, func=None):
+    def __init__(self, func=None, copy_on_write=False, serializer='jinja2', xml_cache=False,
+                 journal_size=DEFAULT_JOURNAL_SIZE, network=None,
+                 rate_limiter=None, columnar=False):
         self.started = False
-        HTTPretty.reset()
+        if not _installed and not _started_instances:
+            HTTPretty.reset()
 
         self.timeout_filter = None
         self.timeout_connection = False
         self.timeout_connection_successful_post = False
+        self.network = network
+        self.rate_limiter = rate_limiter
         self.func = func
+        self.state = State()
+        self.metrics = Metrics()
+        self.journal = Journal(journal_size)
+        self.copy_on_write = copy_on_write
+        self.serializer = serializer
+        self.xml_cache = xml_cache
+        self.columnar = columnar
 
     def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # Used as a decorator with options
+            self.func = args[0]
+            return self
+
         self.start()
         try:
             retval = self.func(*args, **kwargs)
@@ -53,23 +133,55 @@ class mocurly(object):
         """Starts the mocked context by enabling HTTPretty to route requests to
         the defined endpoints.
         """
-        from .endpoints import clear_endpoints
+        global _active_instance
         self.started = True
-        clear_endpoints()
-        clear_backends()
+        with _started_instances_lock:
+            _started_instances.append(self)
+            _active_instance = self
+            set_default_state(self.state)
+        self.previous_thread_instance = getattr(_local, 'instance', None)
+        _local.instance = self
+        self.state_scope = using_state(self.state)
+        self.state_scope.__enter__()
+        reset()
+        self._apply_options()
 
         if not HTTPretty.is_enabled():
             HTTPretty.enable()
+        _bind_requests()
 
-        self._register()
+        if not _installed:
+            _register()
 
     def stop(self):
         """Stops the mocked context, restoring the routes back to what they were
         """
+        global _active_instance
         if not self.started:
             raise RuntimeError('Called stop() before start()')
 
-        HTTPretty.disable()
+        self.state_scope.__exit__(None, None, None)
+        _local.instance = self.previous_thread_instance
+        # Contexts of different threads may be stopped in any order
+        with _started_instances_lock:
+            if self in _started_instances:
+                _started_instances.remove(self)
+            _active_instance = _started_instances[-1] if _started_instances else None
+            _restore_default_state()
+            last = not _started_instances
+        # Nested contexts, and contexts of other threads, keep the requests
+        # mocked until the last of them is stopped
+        if last and not _installed:
+            _unbind_requests()
+            HTTPretty.disable()
+
+    def _apply_options(self):
+        """Applies the options to the current state
+        """
+        set_copy_on_write(self.copy_on_write)
+        set_columnar(self.columnar)
+        set_serializer(self.serializer)
+        set_xml_cache(self.xml_cache)
 
     def start_timeout(self, timeout_filter=None):
         """Notifies mocurly to start simulating time outs within the current
@@ -135,6 +247,49 @@ class mocurly(object):
         self.timeout_filter = None
         self.timeout_connection_successful_post = False
 
+    def start_latency(self, network):
+        """Notifies mocurly to delay the responses within the current context
+        by the latency and bandwidth of the given `mocurly.network.NetworkModel`.
+
+        The delay is applied once the request is handled, so a request that the
+        client gives up on (e.g because it exceeded
+        `recurly.SOCKET_TIMEOUT_SECONDS`) still has its effects. Since the
+        requests made through HTTPretty are handled one at a time, the delays
+        of requests made in parallel add up; use the standalone server (see
+        `mocurly.server`) to delay parallel requests independently.
+        """
+        self.network = network
+
+    def stop_latency(self):
+        """Notifies mocurly to stop delaying the responses within the current
+        context.
+        """
+        self.network = None
+
+    def start_rate_limit(self, rate_limiter):
+        """Notifies mocurly to limit the rate of the requests within the
+        current context with the given `mocurly.ratelimit.RateLimiter`.
+
+        Like recurly, every response then has `X-RateLimit-Limit`,
+        `X-RateLimit-Remaining` and `X-RateLimit-Reset` headers, and requests
+        made once the API key has no requests left are answered with a 429.
+        """
+        self.rate_limiter = rate_limiter
+
+    def stop_rate_limit(self):
+        """Notifies mocurly to stop limiting the rate of the requests within
+        the current context.
+        """
+        self.rate_limiter = None
+
+    def stats(self):
+        """Returns the metrics of the requests handled within this context, per
+        route: the number of requests per status, the size of the responses
+        and histograms of the time spent handling them. See
+        `mocurly.metrics.Metrics.stats` for the format.
+        """
+        return self.metrics.stats()
+
     def register_transaction_failure(self, account_code, error_code):
         """Register a transaction failure for the given account.
 
@@ -142,140 +297,287 @@ class mocurly(object):
         with the given `account_code` will fail with the selected `error_code`.
         """
         from .endpoints import transactions_endpoint
-        transactions_endpoint.register_transaction_failure(account_code, error_code)
+        with using_state(self.state):
+            transactions_endpoint.register_transaction_failure(account_code, error_code)
 
-    def _register(self):
-        """Walks the endpoints to register all its URIs to HTTPretty so that
-        they can mock recurly requests.
+    def advance(self, **delta):
+        """Moves the virtual clock of this context forward (see `advance`).
         """
+        with using_state(self.state):
+            advance(**delta)
+
+
+def advance(**delta):
+    """Moves the virtual clock of the current context forward by the given
+    amount of time, given as the keyword arguments of
+    `dateutil.relativedelta.relativedelta` (e.g `advance(days=30)` or
+    `advance(months=1)`).
+
+    The subscriptions change as recurly would change them in the meantime:
+    they are renewed (ending their trial), expired once canceled, or activated
+    once started, with the invoices, transactions and adjustments of the
+    charged periods dated at the time of the change. From then on, the
+    timestamps of the endpoints are read from the advanced clock.
+    """
+    from .endpoints import subscriptions_endpoint
+    subscriptions_endpoint.advance(dateutil.relativedelta.relativedelta(**delta))
+
+
+def install(**options):
+    """Installs mocurly for the rest of the process.
+
+    The routes are registered to HTTPretty once, and stay registered (and
+    HTTPretty enabled) until `uninstall` is called, so that starting and
+    stopping mocurly contexts only needs to reset the mocked state. Requests
+    made outside of a started context are handled in a session wide context,
+    which takes the same keyword options as the `mocurly` class.
+
+    Note that the routes are registered using the `recurly.base_uri()` at the
+    time of the installation.
+    """
+    global _installed, _session_instance
+    if _installed:
+        return
+    _session_instance = mocurly(**options)
+    _session_instance.start()
+    _installed = True
+
+
+def uninstall():
+    """Reverts `install`, disabling HTTPretty.
+    """
+    global _installed, _session_instance
+    if not _installed:
+        return
+    _installed = False
+    _session_instance.stop()
+    _session_instance = None
+    _unbind_requests()
+
+
+def reset():
+    """Clears all state in the backends and endpoints, without touching the
+    routes. This is a cheap way to isolate tests from each other when mocurly
+    is installed for the whole session.
+
+    If a base layer was set with `set_base_layer`, the state is reset to the
+    base layer instead of being cleared.
+    """
+    from .endpoints import clear_endpoints, set_endpoints_state
+    if _base_layer is None:
+        clear_endpoints()
+        clear_backends()
+    else:
+        frozen_backends, endpoints_state = _base_layer
+        overlay_backends(frozen_backends)
+        set_endpoints_state(endpoints_state)
+    xml_cache.clear()
+
+
+def set_base_layer():
+    """Freezes the current state of the backends and endpoints into a read-only
+    base layer, which is shared by all mocurly contexts started afterwards.
+
+    Instead of starting from an empty state, each context then starts with a
+    thin layer over the base layer: reads fall through to the base layer, while
+    writes and deletes stay in the layer of the context. Discarding the layer
+    costs the same regardless of the size of the base layer, so a large
+    fixture can be set up once for the whole session.
+    """
+    global _base_layer
+    from .endpoints import get_endpoints_state
+    _base_layer = (freeze_backends(), get_endpoints_state())
+
+
+def clear_base_layer():
+    """Removes the base layer set with `set_base_layer`, so that contexts start
+    from an empty state again.
+    """
+    global _base_layer
+    _base_layer = None
+
+
+def _restore_default_state():
+    """Sets the state used by threads outside of any context back to the state
+    of the most recently started context, or to a new state if there is none.
+    """
+    set_default_state(_active_instance.state if _active_instance is not None else None)
+
+
+def _get_router():
+    global _router
+    if _router is None:
         from .endpoints import endpoints
-        for endpoint in endpoints:
-            # register list views
-            list_uri = recurly.base_uri() + endpoint.base_uri
-            list_uri_re = re.compile(list_uri + r'$')
-
-            def list_callback(request, uri, headers, endpoint=endpoint):
-                xml, item_count = endpoint.list()
-                headers['X-Records'] = item_count
-                return 200, headers, xml
-            HTTPretty.register_uri(
-                HTTPretty.GET,
-                list_uri_re,
-                body=_callback(self)(list_callback),
-                content_type="application/xml")
-
-            def create_callback(request, uri, headers, endpoint=endpoint):
-                return 200, headers, endpoint.create(deserialize(request.body)[1])
-            HTTPretty.register_uri(
-                HTTPretty.POST,
-                list_uri_re,
-                body=_callback(self)(create_callback),
-                content_type="application/xml")
-
-            # register details views
-            detail_uri = recurly.base_uri() + endpoint.base_uri + r'/([^/ ]+)'
-            detail_uri_re = re.compile(detail_uri + r'$')
-
-            def retrieve_callback(request, uri, headers, endpoint=endpoint, detail_uri_re=detail_uri_re):
-                raw_pk = detail_uri_re.match(uri).group(1)
-                pk = unquote(raw_pk)
-                return 200, headers, endpoint.retrieve(pk)
-            HTTPretty.register_uri(
-                HTTPretty.GET,
-                detail_uri_re,
-                body=_callback(self)(retrieve_callback),
-                content_type="application/xml")
-
-            def update_callback(request, uri, headers, endpoint=endpoint, detail_uri_re=detail_uri_re):
-                raw_pk = detail_uri_re.match(uri).group(1)
-                pk = unquote(raw_pk)
-                return 200, headers, endpoint.update(pk, deserialize(request.body)[1])
-            HTTPretty.register_uri(
-                HTTPretty.PUT,
-                detail_uri_re,
-                body=_callback(self)(update_callback),
-                content_type="application/xml")
-
-            def delete_callback(request, uri, headers, endpoint=endpoint, detail_uri_re=detail_uri_re):
-                parsed_url = urlparse(uri)
-                url_domain_part = '{0}://{1}{2}'.format(parsed_url.scheme, parsed_url.netloc, parsed_url.path)
-                raw_pk = detail_uri_re.match(url_domain_part).group(1)
-                pk = unquote(raw_pk)
-                endpoint.delete(pk, **parse_qs(parsed_url.query))
-                return 204, headers, ''
-            HTTPretty.register_uri(
-                HTTPretty.DELETE,
-                detail_uri_re,
-                body=_callback(self)(delete_callback))
-
-            # register extra views
-            extra_views = filter(
-                lambda method: callable(method) and getattr(method, 'is_route', False),
-                (getattr(endpoint, m)
-                 for m in dir(endpoint)))
-            for method in extra_views:
-                uri = detail_uri + '/' + method.uri
-                uri_re = re.compile(uri)
-
-                def extra_route_callback(
-                        request,
-                        uri,
-                        headers,
-                        method=method,
-                        uri_re=uri_re):
-                    uri_args = uri_re.match(uri).groups()
-                    uri_args = list(uri_args)
-                    uri_args[0] = unquote(uri_args[0])
-                    if method.method == 'DELETE':
-                        status = 204
-                    else:
-                        status = 200
-                    if request.method in ['POST', 'PUT']:
-                        post_data = request.querystring.copy()
-                        if request.body:
-                            post_data.update(deserialize(request.body)[1])
-                        uri_args.append(post_data)
-                        result = method(*uri_args)
-                    elif method.is_list:
-                        result = method(*uri_args, filters=request.querystring)
-                        headers['X-Records'] = result[1]
-                        result = result[0]
-                    else:
-                        result = method(*uri_args)
-                    return status, headers, result
-                if method.method == 'DELETE':
-                    HTTPretty.register_uri(HTTPretty.DELETE, uri_re, body=_callback(self)(extra_route_callback))
-                else:
-                    HTTPretty.register_uri(method.method, uri_re, body=_callback(self)(extra_route_callback), content_type="application/xml")
+        _router = Router(endpoints)
+    return _router
+
+
+def _register():
+    """Registers a single catch-all URI to HTTPretty for each HTTP method,
+    which routes all recurly requests to the endpoints.
+    """
+    base_uri_re = re.compile(recurly.base_uri() + r'.*')
+    for method in Router.methods:
+        HTTPretty.register_uri(
+            method,
+            base_uri_re,
+            body=_callback()(_get_router().dispatch),
+            content_type="application/xml")
 
 
 class _callback(object):
     """Decorator for setting up callback functions to be used in the mocurly
     context.
 
-    This will handle the machinery behind timeout and error simulation.
+    This will handle the machinery behind timeout, latency, rate limit and
+    error simulation, record the metrics of the request, and run the callback
+    in the state of the mocurly context. By default, this is the context that
+    the request was made in, as bound by `_bind_requests`.
+
+    With `send_body` set, the callback only waits for the latency of the
+    simulated network, and leaves the time to transfer the response body to
+    the caller, which writes it to a socket with `NetworkModel.send`.
+    HTTPretty hands the body to the client all at once, so without it the
+    callback waits for the transfer up front.
     """
-    def __init__(self, mocurly_instance):
+    def __init__(self, mocurly_instance=None, send_body=False):
         self.mocurly_instance = mocurly_instance
+        self.send_body = send_body
+
+    @property
+    def active_instance(self):
+        if self.mocurly_instance is not None:
+            return self.mocurly_instance
+        if _request_binding is not None and _request_binding.instance is not None:
+            return _request_binding.instance
+        return _active_instance
 
     def __call__(self, func):
         def wrapped(request, uri, headers, **kwargs):
+            binding = _request_binding if self.mocurly_instance is None else None
+            mocurly_instance = self.active_instance
+            try:
+                with using_state(mocurly_instance.state):
+                    return measured_handle(mocurly_instance, request, uri, headers, **kwargs)
+            except Exception as exc:
+                if binding is None:
+                    raise
+                # Raising from the helper thread of HTTPretty would only drop
+                # the connection, so the requesting thread raises the error
+                binding.error = exc
+                return 500, headers, ''
+
+        def measured_handle(mocurly_instance, request, uri, headers, **kwargs):
+            with timing_request() as timer:
+                status, response_body = 500, ''
+                try:
+                    status, headers, response_body = handle(mocurly_instance, request, uri, headers, **kwargs)
+                except ssl.SSLError:
+                    status = 'timeout'
+                    if timer.route == UNMATCHED_ROUTE:
+                        # Timed out before reaching the router
+                        _set_route_of(request, uri)
+                    raise
+                finally:
+                    timings = timer.timings()
+                    response_bytes = len(response_body.encode('utf-8')) if response_body else 0
+                    mocurly_instance.metrics.record(timer.route, status, response_bytes, timings)
+                    process_metrics.record(timer.route, status, response_bytes, timings)
+                    pk = timer.route_args[0] if timer.route_args else None
+                    mocurly_instance.journal.record(request.method, request.path, timer.route, pk, timer.account,
+                                                    request.body, status, response_body)
+
+            # The simulated network is not part of the time spent handling the
+            # request
+            network = mocurly_instance.network
+            if network is not None:
+                network.wait(timer.route, len(response_body.encode('utf-8')) if response_body else 0,
+                             transfer=not self.send_body)
+            return status, headers, response_body
+
+        def handle(mocurly_instance, request, uri, headers, **kwargs):
             # If we want to timeout the request, timeout, but only if we aren't
             # going to allow the POST
-            if (self.mocurly_instance.should_timeout(request) and
-                    not self.mocurly_instance.should_timeout_successful_post(request)):
+            if (mocurly_instance.should_timeout(request) and
+                    not mocurly_instance.should_timeout_successful_post(request)):
                 raise ssl.SSLError('The read operation timed out')
 
+            rate_limiter = mocurly_instance.rate_limiter
+            if rate_limiter is not None:
+                allowed, rate_limit_headers = rate_limiter.acquire(api_key_of(request))
+                headers.update(rate_limit_headers)
+                if not allowed:
+                    _set_route_of(request, uri)
+                    return 429, headers, RATE_LIMITED_BODY
+
             try:
                 return_val = func(request, uri, headers, **kwargs)
             except ResponseError as exc:
                 # Pass through response errors in a way that httpretty will
                 # respond with the right status code and message
-                if not self.mocurly_instance.should_timeout_successful_post(request):
+                if not mocurly_instance.should_timeout_successful_post(request):
                     return exc.status_code, headers, exc.response_body
 
-            if self.mocurly_instance.should_timeout_successful_post(request):
+            if mocurly_instance.should_timeout_successful_post(request):
                 raise ssl.SSLError('The read operation timed out')
 
             return return_val
         return wrapped
+
+
+def _set_route_of(request, uri):
+    """Sets the route of a request that is answered without reaching the
+    router, so that its metrics are recorded under its route
+    """
+    resolved = _get_router().resolve(request.method, uri)
+    if resolved is not None:
+        set_route(resolved[0].name, resolved[1])
+
+
+class _RequestBinding(object):
+    """The mocurly context of the thread making a request, and the error that
+    handling the request raised, if any.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self.error = None
+
+
+def _bind_requests():
+    """Wraps the method making the requests of the recurly client, so that the
+    requests are handled in the mocurly context of the requesting thread, which
+    defaults to the most recently started context. Errors raised by handling a
+    request (e.g simulated timeouts) are raised in the requesting thread.
+    """
+    global _original_http_request
+    if _original_http_request is not None:
+        return
+    _original_http_request = recurly.Resource.__dict__['http_request']
+    http_request = _original_http_request.__func__
+
+    def bound_http_request(cls, *args, **kwargs):
+        global _request_binding
+        instance = getattr(_local, 'instance', None)
+        if instance is None:
+            instance = _active_instance
+        with _request_lock:
+            previous_binding = _request_binding
+            binding = _request_binding = _RequestBinding(instance)
+            try:
+                response = http_request(cls, *args, **kwargs)
+            finally:
+                _request_binding = previous_binding
+            if binding.error is not None:
+                raise binding.error
+            return response
+    recurly.Resource.http_request = classmethod(bound_http_request)
+
+
+def _unbind_requests():
+    """Reverts `_bind_requests`
+    """
+    global _original_http_request
+    if _original_http_request is None:
+        return
+    recurly.Resource.http_request = _original_http_request
+    _original_http_request = None
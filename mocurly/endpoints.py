@@ -2,22 +2,67 @@
 
 Each endpoint class will define the CRUD interface into the resource.
 """
-from datetime import datetime
+from datetime import timedelta
 
 import recurly
 import six
 import random
 import string
+import functools
 import dateutil.relativedelta
-import dateutil.parser
 from dateutil.tz import tzutc
 
-from .utils import current_time
+from .utils import current_time, parse_time
 from .errors import TRANSACTION_ERRORS, ResponseError
-from .utils import details_route, serialize, serialize_list
+from .utils import details_route, serialize, serialize_list, join_serialized_list
+from .cache import xml_cache
+from .metrics import set_request_account
+from .backend import StateProxy, current_state, identity_map, _match_all
 from .backend import accounts_backend, billing_info_backend, transactions_backend, invoices_backend, subscriptions_backend, plans_backend, plan_add_ons_backend, adjustments_backend, coupons_backend, coupon_redemptions_backend
 
 
+# Changes to the resources of an account (e.g creating a subscription, along
+# with its transaction, invoice and adjustments) happen within the section of
+# the account, so that concurrent requests never see or build on half done
+# changes. Requests for different accounts proceed in parallel. The locks of
+# the sections are part of the current state.
+account_locks = StateProxy('account_locks')
+
+
+def account_section(get_account_code):
+    """Decorator for endpoint methods that runs the method within the section
+    of an account. `get_account_code` is called with the arguments of the
+    method, and returns the code of the account.
+    """
+    def account_section_decorator(method):
+        @functools.wraps(method)
+        def account_section_method(*args, **kwargs):
+            account_code = get_account_code(*args, **kwargs)
+            set_request_account(account_code)
+            with account_locks.get(account_code):
+                return method(*args, **kwargs)
+        return account_section_method
+    return account_section_decorator
+
+
+def _pk(self, pk, *args, **kwargs):
+    return pk
+
+
+def _filter_pred(filters):
+    """Returns a filter function matching the records whose fields have one of
+    the values given for them in `filters`, the query parameters of a nested
+    list request other than the paging and query ones (e.g
+    `{'currency': ['USD']}`).
+    """
+    if not filters:
+        return _match_all
+
+    def filter_pred(record):
+        return all(record.get(field) in values for field, values in filters.items())
+    return filter_pred
+
+
 class BaseRecurlyEndpoint(object):
     """Baseclass for simulating resource endpoints.
 
@@ -25,9 +70,26 @@ class BaseRecurlyEndpoint(object):
     store backend.
     """
     pk_attr = 'uuid'
+    # Field of the resource holding the code of the account it belongs to, if
+    # any
+    account_attr = None
+    # States that can be requested through the `state` filter of the lists,
+    # mapped to the stored states they stand for, if they are not stored as is
+    state_aliases = {}
     XML = 0
     RAW = 1
 
+    def resolve_query(self, query):
+        """Resolves the aliases of the states requested by the `Query`, if
+        any, into the stored states
+        """
+        if query is not None and query.states is not None:
+            states = []
+            for state in query.states:
+                states.extend(self.state_aliases.get(state, [state]))
+            query.states = states
+        return query
+
     def hydrate_foreign_keys(self, obj):
         """Hydrates all foreign key objects from Id strings into actual objects
         """
@@ -47,18 +109,26 @@ class BaseRecurlyEndpoint(object):
         uri_out['object_uri'] = self.get_object_uri(obj)
         return uri_out
 
-    def serialize(self, obj, format=XML):
+    def serialize(self, obj, format=XML, cache=False):
         """Serialize the object into the provided format, using the resource
         template.
 
         Currently only supports XML (for XML representation of the resource.
         This is what recurly expects) and RAW (a dictionary representation of
         the resource)
+
+        Objects that were read from the backend as is can be serialized with
+        `cache` set, in which case their XML is served from the XML cache when
+        it is enabled.
         """
         if format == BaseRecurlyEndpoint.RAW:
             return obj
 
         cls = self.__class__
+        if cache and xml_cache.enabled:
+            if type(obj) == list:
+                return join_serialized_list(cls.object_type_plural, [self._serialize_cached(o) for o in obj])
+            return self._serialize_cached(obj)
         if type(obj) == list:
             for o in obj:
                 o['uris'] = self.uris(o)
@@ -67,12 +137,22 @@ class BaseRecurlyEndpoint(object):
             obj['uris'] = self.uris(obj)
             return serialize(cls.template, cls.object_type, obj)
 
-    def list(self, format=XML):
-        """Endpoint to list all resources stored in the backend
+    def _serialize_cached(self, obj):
+        cls = self.__class__
+        pk = obj[cls.pk_attr]
+
+        def generate_xml(obj):
+            obj['uris'] = self.uris(obj)
+            return serialize(cls.template, cls.object_type, obj)
+        return xml_cache.generate((cls.template, pk), cls.backend, pk, generate_xml, obj)
+
+    def list(self, format=XML, page=None, query=None):
+        """Endpoint to list all resources stored in the backend, limited to the
+        given `Page` and filtered and ordered by the given `Query` if any
         """
         cls = self.__class__
-        out = cls.backend.list_objects()
-        return self.serialize(out, format=format)
+        out = cls.backend.list_objects(page=page, query=self.resolve_query(query))
+        return self.serialize(out, format=format, cache=True)
 
     def create(self, create_info, format=XML):
         """Endpoint to create a new instance of the resource into the backend
@@ -93,8 +173,14 @@ class BaseRecurlyEndpoint(object):
         cls = self.__class__
         if not cls.backend.has_object(pk):
             raise ResponseError(404, '')
-        out = cls.backend.get_object(pk)
-        return self.serialize(out, format=format)
+        if cls.account_attr is None:
+            out = cls.backend.get_object(pk)
+            return self.serialize(out, format=format, cache=True)
+        account_code = cls.backend.get_object(pk)[cls.account_attr]
+        set_request_account(account_code)
+        with account_locks.get(account_code):
+            out = cls.backend.get_object(pk)
+            return self.serialize(out, format=format, cache=True)
 
     def update(self, pk, update_info, format=XML):
         """Endpoint to update an existing resource from the backend
@@ -119,7 +205,8 @@ class BaseRecurlyEndpoint(object):
         return ''
 
     def generate_id(self):
-        """Generates a random ID that can be used as a UUID or recurly ID
+        """Generates a random ID that can be used as a UUID or recurly ID,
+        which are 32 hexadecimal digits like the UUIDs of recurly
         """
         return ''.join(random.choice(string.ascii_lowercase + string.digits) for i in range(32))
 
@@ -131,6 +218,7 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
     object_type = 'account'
     object_type_plural = 'accounts'
     template = 'account.xml'
+    account_attr = 'account_code'
 
     def uris(self, obj):
         uri_out = super(AccountsEndpoint, self).uris(obj)
@@ -143,6 +231,7 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
         uri_out['transactions_uri'] = uri_out['object_uri'] + '/transactions'
         return uri_out
 
+    @account_section(lambda self, create_info, *args, **kwargs: create_info[AccountsEndpoint.pk_attr])
     def create(self, create_info, format=BaseRecurlyEndpoint.XML):
         if 'billing_info' in create_info:
             billing_info = create_info['billing_info']
@@ -151,8 +240,10 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
             del create_info['billing_info']
         create_info['hosted_login_token'] = self.generate_id()
         create_info['created_at'] = current_time().isoformat()
+        create_info.setdefault('state', 'active')
         return super(AccountsEndpoint, self).create(create_info, format=format)
 
+    @account_section(_pk)
     def update(self, pk, update_info, format=BaseRecurlyEndpoint.XML):
         if 'billing_info' in update_info:
             updated_billing_info = update_info['billing_info']
@@ -164,6 +255,7 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
             del update_info['billing_info']
         return super(AccountsEndpoint, self).update(pk, update_info, format=format)
 
+    @account_section(_pk)
     def delete(self, pk):
         AccountsEndpoint.backend.update_object(pk, {'state': 'closed'})
         billing_info_backend.delete_object(pk)
@@ -192,6 +284,7 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
         return self.serialize_billing_info(out, format=format)
 
     @details_route('PUT', 'billing_info')
+    @account_section(_pk)
     def update_billing_info(self, pk, update_info, format=BaseRecurlyEndpoint.XML):
         if billing_info_backend.has_object(pk):
             out = billing_info_backend.update_object(pk, update_info)
@@ -201,44 +294,45 @@ class AccountsEndpoint(BaseRecurlyEndpoint):
         return self.serialize_billing_info(out, format=format)
 
     @details_route('DELETE', 'billing_info')
+    @account_section(_pk)
     def delete_billing_info(self, pk):
         billing_info_backend.delete_object(pk)
         return ''
 
     @details_route('GET', 'transactions', is_list=True)
-    def get_transactions_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML):
-        out = TransactionsEndpoint.backend.list_objects(lambda transaction: transaction['account'] == pk)
-        return transactions_endpoint.serialize(out, format=format)
+    @account_section(_pk)
+    def get_transactions_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        out = TransactionsEndpoint.backend.list_objects_by('account', pk, _filter_pred(filters), page=page,
+                                                           query=transactions_endpoint.resolve_query(query))
+        return transactions_endpoint.serialize(out, format=format, cache=True)
 
     @details_route('GET', 'invoices', is_list=True)
-    def get_invoices_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML):
-        out = InvoicesEndpoint.backend.list_objects(lambda invoice: invoice['account'] == pk)
-        return invoices_endpoint.serialize(out, format=format)
+    @account_section(_pk)
+    def get_invoices_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        out = InvoicesEndpoint.backend.list_objects_by('account', pk, _filter_pred(filters), page=page,
+                                                       query=invoices_endpoint.resolve_query(query))
+        return invoices_endpoint.serialize(out, format=format, cache=True)
 
     @details_route('GET', 'subscriptions', is_list=True)
-    def get_subscriptions_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML):
-        def filter_subscriptions(subscription):
-            if filters:
-                if 'state' in filters and filters['state'][0] == 'live':
-                    filters['state'] = ['active', 'canceled', 'future', 'in_trial']
-                cond = all(subscription[k] in v for k, v in filters.items())
-            else:
-                cond = True
-            return subscription['account'] == pk and cond
-        out = SubscriptionsEndpoint.backend.list_objects(filter_subscriptions)
-        return subscriptions_endpoint.serialize(out, format=format)
-
-    @details_route('GET', 'redemptions$', is_list=True)
-    def get_coupon_redemptions(self, account_code, filters=None, format=BaseRecurlyEndpoint.XML):
-        account_coupon_redemptions = coupon_redemptions_backend.list_objects(lambda redemption: redemption['account_code'] == account_code)
+    @account_section(_pk)
+    def get_subscriptions_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        out = SubscriptionsEndpoint.backend.list_objects_by('account', pk, _filter_pred(filters), page=page,
+                                                            query=subscriptions_endpoint.resolve_query(query))
+        return subscriptions_endpoint.serialize(out, format=format, cache=True)
+
+    @details_route('GET', 'redemptions', is_list=True)
+    @account_section(_pk)
+    def get_coupon_redemptions(self, account_code, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        account_coupon_redemptions = coupon_redemptions_backend.list_objects_by(
+            'account_code', account_code, _filter_pred(filters), page=page, query=query)
         return coupons_endpoint.serialize_coupon_redemption(account_coupon_redemptions, format=format)
 
     @details_route('DELETE', 'redemptions/([^/ ]+)')
+    @account_section(_pk)
     def delete_coupon_redemption(self, account_code, redemption_uuid, format=BaseRecurlyEndpoint.XML):
-        account_coupon_redemptions = coupon_redemptions_backend.list_objects(
-            lambda redemption: \
-                (redemption['account_code'] == account_code and
-                 coupons_endpoint.generate_coupon_redemption_uuid(redemption['coupon'], redemption['account_code']) == redemption_uuid))
+        account_coupon_redemptions = coupon_redemptions_backend.list_objects_by(
+            'account_code', account_code,
+            lambda redemption: coupons_endpoint.generate_coupon_redemption_uuid(redemption['coupon'], redemption['account_code']) == redemption_uuid)
         if not account_coupon_redemptions:
             raise ResponseError(404, '')
 
@@ -252,16 +346,37 @@ class TransactionsEndpoint(BaseRecurlyEndpoint):
     object_type = 'transaction'
     object_type_plural = 'transactions'
     template = 'transaction.xml'
+    account_attr = 'account'
+    # The states of the transaction lists are stored in the `status` field
+    state_aliases = {'successful': ['success'],
+                     'failed': ['declined'],
+                     'voided': ['void']}
+
+    @property
+    def registered_errors(self):
+        """The transaction failures registered in the current state, keyed by
+        the account code
+        """
+        return current_state().registered_errors
 
-    def __init__(self):
-        self.registered_errors = {}
-        return super(TransactionsEndpoint, self).__init__()
+    @registered_errors.setter
+    def registered_errors(self, registered_errors):
+        current_state().registered_errors = registered_errors
 
     def clear_state(self):
         """Clears all registered errors
         """
         self.registered_errors = {}
 
+    def get_state(self):
+        """Returns the registered errors, in a form that can be restored with
+        `set_state`
+        """
+        return {'registered_errors': dict(self.registered_errors)}
+
+    def set_state(self, state):
+        self.registered_errors = dict(state['registered_errors'])
+
     def register_transaction_failure(self, account_code, error_code):
         """Registers an error_code to associate with the given account for all
         transactions made by the account
@@ -271,14 +386,17 @@ class TransactionsEndpoint(BaseRecurlyEndpoint):
     def hydrate_foreign_keys(self, obj):
         if isinstance(obj['account'], six.string_types):
             # hydrate account
-            obj['account'] = AccountsEndpoint.backend.get_object(obj['account'])
+            obj['account'] = AccountsEndpoint.backend.lookup_object(obj['account'])
         if 'invoice' in obj and isinstance(obj['invoice'], six.string_types):
             # hydrate invoice
-            obj['invoice'] = InvoicesEndpoint.backend.get_object(obj['invoice'])
+            obj['invoice'] = InvoicesEndpoint.backend.lookup_object(obj['invoice'])
         return obj
 
     def uris(self, obj):
         uri_out = super(TransactionsEndpoint, self).uris(obj)
+        # The account may be shared with other transactions in the same
+        # response, but its uris are built again for each of them, so that
+        # the XML cache entry of each transaction records the reads they need
         obj['account']['uris'] = accounts_endpoint.uris(obj['account'])
         uri_out['account_uri'] = obj['account']['uris']['object_uri']
         if 'invoice' in obj:
@@ -292,6 +410,7 @@ class TransactionsEndpoint(BaseRecurlyEndpoint):
             uri_out['original_transaction_uri'] = transactions_endpoint.get_object_uri(obj['original_transaction'])
         return uri_out
 
+    @account_section(lambda self, create_info, *args, **kwargs: create_info['account'][AccountsEndpoint.pk_attr])
     def create(self, create_info, format=BaseRecurlyEndpoint.XML):
         # Like recurly, creates an invoice that is associated with the
         # transaction
@@ -356,8 +475,8 @@ class TransactionsEndpoint(BaseRecurlyEndpoint):
 
         if 'subscription' in create_info:
             subscription = subscriptions_backend.get_object(create_info['subscription'])
-            transaction_charge_line_item['start_date'] = dateutil.parser.parse(subscription['current_period_started_at'])
-            transaction_charge_line_item['end_date'] = dateutil.parser.parse(subscription['current_period_ends_at'])
+            transaction_charge_line_item['start_date'] = parse_time(subscription['current_period_started_at'])
+            transaction_charge_line_item['end_date'] = parse_time(subscription['current_period_ends_at'])
 
         transaction_charge_line_item = adjustments_endpoint.create(transaction_charge_line_item, format=BaseRecurlyEndpoint.RAW)
         InvoicesEndpoint.backend.update_object(new_invoice_id, {'line_items': [transaction_charge_line_item]})
@@ -377,6 +496,7 @@ class AdjustmentsEndpoint(BaseRecurlyEndpoint):
     object_type = 'adjustment'
     object_type_plural = 'adjustments'
     template = 'adjustment.xml'
+    account_attr = 'account_code'
     defaults = {'state': 'active',
                 'quantity': 1,
                 'origin': 'credit',
@@ -395,6 +515,7 @@ class AdjustmentsEndpoint(BaseRecurlyEndpoint):
         uri_out['invoice_uri'] = invoices_endpoint.get_object_uri(pseudo_invoice_object)
         return uri_out
 
+    @account_section(lambda self, create_info, *args, **kwargs: create_info['account_code'])
     def create(self, create_info, format=BaseRecurlyEndpoint.XML):
         create_info['created_at'] = current_time().isoformat()
         if int(create_info['unit_amount_in_cents']) >= 0:
@@ -420,18 +541,19 @@ class InvoicesEndpoint(BaseRecurlyEndpoint):
     object_type_plural = 'invoices'
     pk_attr = 'invoice_number'
     template = 'invoice.xml'
+    account_attr = 'account'
 
     def hydrate_foreign_keys(self, obj):
         if isinstance(obj['account'], six.string_types):
             # hydrate account
-            obj['account'] = AccountsEndpoint.backend.get_object(obj['account'])
+            obj['account'] = AccountsEndpoint.backend.lookup_object(obj['account'])
         if 'transactions' in obj:
-            obj['transactions'] = [TransactionsEndpoint.backend.get_object(transaction_id) if isinstance(transaction_id, six.string_types) else transaction_id for transaction_id in obj['transactions']]
+            obj['transactions'] = [TransactionsEndpoint.backend.lookup_object(transaction_id) if isinstance(transaction_id, six.string_types) else transaction_id for transaction_id in obj['transactions']]
             for transaction in obj['transactions']:
                 transaction['invoice'] = obj
                 transaction['uris'] = transactions_endpoint.uris(transaction)
         if 'line_items' in obj:
-            obj['line_items'] = [AdjustmentsEndpoint.backend.get_object(adjustment_id) if isinstance(adjustment_id, six.string_types) else adjustment_id for adjustment_id in obj['line_items']]
+            obj['line_items'] = [AdjustmentsEndpoint.backend.lookup_object(adjustment_id) if isinstance(adjustment_id, six.string_types) else adjustment_id for adjustment_id in obj['line_items']]
             for adjustment in obj['line_items']:
                 adjustment['uris'] = adjustments_endpoint.uris(adjustment)
         return obj
@@ -448,6 +570,7 @@ class InvoicesEndpoint(BaseRecurlyEndpoint):
         return uri_out
 
     @details_route('POST', 'refund')
+    @account_section(lambda self, pk, *args, **kwargs: invoices_backend.get_object(pk)['account'])
     def refund_invoice(self, pk, refund_info, format=BaseRecurlyEndpoint.XML):
         """Refunds the invoice.
 
@@ -612,9 +735,7 @@ class InvoicesEndpoint(BaseRecurlyEndpoint):
 
     @staticmethod
     def generate_invoice_number():
-        if InvoicesEndpoint.backend.empty():
-            return '1000'
-        return str(max(int(invoice['invoice_number']) for invoice in InvoicesEndpoint.backend.list_objects()) + 1)
+        return InvoicesEndpoint.backend.allocate_invoice_number()
 
 
 class CouponsEndpoint(BaseRecurlyEndpoint):
@@ -644,7 +765,7 @@ class CouponsEndpoint(BaseRecurlyEndpoint):
 
     def hydrate_coupon_redemption_foreign_keys(self, obj):
         if isinstance(obj['coupon'], six.string_types):
-            obj['coupon'] = CouponsEndpoint.backend.get_object(obj['coupon'])
+            obj['coupon'] = CouponsEndpoint.backend.lookup_object(obj['coupon'])
         return obj
 
     def coupon_redemption_uris(self, obj):
@@ -674,11 +795,12 @@ class CouponsEndpoint(BaseRecurlyEndpoint):
             return serialize('redemption.xml', 'redemption', obj)
 
     @details_route('GET', 'redemptions', is_list=True)
-    def get_coupon_redemptions(self, pk, filters=None, format=BaseRecurlyEndpoint.XML):
-        obj_list = coupon_redemptions_backend.list_objects(lambda redemption: redemption['coupon'] == pk)
+    def get_coupon_redemptions(self, pk, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        obj_list = coupon_redemptions_backend.list_objects_by('coupon', pk, _filter_pred(filters), page=page, query=query)
         return self.serialize_coupon_redemption(obj_list, format=format)
 
     @details_route('POST', 'redeem')
+    @account_section(lambda self, pk, redeem_info, *args, **kwargs: redeem_info['account_code'])
     def redeem_coupon(self, pk, redeem_info, format=BaseRecurlyEndpoint.XML):
         assert CouponsEndpoint.backend.has_object(pk), pk
         redeem_info['coupon'] = pk
@@ -747,8 +869,8 @@ class PlansEndpoint(BaseRecurlyEndpoint):
             return serialize('add_on.xml', 'add_on', obj)
 
     @details_route('GET', 'add_ons', is_list=True)
-    def get_add_on_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML):
-        out = plan_add_ons_backend.list_objects(lambda add_on: add_on['plan'] == pk)
+    def get_add_on_list(self, pk, filters=None, format=BaseRecurlyEndpoint.XML, page=None, query=None):
+        out = plan_add_ons_backend.list_objects_by('plan', pk, _filter_pred(filters), page=page, query=query)
         return self.serialize_plan_add_on(out, format=format)
 
     @details_route('POST', 'add_ons')
@@ -761,13 +883,19 @@ class PlansEndpoint(BaseRecurlyEndpoint):
         return self.serialize_plan_add_on(plan_add_ons_backend.add_object(self.generate_plan_add_on_uuid(pk, create_info['add_on_code']), create_info), format=format)
 
 
+def _subscription_account(self, pk, *args, **kwargs):
+    return subscriptions_backend.get_object(pk)['account']
+
+
 class SubscriptionsEndpoint(BaseRecurlyEndpoint):
     base_uri = 'subscriptions'
     backend = subscriptions_backend
     object_type = 'subscription'
     object_type_plural = 'subscriptions'
     template = 'subscription.xml'
+    account_attr = 'account'
     defaults = {'quantity': 1, 'collection_method': 'automatic'}
+    state_aliases = {'live': ['active', 'canceled', 'future', 'in_trial']}
 
     def _calculate_timedelta(self, units, length):
         timedelta_info = {}
@@ -775,18 +903,18 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         return dateutil.relativedelta.relativedelta(**timedelta_info)
 
     def _parse_isoformat(self, isoformat):
-        return dateutil.parser.parse(isoformat)
+        return parse_time(isoformat)
 
     def hydrate_foreign_keys(self, obj):
         if 'plan' not in obj:
-            obj['plan'] = PlansEndpoint.backend.get_object(obj['plan_code'])
+            obj['plan'] = PlansEndpoint.backend.lookup_object(obj['plan_code'])
         if 'subscription_add_ons' in obj:
             def hydrate_add_ons(add_on):
                 if isinstance(add_on, six.string_types):
                     add_on = plan_add_ons_backend.get_object(plans_endpoint.generate_plan_add_on_uuid(obj['plan_code'], add_on))
                     add_on['unit_amount_in_cents'] = add_on['unit_amount_in_cents'][obj['currency']]
                 return add_on
-            obj['subscription_add_ons'] = map(hydrate_add_ons, obj['subscription_add_ons'])
+            obj['subscription_add_ons'] = [hydrate_add_ons(add_on) for add_on in obj['subscription_add_ons']]
         return obj
 
     def uris(self, obj):
@@ -804,6 +932,7 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         uri_out['terminate_uri'] = uri_out['object_uri'] + '/terminate'
         return uri_out
 
+    @account_section(lambda self, create_info, *args, **kwargs: create_info['account'][AccountsEndpoint.pk_attr])
     def create(self, create_info, format=BaseRecurlyEndpoint.XML):
         # Like recurly, this will create a new invoice and transaction that
         # goes with the new subscription enrollment
@@ -822,7 +951,7 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         # Trial dates need to be calculated
         if 'trial_ends_at' in create_info:
             create_info['trial_started_at'] = now.isoformat()
-        elif plan['trial_interval_length'] > 0:
+        elif int(plan['trial_interval_length']) > 0:
             create_info['trial_started_at'] = now.isoformat()
             create_info['trial_ends_at'] = (now + self._calculate_timedelta(plan['trial_interval_unit'], plan['trial_interval_length'])).isoformat()
 
@@ -845,7 +974,9 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
             # Plan already started
             if 'first_renewal_date' in create_info:
                 create_info['current_period_ends_at'] = self._parse_isoformat(create_info['first_renewal_date'])
-            else:
+            elif 'current_period_ends_at' not in create_info or \
+                    self._parse_isoformat(create_info['current_period_ends_at']) < now:
+                # Not in a trial, or the trial already ended
                 create_info['current_period_ends_at'] = (started_at + self._calculate_timedelta(plan['plan_interval_unit'], plan['plan_interval_length'])).isoformat()
 
         # Tax calculated based on plan info
@@ -882,7 +1013,7 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         if defaults['state'] == 'active':
             # if trial_ends_at is set but is not in the future, the trial has ended
             if 'trial_started_at' in defaults and \
-                ('trial_ends_at' not in defaults or self._parse_isoformat(defaults['trial_ends_at']) >= datetime.now(tzutc())):
+                ('trial_ends_at' not in defaults or self._parse_isoformat(defaults['trial_ends_at']) >= current_time()):
                 # create a transaction and invoice for the trial
                 new_transaction = {}
                 new_transaction['account'] = {}
@@ -897,67 +1028,75 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
 
                 new_sub = SubscriptionsEndpoint.backend.update_object(defaults['uuid'], {'invoice': new_invoice_id})
             else:
-                # Setup charges first, to calculate total charge to put on the
-                # invoice and transaction
-                total = 0
-                adjustment_infos = []
+                new_sub = self._invoice_period(new_sub)
+        return self.serialize(new_sub, format=format)
+
+    def _invoice_period(self, subscription):
+        """Charges the current period of the (hydrated) subscription, creating
+        its transaction, invoice and adjustments, and returns the subscription
+        pointing at the new invoice
+        """
+        # Setup charges first, to calculate total charge to put on the
+        # invoice and transaction
+        total = 0
+        adjustment_infos = []
+        plan_charge_line_item = {
+            'account_code': subscription['account'],
+            'currency': subscription['currency'],
+            'unit_amount_in_cents': int(subscription['unit_amount_in_cents']),
+            'description': subscription['plan']['name'],
+            'quantity': subscription['quantity'],
+            'start_date': self._parse_isoformat(subscription['current_period_started_at']),
+            'end_date': self._parse_isoformat(subscription['current_period_ends_at'])
+        }
+        total += plan_charge_line_item['unit_amount_in_cents']
+        adjustment_infos.append(plan_charge_line_item)
+
+        if 'subscription_add_ons' in subscription:
+            for add_on in subscription['subscription_add_ons']:
                 plan_charge_line_item = {
-                    'account_code': new_sub['account'],
-                    'currency': new_sub['currency'],
-                    'unit_amount_in_cents': int(new_sub['unit_amount_in_cents']),
-                    'description': new_sub['plan']['name'],
-                    'quantity': new_sub['quantity'],
-                    'start_date': self._parse_isoformat(new_sub['current_period_started_at']),
-                    'end_date': self._parse_isoformat(new_sub['current_period_ends_at'])
+                    'account_code': subscription['account'],
+                    'currency': subscription['currency'],
+                    'unit_amount_in_cents': int(add_on['unit_amount_in_cents']),
+                    'description': add_on['name'],
+                    'quantity': subscription['quantity'],
                 }
                 total += plan_charge_line_item['unit_amount_in_cents']
                 adjustment_infos.append(plan_charge_line_item)
 
-                if 'subscription_add_ons' in new_sub:
-                    for add_on in new_sub['subscription_add_ons']:
-                        plan_charge_line_item = {
-                            'account_code': new_sub['account'],
-                            'currency': new_sub['currency'],
-                            'unit_amount_in_cents': int(add_on['unit_amount_in_cents']),
-                            'description': add_on['name'],
-                            'quantity': new_sub['quantity'],
-                        }
-                        total += plan_charge_line_item['unit_amount_in_cents']
-                        adjustment_infos.append(plan_charge_line_item)
-
-                # now calculate discounts
-                coupon_redemptions = accounts_endpoint.get_coupon_redemptions(
-                    new_sub['account'], format=BaseRecurlyEndpoint.RAW)
-                if coupon_redemptions:
-                    total -= self._apply_coupons(coupon_redemptions, adjustment_infos)
-
-                # create a transaction if the subscription is started
-                new_transaction = {}
-                new_transaction['account'] = {}
-                new_transaction['account'][AccountsEndpoint.pk_attr] = new_sub['account']
-                new_transaction['amount_in_cents'] = total
-                new_transaction['currency'] = new_sub['currency']
-                new_transaction['subscription'] = new_sub[SubscriptionsEndpoint.pk_attr]
-                new_transaction = transactions_endpoint.create(new_transaction, format=BaseRecurlyEndpoint.RAW)
-                new_invoice_id = new_transaction['invoice']
-
-                # Now create accumulated new adjustments for the sub to track line items
-                adjustments = []
-                for plan_charge_line_item in adjustment_infos:
-                    plan_charge_line_item['invoice'] = new_invoice_id
-                    plan_charge_line_item = adjustments_endpoint.create(plan_charge_line_item, format=BaseRecurlyEndpoint.RAW)
-                    adjustments.append(plan_charge_line_item[AdjustmentsEndpoint.pk_attr])
-
-                InvoicesEndpoint.backend.update_object(new_invoice_id, {'subscription': new_sub[SubscriptionsEndpoint.pk_attr], 'line_items': adjustments})
-
-                new_sub = SubscriptionsEndpoint.backend.update_object(defaults['uuid'], {'invoice': new_invoice_id})
-        return self.serialize(new_sub, format=format)
+        # now calculate discounts
+        coupon_redemptions = accounts_endpoint.get_coupon_redemptions(
+            subscription['account'], format=BaseRecurlyEndpoint.RAW)
+        if coupon_redemptions:
+            total -= self._apply_coupons(coupon_redemptions, adjustment_infos)
+
+        # create a transaction if the subscription is started
+        new_transaction = {}
+        new_transaction['account'] = {}
+        new_transaction['account'][AccountsEndpoint.pk_attr] = subscription['account']
+        new_transaction['amount_in_cents'] = total
+        new_transaction['currency'] = subscription['currency']
+        new_transaction['subscription'] = subscription[SubscriptionsEndpoint.pk_attr]
+        new_transaction = transactions_endpoint.create(new_transaction, format=BaseRecurlyEndpoint.RAW)
+        new_invoice_id = new_transaction['invoice']
+
+        # Now create accumulated new adjustments for the sub to track line items
+        adjustments = []
+        for plan_charge_line_item in adjustment_infos:
+            plan_charge_line_item['invoice'] = new_invoice_id
+            plan_charge_line_item = adjustments_endpoint.create(plan_charge_line_item, format=BaseRecurlyEndpoint.RAW)
+            adjustments.append(plan_charge_line_item[AdjustmentsEndpoint.pk_attr])
+
+        InvoicesEndpoint.backend.update_object(new_invoice_id, {'subscription': subscription[SubscriptionsEndpoint.pk_attr], 'line_items': adjustments})
+
+        return SubscriptionsEndpoint.backend.update_object(subscription[SubscriptionsEndpoint.pk_attr], {'invoice': new_invoice_id})
 
     @details_route('PUT', 'terminate')
+    @account_section(_subscription_account)
     def terminate_subscription(self, pk, terminate_info, format=format):
         subscription = SubscriptionsEndpoint.backend.get_object(pk)
         # assume base transaction exists
-        transaction = TransactionsEndpoint.backend.list_objects(lambda trans: trans.get('subscription', None) == subscription[SubscriptionsEndpoint.pk_attr])[0]
+        transaction = TransactionsEndpoint.backend.list_objects_by('subscription', subscription[SubscriptionsEndpoint.pk_attr])[0]
         invoice_number = transaction['invoice']
         invoice = InvoicesEndpoint.backend.get_object(invoice_number)
         start = self._parse_isoformat(subscription['current_period_started_at'])
@@ -987,6 +1126,7 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         }), format=format)
 
     @details_route('PUT', 'cancel')
+    @account_section(_subscription_account)
     def cancel_subscription(self, pk, cancel_info, format=format):
         subscription = SubscriptionsEndpoint.backend.get_object(pk)
         return self.serialize(SubscriptionsEndpoint.backend.update_object(pk, {
@@ -996,6 +1136,7 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
         }), format=format)
 
     @details_route('PUT', 'reactivate')
+    @account_section(_subscription_account)
     def reactivate_subscription(self, pk, reactivate_info, format=format):
         subscription = SubscriptionsEndpoint.backend.get_object(pk)
         if not subscription['state'] == 'canceled':
@@ -1006,6 +1147,102 @@ class SubscriptionsEndpoint(BaseRecurlyEndpoint):
             'canceled_at': None
         }), format=format)
 
+    @property
+    def clock_offset(self):
+        """How far the virtual clock of the current state runs ahead of the
+        wall clock
+        """
+        return current_state().clock_offset
+
+    @clock_offset.setter
+    def clock_offset(self, clock_offset):
+        current_state().clock_offset = clock_offset
+
+    def clear_state(self):
+        """Sets the virtual clock back to the wall clock
+        """
+        self.clock_offset = timedelta(0)
+
+    def get_state(self):
+        """Returns the offset of the virtual clock, in a form that can be
+        restored with `set_state`
+        """
+        return {'clock_offset': self.clock_offset}
+
+    def set_state(self, state):
+        self.clock_offset = state['clock_offset']
+
+    def advance(self, delta):
+        """Moves the virtual clock forward by the given `timedelta` or
+        `relativedelta`, processing the events of the subscriptions that fall
+        due on the way, in order and each at its own time:
+            - active subscriptions are renewed at the end of their current
+              period (which is the end of the trial for subscriptions in
+              trial), charging the new period like a new subscription
+            - canceled subscriptions expire
+            - future subscriptions are activated, charging their first period
+
+        Renewals of accounts with a registered transaction failure expire the
+        subscription instead, as recurly does once it gives up on collecting.
+        Only the subscriptions with due events are visited, since their events
+        are scheduled by the subscriptions backend.
+        """
+        state = current_state()
+        start = current_time()
+        until = start + delta
+        if until < start:
+            raise ValueError('The clock can only be moved forward')
+        try:
+            with identity_map():
+                while True:
+                    pk = SubscriptionsEndpoint.backend.next_event(until)
+                    if pk is None:
+                        break
+                    self._process_event(pk, start)
+        finally:
+            state.frozen_time = None
+            state.clock_offset += until - current_time()
+
+    @account_section(_subscription_account)
+    def _process_event(self, pk, start):
+        """Processes the due event of the subscription, with the virtual clock
+        stopped at the time of the event (or at the given start time, for
+        events that were overdue)
+        """
+        subscription = SubscriptionsEndpoint.backend.get_object(pk)
+        state = subscription['state']
+        event_time = max(self._to_datetime(subscription[SubscriptionsEndpoint.backend.event_fields[state]]), start)
+        current_state().frozen_time = event_time
+        if state == 'canceled':
+            SubscriptionsEndpoint.backend.update_object(pk, {'state': 'expired'})
+            return
+
+        if subscription['account'] in transactions_endpoint.registered_errors:
+            SubscriptionsEndpoint.backend.update_object(pk, {
+                'state': 'expired',
+                'expires_at': event_time.isoformat(),
+                'current_period_ends_at': event_time.isoformat()
+            })
+            return
+
+        plan = plans_backend.get_object(subscription['plan_code'])
+        started_at = event_time
+        if state == 'active':
+            started_at = self._to_datetime(subscription['current_period_ends_at'])
+        ends_at = started_at + self._calculate_timedelta(plan['plan_interval_unit'], plan['plan_interval_length'])
+        subscription = SubscriptionsEndpoint.backend.update_object(pk, {
+            'state': 'active',
+            'current_period_started_at': started_at.isoformat(),
+            'current_period_ends_at': ends_at.isoformat()
+        })
+        self._invoice_period(self.hydrate_foreign_keys(subscription))
+
+    def _to_datetime(self, value):
+        value = self._parse_isoformat(value)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=tzutc())
+        return value
+
     def _apply_coupons(self, coupon_redemptions, adjustment_infos):
         total_discounts = 0
         for redemption in coupon_redemptions:
@@ -1041,3 +1278,18 @@ def clear_endpoints():
     carries over between mocurly contexts.
     """
     transactions_endpoint.clear_state()
+    subscriptions_endpoint.clear_state()
+
+
+def get_endpoints_state():
+    """Returns the state of all endpoints, in a form that can be restored with
+    `set_endpoints_state`
+    """
+    return {'transactions': transactions_endpoint.get_state(),
+            'subscriptions': subscriptions_endpoint.get_state()}
+
+
+def set_endpoints_state(state):
+    transactions_endpoint.set_state(state['transactions'])
+    if 'subscriptions' in state:
+        subscriptions_endpoint.set_state(state['subscriptions'])
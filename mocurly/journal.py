@@ -0,0 +1,138 @@
+"""Journal of the requests handled by the mocked endpoints
+
+The journal keeps the most recent requests along with their responses, so that
+tests can assert on the recurly calls that their code made. It is bounded: once
+full, recording a request evicts the oldest one. The entries are indexed by
+method, route, primary key and account, so that queries only visit the
+entries matching one of their filters.
+"""
+import itertools
+import threading
+from collections import deque
+
+from .utils import current_time
+
+# Number of requests kept by the journal of a mocurly context by default
+DEFAULT_JOURNAL_SIZE = 1000
+
+
+class JournalEntry(object):
+    """A request recorded in the journal, with its response.
+
+    Attributes:
+        sequence - Position of the request among all recorded requests
+        time - Time at which the request was handled
+        method - HTTP method of the request
+        path - Requested path, including the query string
+        route - Name of the route that handled the request, e.g
+            `GET /accounts/:pk`
+        pk - Primary key in the path of the request (e.g the account code for
+            `/accounts/blah/invoices`), or None
+        account - Code of the account whose resources the request accessed,
+            or None
+        request_body - Raw body of the request
+        status - Status of the response, or `timeout` for simulated timeouts
+        response_body - Body of the response
+    """
+    __slots__ = ('sequence', 'time', 'method', 'path', 'route', 'pk', 'account',
+                 'request_body', 'status', 'response_body')
+    indexed_fields = ('method', 'route', 'pk', 'account')
+
+    def __init__(self, sequence, method, path, route, pk, account, request_body, status, response_body):
+        self.sequence = sequence
+        self.time = current_time()
+        self.method = method
+        self.path = path
+        self.route = route
+        self.pk = pk
+        self.account = account
+        self.request_body = request_body
+        self.status = status
+        self.response_body = response_body
+
+    def __repr__(self):
+        return 'JournalEntry({0!r}, {1!r}, {2!r})'.format(self.sequence, self.route, self.status)
+
+
+class Journal(object):
+    """Bounded journal of requests, keeping the `max_size` most recent ones.
+    """
+    def __init__(self, max_size=DEFAULT_JOURNAL_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+        self.entries = deque()
+        # Entries in the order they were recorded, keyed by the field and then
+        # by its value
+        self.indexes = dict((field, {}) for field in JournalEntry.indexed_fields)
+
+    def record(self, method, path, route, pk, account, request_body, status, response_body):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            if len(self.entries) >= self.max_size:
+                self._evict()
+            entry = JournalEntry(next(self.sequence), method, path, route, pk, account,
+                                 request_body, status, response_body)
+            self.entries.append(entry)
+            for field, index in self.indexes.items():
+                index.setdefault(getattr(entry, field), deque()).append(entry)
+
+    def _evict(self):
+        """Removes the oldest entry, which is also the oldest of each of the
+        buckets of the indexes it is in.
+        """
+        entry = self.entries.popleft()
+        for field, index in self.indexes.items():
+            value = getattr(entry, field)
+            bucket = index[value]
+            bucket.popleft()
+            if not bucket:
+                del index[value]
+
+    def find(self, **filters):
+        """Returns the entries matching all the given filters, oldest first.
+        The filters are keyed by the indexed fields (`method`, `route`, `pk`
+        and `account`), e.g `find(route='POST /subscriptions', account='blah')`.
+        """
+        unknown_fields = set(filters) - set(JournalEntry.indexed_fields)
+        if unknown_fields:
+            raise TypeError('Cannot filter the journal by {0}'.format(', '.join(sorted(unknown_fields))))
+        with self.lock:
+            if not filters:
+                return list(self.entries)
+            # Only visit the smallest of the buckets of the filters
+            buckets = [(self.indexes[field].get(value, ()), field) for field, value in filters.items()]
+            candidates, candidates_field = min(buckets, key=lambda bucket: len(bucket[0]))
+            other_filters = [(field, value) for field, value in filters.items() if field != candidates_field]
+            return [entry for entry in candidates
+                    if all(getattr(entry, field) == value for field, value in other_filters)]
+
+    def count(self, **filters):
+        """Returns the number of entries matching all the given filters
+        """
+        if len(filters) == 1:
+            (field, value), = filters.items()
+            if field in self.indexes:
+                with self.lock:
+                    return len(self.indexes[field].get(value, ()))
+        return len(self.find(**filters))
+
+    def last(self, **filters):
+        """Returns the most recent entry matching all the given filters, or None
+        """
+        entries = self.find(**filters)
+        return entries[-1] if entries else None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            for index in self.indexes.values():
+                index.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.entries))
@@ -0,0 +1,230 @@
+"""Metrics of the requests handled by the mocked endpoints
+
+Every request is recorded under the route that handled it: the number of
+requests per status code, the number of bytes in the responses, and the time
+spent handling them, split into the time spent deserializing the request,
+serializing the response and in the handler itself.
+"""
+import functools
+import threading
+from timeit import default_timer
+
+# Upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PHASES = ('total', 'deserialize', 'handler', 'serialize')
+# Route under which the requests that no route handles are recorded
+UNMATCHED_ROUTE = 'unmatched'
+
+# Timer of the request being handled by the current thread
+_local = threading.local()
+
+
+class Histogram(object):
+    """Counts the observed values per bucket, along with their sum.
+    """
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in LATENCY_BUCKETS:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """Returns the number of observed values less than or equal to each
+        bucket bound, the last one (for the infinite bound) being the total.
+        """
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def as_dict(self):
+        bounds = list(LATENCY_BUCKETS) + [float('inf')]
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': list(zip(bounds, self.cumulative_counts()))
+        }
+
+
+class RouteMetrics(object):
+    """Metrics of the requests handled by a single route
+    """
+    def __init__(self):
+        self.statuses = {}
+        self.response_bytes = 0
+        self.latency = dict((phase, Histogram()) for phase in PHASES)
+
+    def record(self, status, response_bytes, timings):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.response_bytes += response_bytes
+        for phase, seconds in timings.items():
+            self.latency[phase].observe(seconds)
+
+    def as_dict(self):
+        return {
+            'count': sum(self.statuses.values()),
+            'statuses': dict(self.statuses),
+            'response_bytes': self.response_bytes,
+            'latency': dict((phase, histogram.as_dict()) for phase, histogram in self.latency.items())
+        }
+
+
+class Metrics(object):
+    """Metrics of the requests handled by the mocked endpoints, keyed by the
+    name of the route, e.g `GET /accounts/:pk`.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, status, response_bytes, timings):
+        with self.lock:
+            route_metrics = self.routes.get(route)
+            if route_metrics is None:
+                route_metrics = self.routes[route] = RouteMetrics()
+            route_metrics.record(status, response_bytes, timings)
+
+    def clear(self):
+        with self.lock:
+            self.routes = {}
+
+    def stats(self):
+        """Returns the metrics as a dictionary keyed by route name, with for each
+        route:
+            `count` -> the number of requests
+            `statuses` -> the number of requests per response status, where
+                simulated timeouts have the status `timeout`
+            `response_bytes` -> the total size of the response bodies
+            `latency` -> a histogram of the time spent handling the requests
+                for each phase (`total`, `deserialize`, `handler` and
+                `serialize`), as a dictionary with the `count` and `sum` (in
+                seconds) of the observed times, and the cumulative number of
+                observed times per bucket, as a list of (upper bound, count)
+        """
+        with self.lock:
+            return dict((route, route_metrics.as_dict()) for route, route_metrics in self.routes.items())
+
+    def to_prometheus(self):
+        """Renders the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines.append('# HELP mocurly_requests_total Requests handled by the mocked endpoints.')
+            lines.append('# TYPE mocurly_requests_total counter')
+            for route, route_metrics in routes:
+                for status, count in sorted(route_metrics.statuses.items(), key=lambda item: str(item[0])):
+                    lines.append('mocurly_requests_total{{route="{0}",status="{1}"}} {2}'.format(_escape(route), status, count))
+
+            lines.append('# HELP mocurly_response_bytes_total Bytes in the bodies of the responses.')
+            lines.append('# TYPE mocurly_response_bytes_total counter')
+            for route, route_metrics in routes:
+                lines.append('mocurly_response_bytes_total{{route="{0}"}} {1}'.format(_escape(route), route_metrics.response_bytes))
+
+            lines.append('# HELP mocurly_request_duration_seconds Time spent handling the requests, per phase.')
+            lines.append('# TYPE mocurly_request_duration_seconds histogram')
+            bounds = [repr(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+            for route, route_metrics in routes:
+                for phase in PHASES:
+                    histogram = route_metrics.latency[phase]
+                    labels = 'route="{0}",phase="{1}"'.format(_escape(route), phase)
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append('mocurly_request_duration_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, count))
+                    lines.append('mocurly_request_duration_seconds_sum{{{0}}} {1!r}'.format(labels, histogram.sum))
+                    lines.append('mocurly_request_duration_seconds_count{{{0}}} {1}'.format(labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(label_value):
+    return label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Metrics of all the requests handled in the process, across contexts
+process_metrics = Metrics()
+
+
+class RequestTimer(object):
+    """Measures the time spent handling a request, and in each of its phases.
+    Also collects what the endpoints tell about the request: the route handling
+    it, the arguments parsed out of its path, and the account it accessed.
+    """
+    def __init__(self):
+        self.route = UNMATCHED_ROUTE
+        self.route_args = ()
+        self.account = None
+        self.start = default_timer()
+        self.phases = {'deserialize': 0.0, 'serialize': 0.0}
+        self.depth = 0
+
+    def timings(self):
+        total = default_timer() - self.start
+        timings = dict(self.phases)
+        timings['total'] = total
+        timings['handler'] = max(total - self.phases['deserialize'] - self.phases['serialize'], 0.0)
+        return timings
+
+
+class timing_request(object):
+    """Context manager timing the request handled within it in the current
+    thread.
+    """
+    def __enter__(self):
+        self.previous_timer = getattr(_local, 'timer', None)
+        self.timer = _local.timer = RequestTimer()
+        return self.timer
+
+    def __exit__(self, type, value, tb):
+        _local.timer = self.previous_timer
+
+
+def set_route(route, route_args=()):
+    """Sets the name of the route handling the current request, and the
+    arguments parsed out of its path
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.route = route
+        timer.route_args = route_args
+
+
+def set_request_account(account_code):
+    """Sets the account accessed by the current request, unless the request
+    already accessed one
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is not None and timer.account is None:
+        timer.account = account_code
+
+
+def timed(phase):
+    """Decorator adding the time spent in the function to the given phase of the
+    current request. Calls nested in a timed call are not counted again.
+    """
+    def timed_decorator(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            timer = getattr(_local, 'timer', None)
+            if timer is None or timer.depth:
+                return func(*args, **kwargs)
+            timer.depth += 1
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.phases[phase] += default_timer() - start
+                timer.depth -= 1
+        return timed_func
+    return timed_decorator
@@ -0,0 +1,147 @@
+"""Simulation of the latency and bandwidth of the network
+
+A `NetworkModel` delays the responses of the mocked endpoints, to exercise the
+timeouts, connection pools and retries of the code under test. Each response
+is delayed by a latency drawn from the distribution of its route, plus the time
+it takes to transfer its body at the capped throughput. The random number
+generator is seeded, so that runs with the same seed are delayed the same way.
+"""
+import bisect
+import math
+import random
+import threading
+import time
+
+
+class Fixed(object):
+    """Always the same latency, in seconds
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def sample(self, rng):
+        return self.seconds
+
+
+class Uniform(object):
+    """Latency uniformly distributed between `low` and `high` seconds
+    """
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+
+class LogNormal(object):
+    """Latency following a log-normal distribution, the usual shape of network
+    latencies, with the given median (in seconds) and standard deviation of
+    its logarithm
+    """
+    def __init__(self, median, sigma):
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self, rng):
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+class Percentiles(object):
+    """Latency replayed from recorded percentiles, given as a dictionary of
+    the latency (in seconds) per percentile, e.g `{50: 0.08, 90: 0.2, 99: 1.5}`.
+    Latencies between the recorded percentiles are interpolated linearly,
+    and latencies below the lowest (above the highest) recorded percentile
+    are the latency of that percentile.
+    """
+    def __init__(self, percentiles):
+        if not percentiles:
+            raise ValueError('At least one percentile is needed')
+        points = sorted(percentiles.items())
+        self.percentiles = [float(percentile) for percentile, _ in points]
+        self.latencies = [latency for _, latency in points]
+
+    def sample(self, rng):
+        percentile = rng.uniform(0, 100)
+        index = bisect.bisect_left(self.percentiles, percentile)
+        if index == 0:
+            return self.latencies[0]
+        if index == len(self.percentiles):
+            return self.latencies[-1]
+        low, high = self.percentiles[index - 1], self.percentiles[index]
+        fraction = (percentile - low) / (high - low)
+        return self.latencies[index - 1] + fraction * (self.latencies[index] - self.latencies[index - 1])
+
+
+class NetworkModel(object):
+    """Latency and bandwidth of the simulated network.
+
+    Accepts:
+        latency - Distribution of the latency of the routes without a
+            distribution of their own (see `routes`), or a number of seconds.
+            No latency by default.
+        routes - Distributions of the latency (or numbers of seconds) keyed
+            by the name of the route, e.g `{'POST /subscriptions': 0.5}`.
+        bandwidth - Throughput of the response bodies in bytes per second, or
+            None for no limit.
+        seed - Seed of the random number generator drawing the latencies.
+    """
+    def __init__(self, latency=None, routes=None, bandwidth=None, seed=None):
+        self.latency = _distribution(latency)
+        self.routes = dict((route, _distribution(distribution)) for route, distribution in (routes or {}).items())
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+
+    # Number of bytes written at a time by `send`
+    chunk_size = 1024
+
+    def delay(self, route, response_bytes):
+        """Returns the number of seconds to delay a response of the route with
+        the given number of bytes by
+        """
+        return self.latency_delay(route) + self.transfer_delay(response_bytes)
+
+    def latency_delay(self, route):
+        """Returns the latency of a response of the route, in seconds
+        """
+        distribution = self.routes.get(route, self.latency)
+        if distribution is None:
+            return 0.0
+        with self.lock:
+            return max(distribution.sample(self.rng), 0.0)
+
+    def transfer_delay(self, response_bytes):
+        """Returns the number of seconds to transfer the given number of bytes
+        """
+        if not self.bandwidth:
+            return 0.0
+        return float(response_bytes) / self.bandwidth
+
+    def wait(self, route, response_bytes, transfer=True):
+        """Blocks for the delay of a response of the route, leaving out the
+        time to transfer its body if `transfer` is False
+        """
+        seconds = self.latency_delay(route)
+        if transfer:
+            seconds += self.transfer_delay(response_bytes)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def send(self, write, body):
+        """Writes the body with `write` in chunks, paced to the bandwidth, so
+        that a client reading it from a socket sees it trickle in
+        """
+        if not self.bandwidth:
+            write(body)
+            return
+        for start in range(0, len(body), self.chunk_size):
+            chunk = body[start:start + self.chunk_size]
+            time.sleep(self.transfer_delay(len(chunk)))
+            write(chunk)
+
+
+def _distribution(latency):
+    if latency is None or hasattr(latency, 'sample'):
+        return latency
+    return Fixed(latency)
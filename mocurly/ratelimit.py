@@ -0,0 +1,113 @@
+"""Emulation of the rate limits of the recurly API
+
+Like recurly, a `RateLimiter` allows a number of requests per period to each
+API key, tells the client how many requests it has left in the
+`X-RateLimit-*` headers of every response, and answers with a 429 once they
+are all used up. Requests are limited with a token bucket per API key, which
+refills continuously at `limit` tokens per `period`.
+
+The limiter reads the time from its clock, which can be a `ManualClock` to
+control the passing of time in tests.
+"""
+import base64
+import binascii
+import math
+import threading
+import time
+
+# Requests allowed per period by default, like the production sites of recurly
+DEFAULT_LIMIT = 1000
+DEFAULT_PERIOD = 60
+
+# Body of the responses to the requests that exceeded the rate limit, in the
+# format of the errors returned by recurly
+RATE_LIMITED_BODY = (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                     u'<error>\n'
+                     u'  <symbol>rate_limit_exceeded</symbol>\n'
+                     u'  <description>You have made too many API requests.</description>\n'
+                     u'</error>')
+
+
+class ManualClock(object):
+    """Clock that only moves forward when told to, returning the number of
+    seconds since the epoch like `time.time`
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class RateLimiter(object):
+    """Limits the requests of each API key to `limit` requests per `period`
+    seconds, as measured by `clock`.
+    """
+    def __init__(self, limit=DEFAULT_LIMIT, period=DEFAULT_PERIOD, clock=time.time):
+        self.limit = limit
+        self.period = period
+        self.rate = float(limit) / period
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Tokens left in the bucket of each API key, and when they were counted
+        self.buckets = {}
+
+    def acquire(self, api_key):
+        """Takes a token from the bucket of the API key, if there is any left.
+
+        Returns:
+            Tuple of whether the request is allowed, and the rate limit headers
+            of its response
+        """
+        with self.lock:
+            now = self.clock()
+            tokens = self._tokens(api_key, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[api_key] = (tokens, now)
+        return allowed, self._headers(tokens, now)
+
+    def remaining(self, api_key):
+        """Returns the number of requests the API key has left
+        """
+        with self.lock:
+            return int(self._tokens(api_key, self.clock()))
+
+    def reset(self):
+        """Refills the buckets of all API keys
+        """
+        with self.lock:
+            self.buckets = {}
+
+    def _tokens(self, api_key, now):
+        if api_key not in self.buckets:
+            return float(self.limit)
+        tokens, counted_at = self.buckets[api_key]
+        return min(float(self.limit), tokens + max(now - counted_at, 0) * self.rate)
+
+    def _headers(self, tokens, now):
+        # The reset time is when the bucket is full again
+        return {
+            'X-RateLimit-Limit': str(self.limit),
+            'X-RateLimit-Remaining': str(int(tokens)),
+            'X-RateLimit-Reset': str(int(math.ceil(now + (self.limit - tokens) / self.rate)))
+        }
+
+
+def api_key_of(request):
+    """Returns the API key that the request was authenticated with, or None
+    """
+    authorization = request.headers.get('Authorization')
+    if not authorization:
+        return None
+    scheme, _, credentials = authorization.partition(' ')
+    if scheme.lower() != 'basic':
+        return credentials
+    try:
+        return base64.b64decode(credentials.encode('ascii')).decode('utf-8').partition(':')[0]
+    except (binascii.Error, TypeError, UnicodeError, ValueError):
+        return credentials
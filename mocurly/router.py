@@ -0,0 +1,248 @@
+"""Routes mocked recurly requests to the endpoints that handle them.
+
+Instead of matching the requested URI against a regex per route, the path is
+split once into its resource, primary key, sub resource and sub resource key,
+which are then used to look up the route in a dictionary. This keeps the cost
+of routing a request independent of the number of routes.
+"""
+import dateutil.parser
+import recurly
+from six.moves.urllib.parse import urlparse, unquote, urlencode
+
+from .utils import deserialize
+from .errors import ResponseError
+from .backend import Page, Query, identity_map
+from .metrics import set_route
+
+# Query parameters that select the page of a list, as opposed to filtering it
+PAGE_PARAMS = ('per_page', 'cursor')
+# Query parameters that filter and order a list
+QUERY_PARAMS = ('state', 'sort', 'order', 'begin_time', 'end_time')
+
+
+class Route(object):
+    """A single route that can be dispatched to by the router.
+
+    Accepts:
+        name - Human readable description of the route, e.g
+            `GET /accounts/:pk/invoices`
+        handler - Function handling requests to the route. It will be called
+            with the request, the response headers and the arguments parsed
+            out of the path, and should return a tuple of the status code and
+            response body.
+    """
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+
+    def __repr__(self):
+        return 'Route({0})'.format(self.name)
+
+
+class Router(object):
+    """Dispatches requests to the endpoint methods.
+
+    Routes are keyed by the HTTP method, the resource, the sub resource and the
+    number of path segments, so that a request only needs a single dictionary
+    lookup to find its route.
+    """
+    methods = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE')
+
+    def __init__(self, endpoints):
+        self.routes = {}
+        for endpoint in endpoints:
+            self.add_endpoint(endpoint)
+
+    def add_route(self, method, resource, sub_resource, depth, name, handler):
+        self.routes[(method, resource, sub_resource, depth)] = Route(name, handler)
+
+    def add_endpoint(self, endpoint):
+        """Registers the CRUD routes of the endpoint, as well as all its
+        methods that are decorated with `details_route`.
+        """
+        resource = endpoint.base_uri
+        list_name = '/' + resource
+        detail_name = list_name + '/:pk'
+
+        def list_handler(request, headers):
+            page = self._page(request)
+            xml, item_count = endpoint.list(page=page, query=self._query(request))
+            self._set_page_headers(request, headers, page)
+            return 200, xml
+        self.add_route('GET', resource, None, 1, 'GET ' + list_name, list_handler)
+        self.add_route('HEAD', resource, None, 1, 'HEAD ' + list_name, self._head_handler(list_handler))
+
+        def create_handler(request, headers):
+            return 200, endpoint.create(deserialize(request.body)[1])
+        self.add_route('POST', resource, None, 1, 'POST ' + list_name, create_handler)
+
+        def retrieve_handler(request, headers, pk):
+            return 200, endpoint.retrieve(pk)
+        self.add_route('GET', resource, None, 2, 'GET ' + detail_name, retrieve_handler)
+
+        def update_handler(request, headers, pk):
+            return 200, endpoint.update(pk, deserialize(request.body)[1])
+        self.add_route('PUT', resource, None, 2, 'PUT ' + detail_name, update_handler)
+
+        def delete_handler(request, headers, pk):
+            endpoint.delete(pk, **request.querystring)
+            return 204, ''
+        self.add_route('DELETE', resource, None, 2, 'DELETE ' + detail_name, delete_handler)
+
+        extra_views = filter(
+            lambda method: callable(method) and getattr(method, 'is_route', False),
+            (getattr(endpoint, m)
+             for m in dir(endpoint)))
+        for method in extra_views:
+            # The uri is the name of the sub resource, optionally followed by
+            # a placeholder for the id of the sub resource
+            uri_parts = method.uri.rstrip('$').split('/')
+            sub_resource = uri_parts[0]
+            depth = 3 if len(uri_parts) == 1 else 4
+            name = detail_name + '/' + sub_resource + ('/:pk' if depth == 4 else '')
+            handler = self._details_route_handler(method)
+            self.add_route(method.method, resource, sub_resource, depth,
+                           method.method + ' ' + name, handler)
+            if method.is_list:
+                self.add_route('HEAD', resource, sub_resource, depth, 'HEAD ' + name, self._head_handler(handler))
+
+    def _head_handler(self, handler):
+        """Handles HEAD requests to a list route, which recurly uses to count
+        the records without listing them.
+        """
+        def head_handler(request, headers, *uri_args):
+            status, body = handler(request, headers, *uri_args)
+            return status, ''
+        return head_handler
+
+    def _details_route_handler(self, method):
+        def details_route_handler(request, headers, *uri_args):
+            uri_args = list(uri_args)
+            if method.method == 'DELETE':
+                status = 204
+            else:
+                status = 200
+            if request.method in ['POST', 'PUT']:
+                post_data = request.querystring.copy()
+                if request.body:
+                    post_data.update(deserialize(request.body)[1])
+                uri_args.append(post_data)
+                result = method(*uri_args)
+            elif method.is_list:
+                page = self._page(request)
+                query = self._query(request)
+                filters = dict((k, v) for k, v in request.querystring.items()
+                               if k not in PAGE_PARAMS and k not in QUERY_PARAMS)
+                result = method(*uri_args, filters=filters, page=page, query=query)
+                self._set_page_headers(request, headers, page)
+                result = result[0]
+            else:
+                result = method(*uri_args)
+            return status, result
+        return details_route_handler
+
+    def _page(self, request):
+        """Parses the page requested through the `per_page` and `cursor` query
+        parameters.
+
+        Raises a 400 if either is not a number.
+        """
+        querystring = request.querystring
+        try:
+            per_page = int(querystring.get('per_page', [Page.default_per_page])[0])
+            cursor = querystring.get('cursor', [None])[0]
+            if cursor is not None:
+                cursor = int(cursor)
+        except ValueError:
+            raise ResponseError(400, '')
+        return Page(min(max(per_page, 1), Page.max_per_page), cursor)
+
+    def _query(self, request):
+        """Parses the filters and order requested through the `state`, `sort`,
+        `order`, `begin_time` and `end_time` query parameters, or returns None
+        if there are none.
+
+        Like recurly, lists limited to a time range or given an order are
+        sorted by `created_at` in descending order unless told otherwise.
+        Raises a 400 if the sort field, order or either time is invalid.
+        """
+        querystring = request.querystring
+        if not any(param in querystring for param in QUERY_PARAMS):
+            return None
+        states = querystring.get('state')
+        sort = querystring.get('sort', [None])[0]
+        order = querystring.get('order', ['desc'])[0]
+        begin_time = querystring.get('begin_time', [None])[0]
+        end_time = querystring.get('end_time', [None])[0]
+        if sort is None and (begin_time or end_time or 'order' in querystring):
+            sort = 'created_at'
+        if sort not in Query.sort_fields + (None,) or order not in Query.orders:
+            raise ResponseError(400, '')
+        try:
+            return Query(states=states, sort=sort, order=order,
+                         begin_time=dateutil.parser.parse(begin_time) if begin_time else None,
+                         end_time=dateutil.parser.parse(end_time) if end_time else None)
+        except (ValueError, OverflowError):
+            raise ResponseError(400, '')
+
+    def _set_page_headers(self, request, headers, page):
+        """Sets the `X-Records` header to the total number of records, and the
+        `Link` header to the start and next pages, like recurly does.
+        """
+        headers['X-Records'] = page.total
+        base_uri = urlparse(recurly.base_uri())
+        path = urlparse(request.path).path
+        params = sorted((k, v) for k, v in request.querystring.items() if k != 'cursor')
+
+        def page_uri(params):
+            uri = '{0}://{1}{2}'.format(base_uri.scheme, base_uri.netloc, path)
+            if params:
+                uri += '?' + urlencode(params, doseq=True)
+            return uri
+
+        links = []
+        if page.cursor is not None:
+            links.append('<{0}>; rel="start"'.format(page_uri(params)))
+        if page.next_cursor is not None:
+            links.append('<{0}>; rel="next"'.format(page_uri([('cursor', page.next_cursor)] + params)))
+        if links:
+            headers['Link'] = ', '.join(links)
+
+    def resolve(self, method, uri):
+        """Finds the route for the given request method and URI.
+
+        Returns:
+            Tuple of the route and the arguments parsed out of the path, or
+            None if no route handles the request.
+        """
+        path = urlparse(uri).path
+        base_path = urlparse(recurly.base_uri()).path
+        if not path.startswith(base_path):
+            return None
+        segments = path[len(base_path):].split('/')
+        if not 1 <= len(segments) <= 4 or not all(segments):
+            return None
+
+        resource = segments[0]
+        sub_resource = segments[2] if len(segments) > 2 else None
+        route = self.routes.get((method, resource, sub_resource, len(segments)), None)
+        if route is None:
+            return None
+        args = [unquote(segment) for segment in segments[1:2] + segments[3:4]]
+        return route, args
+
+    def dispatch(self, request, uri, headers):
+        """Callback for HTTPretty, which handles all requests made to recurly.
+
+        Raises a 404 if no route handles the request.
+        """
+        resolved = self.resolve(request.method, uri)
+        if resolved is None:
+            raise ResponseError(404, '')
+        route, args = resolved
+        set_route(route.name, args)
+        # Objects looked up to hydrate foreign keys are shared within the
+        # response
+        with identity_map():
+            status, body = route.handler(request, headers, *args)
+        return status, headers, body
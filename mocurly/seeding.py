@@ -0,0 +1,62 @@
+"""Bulk creation of resources, without going through HTTP
+"""
+from datetime import datetime
+
+import recurly
+import six
+
+from .backend import identity_map
+from .endpoints import BaseRecurlyEndpoint, accounts_endpoint, plans_endpoint, coupons_endpoint, subscriptions_endpoint
+
+
+def seed(accounts=(), plans=(), add_ons=(), coupons=(), subscriptions=()):
+    """Creates the given resources directly through the endpoints, with the
+    same side effects as creating them through the recurly client (e.g the
+    invoice, transaction and adjustments of a new subscription), but without
+    rendering or parsing any XML.
+
+    Each resource is given as a dictionary of the fields the recurly client
+    would send, where the values can be anything the client accepts (e.g
+    numbers, booleans, datetimes, `recurly.Money` or a dictionary of the
+    amount per currency). Nested resources are given as dictionaries as well,
+    e.g the account of a subscription. Add-ons must also have a `plan_code`
+    field, for the plan they are added to.
+
+    The resources are created in the order of the arguments, so that
+    subscriptions can refer to the accounts, plans, add-ons and coupons that
+    are seeded along with them. The given dictionaries are left untouched.
+    """
+    raw = BaseRecurlyEndpoint.RAW
+    with identity_map():
+        for account in accounts:
+            accounts_endpoint.create(_encode(account), format=raw)
+        for plan in plans:
+            plans_endpoint.create(_encode(plan), format=raw)
+        for add_on in add_ons:
+            add_on = _encode(add_on)
+            plans_endpoint.create_add_on(add_on.pop('plan_code'), add_on, format=raw)
+        for coupon in coupons:
+            coupons_endpoint.create(_encode(coupon), format=raw)
+        for subscription in subscriptions:
+            subscriptions_endpoint.create(_encode(subscription), format=raw)
+
+
+def _encode(value):
+    """Converts the value into what the endpoints receive when the recurly
+    client sends it, i.e the value parsed back from its XML representation.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, recurly.Money):
+        value = value.currencies
+    if isinstance(value, dict):
+        return dict((k, _encode(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    text = six.text_type(value)
+    # Elements without any text are parsed as empty objects
+    return text if text else {}
@@ -0,0 +1,186 @@
+"""Standalone HTTP server serving the mocked recurly endpoints
+
+Mocking recurly with HTTPretty only works within a single process. To share a
+mock between processes (e.g the workers of an application server and the
+processes running background jobs), the endpoints can instead be served over
+HTTP with `serve`, or by running `python -m mocurly serve`, and each process
+pointed at the server with `configure_client`.
+
+The metrics of the requests handled by the server are served at `/metrics`,
+in the Prometheus text format.
+"""
+import json
+import ssl
+import sys
+import traceback
+
+import recurly
+from six.moves import socketserver
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from . import core
+from .backend import using_state, set_default_state
+
+
+def configure_client(server_address):
+    """Points the recurly client of the current process at the mocurly server
+    listening on the given (host, port) address.
+    """
+    host, port = server_address
+    netloc = '{0}:{1}'.format(host, port)
+    # The server has no subdomains, so the placeholder for the subdomain in
+    # the base URI does not output anything
+    recurly.BASE_URI = 'http://' + netloc + '/v2/%.0s'
+    if recurly.SUBDOMAIN is None:
+        recurly.SUBDOMAIN = 'mocurly'
+    if netloc not in recurly.VALID_DOMAINS:
+        recurly.VALID_DOMAINS = tuple(recurly.VALID_DOMAINS) + (netloc,)
+
+
+# Body of the response to requests that failed with an unexpected error, in
+# the format of the errors returned by recurly
+INTERNAL_ERROR_BODY = (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                       u'<error>\n'
+                       u'  <symbol>internal_server_error</symbol>\n'
+                       u'  <description>The mocked endpoint failed to handle the request.</description>\n'
+                       u'</error>')
+
+# Path of the metrics of the requests, in the Prometheus text format
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class ServerRequest(object):
+    """A request received by the server, with the attributes of the HTTPretty
+    requests that the router and the timeout filters use.
+    """
+    def __init__(self, method, path, headers, body):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.querystring = parse_qs(urlparse(path).query)
+        self.parsed_body = self.parse_body(body)
+
+    def parse_body(self, body):
+        """Parses the body based on its content type, like HTTPretty does:
+        JSON and form encoded bodies are parsed, others are returned as text.
+        """
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+        try:
+            text = body.decode('utf-8')
+            if content_type in ('application/json', 'text/json'):
+                return json.loads(text)
+            if content_type == 'application/x-www-form-urlencoded':
+                return parse_qs(text)
+            return text
+        except Exception:
+            return body
+
+
+class MocurlyRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests to the server by dispatching them to the router.
+
+    Speaks HTTP/1.1, so that clients can keep their connections alive across
+    requests.
+    """
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which would otherwise
+    # wait for the client to acknowledge the headers before sending the body
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.path == METRICS_PATH and self.command in ('GET', 'HEAD'):
+            self.respond(200, {}, self.server.mocurly_instance.metrics.to_prometheus(), METRICS_CONTENT_TYPE)
+            return
+
+        request = ServerRequest(self.command, self.path, self.headers, body)
+        try:
+            status, headers, response_body = self.server.dispatch(request, self.path, {})
+        except ssl.SSLError:
+            # Simulate a timeout by dropping the connection without responding
+            self.close_connection = True
+            return
+        except Exception:
+            # Respond to unexpected errors, so that they can't be mistaken for
+            # simulated timeouts
+            self.log_error('Error handling %s %s\n%s', self.command, self.path, traceback.format_exc())
+            status, headers, response_body = 500, {}, INTERNAL_ERROR_BODY
+        self.respond(status, headers, response_body, 'application/xml; charset=utf-8')
+
+    def respond(self, status, headers, response_body, content_type):
+        response_body = response_body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(response_body)))
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        if self.command != 'HEAD':
+            network = self.server.mocurly_instance.network
+            if network is not None:
+                # Trickle the body at the bandwidth of the simulated network
+                network.send(self.wfile.write, response_body)
+            else:
+                self.wfile.write(response_body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def log_error(self, format, *args):
+        # Errors are logged even when the server is not verbose
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class MocurlyServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server serving the mocked endpoints, handling each connection in
+    its own thread.
+
+    The requests are handled in the given mocurly context (or a new one),
+    which can be used to register transaction failures or simulate timeouts
+    like with HTTPretty. Unlike with HTTPretty, the context does not need to
+    be started, and starting it would patch the sockets of the server. Until
+    the server is closed, the backends of the context are also the ones that
+    `mocurly.backend` resolves to in threads outside of any started context.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, mocurly_instance=None, verbose=False):
+        HTTPServer.__init__(self, server_address, MocurlyRequestHandler)
+        if mocurly_instance is None:
+            mocurly_instance = core.mocurly()
+        self.mocurly_instance = mocurly_instance
+        self.verbose = verbose
+        self.dispatch = core._callback(mocurly_instance, send_body=True)(core._get_router().dispatch)
+
+        with using_state(mocurly_instance.state):
+            core.reset()
+            mocurly_instance._apply_options()
+        set_default_state(mocurly_instance.state)
+        configure_client(self.server_address)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        core._restore_default_state()
+
+
+def serve(host='127.0.0.1', port=8000, verbose=False, **options):
+    """Serves the mocked endpoints on the given address until interrupted.
+    The options are the same as the keyword options of the `mocurly` class.
+    """
+    server = MocurlyServer((host, port), core.mocurly(**options), verbose=verbose)
+    print('Serving mocurly on {0}'.format(recurly.base_uri()))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
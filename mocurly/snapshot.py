@@ -0,0 +1,131 @@
+"""Snapshots of the state of all backends and endpoints
+
+A snapshot file starts with the offset of its header, followed by the records
+of all backends, each pickled on its own, the pickled indexes of each backend
+and finally the header, which describes where everything is. Loading a snapshot
+maps the file into memory and only reads the header: records are decoded the
+first time they are read, and the indexes of a field the first time they are
+used.
+"""
+import mmap
+import struct
+
+from six.moves import cPickle as pickle
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+
+from .backend import current_state
+from .endpoints import get_endpoints_state, set_endpoints_state
+
+MAGIC = b'MOCURLY\x01'
+_header_offset = struct.Struct('<Q')
+
+
+class SnapshotRecords(Mapping):
+    """Read-only mapping of the ids to the records of a backend in a snapshot,
+    which only decodes a record the first time it is read.
+    """
+    def __init__(self, buffer, uuids, bounds):
+        self.buffer = buffer
+        self.uuids = uuids
+        self.bounds = bounds
+        # The records are saved in order, so their position in the snapshot
+        # doubles as their position in the backend
+        self.positions = dict(zip(uuids, range(len(uuids))))
+        self.decoded = {}
+
+    def __getitem__(self, uuid):
+        try:
+            return self.decoded[uuid]
+        except KeyError:
+            i = self.positions[uuid]
+        record = self.decoded[uuid] = pickle.loads(self.buffer[self.bounds[i]:self.bounds[i + 1]])
+        return record
+
+    def __contains__(self, uuid):
+        return uuid in self.positions
+
+    def __iter__(self):
+        return iter(self.uuids)
+
+    def __len__(self):
+        return len(self.uuids)
+
+
+class SnapshotIndexes(dict):
+    """Indexes of a backend in a snapshot, which only decodes the index of a
+    field the first time it is used.
+    """
+    def __init__(self, buffer, bounds):
+        super(SnapshotIndexes, self).__init__()
+        self.buffer = buffer
+        self.bounds = bounds
+
+    def __missing__(self, field):
+        start, end = self.bounds[field]
+        index = self[field] = pickle.loads(self.buffer[start:end])
+        return index
+
+
+def save_snapshot(path):
+    """Saves the state of all backends and endpoints into a file, which can be
+    loaded back with `load_snapshot`.
+    """
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_header_offset.pack(0))
+
+        backends_state = []
+        for backend in current_state().backends:
+            uuids = list(backend.datastore)
+            bounds = [f.tell()]
+            for uuid in uuids:
+                f.write(pickle.dumps(dict(backend.datastore[uuid]), pickle.HIGHEST_PROTOCOL))
+                bounds.append(f.tell())
+
+            indexes = {}
+            for field in backend.indexed_fields:
+                start = f.tell()
+                pickle.dump(dict(backend.indexes[field].items()), f, pickle.HIGHEST_PROTOCOL)
+                indexes[field] = (start, f.tell())
+
+            backends_state.append({
+                'name': type(backend).__name__,
+                'uuids': uuids,
+                'bounds': bounds,
+                'indexes': indexes,
+                'attributes': dict((name, getattr(backend, name)) for name in backend.snapshot_attributes)
+            })
+
+        header_offset = f.tell()
+        pickle.dump({'backends': backends_state, 'endpoints': get_endpoints_state()}, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(len(MAGIC))
+        f.write(_header_offset.pack(header_offset))
+
+
+def load_snapshot(path):
+    """Replaces the state of all backends and endpoints with the snapshot saved
+    in the file by `save_snapshot`.
+
+    The file is mapped into memory, and records are only decoded when they are
+    first read. Since starting a mocurly context clears all state, snapshots
+    must be loaded after starting it.
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('{0} is not a mocurly snapshot'.format(path))
+    header_offset, = _header_offset.unpack_from(buffer, len(MAGIC))
+    header = pickle.loads(buffer[header_offset:])
+
+    backends_by_name = dict((type(backend).__name__, backend) for backend in current_state().backends)
+    for state in header['backends']:
+        backend = backends_by_name[state['name']]
+        records = SnapshotRecords(buffer, state['uuids'], state['bounds'])
+        backend.load_records(records, records.positions, SnapshotIndexes(buffer, state['indexes']))
+        for name, value in state['attributes'].items():
+            setattr(backend, name, value)
+    set_endpoints_state(header['endpoints'])
@@ -2,16 +2,58 @@
 """
 import pytz
 import datetime
-from xml.dom import minidom
+from xml.parsers import expat
 
-from jinja2 import Environment, PackageLoader
-jinja2_env = Environment(loader=PackageLoader('mocurly', 'templates'), extensions=['jinja2.ext.with_'])
+import dateutil.parser
+
+from jinja2 import Environment, PackageLoader, ModuleLoader
+
+from . import writer
+from .backend import current_state
+from .metrics import timed
+
+
+def _create_jinja2_env(loader):
+    return Environment(loader=loader, extensions=['jinja2.ext.with_'], autoescape=True, auto_reload=False)
+jinja2_env = _create_jinja2_env(PackageLoader('mocurly', 'templates'))
+
+# Render functions of the templates that have been loaded, keyed by the
+# template name, so that each template is only looked up once
+_render_functions = {}
+
+# Serializers that can generate the XML of the resource objects: the jinja2
+# templates or the native writer in writer.py. The serializer in use is part of
+# the state of the mocurly context.
+SERIALIZERS = ('jinja2', 'native')
 
 
 def current_time():
-    """Returns the current time in UTC, with the timezone set
+    """Returns the current time of the virtual clock of the current state, in
+    UTC with the timezone set. The virtual clock follows the wall clock, until
+    it is moved forward with `mocurly.advance`.
+    """
+    state = current_state()
+    if state.frozen_time is not None:
+        return state.frozen_time
+    return datetime.datetime.utcnow().replace(tzinfo=pytz.utc) + state.clock_offset
+
+
+# Parser of the times in the format written by `datetime.isoformat`, which is
+# much faster than dateutil (python 3.7+ only)
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+
+def parse_time(value):
+    """Parses an ISO 8601 time into a datetime. Datetimes are returned as is.
     """
-    return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    if isinstance(value, datetime.datetime):
+        return value
+    if _fromisoformat is not None:
+        try:
+            return _fromisoformat(value)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
 
 
 def details_route(method, uri, is_list=False):
@@ -28,6 +70,11 @@ def details_route(method, uri, is_list=False):
 
     This will generate a new endpoint /foo/:pk/bar that routes to the
     `bar_callback` method.
+
+    The uri can also capture the id of a nested resource, by following the
+    name of the nested resource with a `([^/ ]+)` placeholder (e.g
+    `bar/([^/ ]+)` routes /foo/:pk/bar/:bar_pk). The captured id is passed
+    to the method after the pk.
     """
     def details_route_decorator(func):
         func.is_route = True
@@ -38,6 +85,7 @@ def details_route(method, uri, is_list=False):
     return details_route_decorator
 
 
+@timed('serialize')
 def serialize_list(template, object_type_plural, object_type, object_list):
     """Serializes a list of resource objects into its XML version.
 
@@ -50,12 +98,23 @@ def serialize_list(template, object_type_plural, object_type, object_list):
     Returns:
         An XML string representing the serialized object list
     """
+    if current_state().serializer == 'native':
+        return writer.render_list(template, object_type_plural, object_list)
     serialized_obj_list = []
     for obj in object_list:
         serialized_obj_list.append(serialize(template, object_type, obj))
+    return join_serialized_list(object_type_plural, serialized_obj_list)
+
+
+@timed('serialize')
+def join_serialized_list(object_type_plural, serialized_obj_list):
+    """Joins the XML of already serialized resource objects into the XML of
+    the list, returning the same as `serialize_list`.
+    """
     return '<{0} type="array">{1}</{0}>'.format(object_type_plural, ''.join(serialized_obj_list)), len(serialized_obj_list)
 
 
+@timed('serialize')
 def serialize(template, object_type, object_dict):
     """Serializes a resource object into its XML version.
 
@@ -67,12 +126,64 @@ def serialize(template, object_type, object_dict):
     Returns:
         An XML string representing the serialized object list
     """
-    template = jinja2_env.get_template(template)
+    if current_state().serializer == 'native':
+        return writer.render(template, object_dict)
     kwargs = {}
     kwargs[object_type] = object_dict
-    return template.render(**kwargs)
+    return get_render_function(template)(**kwargs)
+
+
+def set_serializer(serializer):
+    """Selects the serializer used to generate the XML of the resource
+    objects in the current state. Both serializers generate the same XML.
+
+    Accepts:
+        serializer - `jinja2` to render the templates, or `native` to write
+            the XML directly using the schemas in writer.py, skipping the
+            template engine
+    """
+    if serializer not in SERIALIZERS:
+        raise ValueError('Unknown serializer {0}, expected one of {1}'.format(serializer, ', '.join(SERIALIZERS)))
+    current_state().serializer = serializer
+
+
+def get_render_function(template):
+    """Returns the function that renders the given template
+    """
+    try:
+        return _render_functions[template]
+    except KeyError:
+        render = _render_functions[template] = jinja2_env.get_template(template).render
+        return render
+
+
+def compile_templates(target, zip='deflated'):
+    """Precompiles the resource templates into python code, so that they can be
+    loaded without parsing them using `use_precompiled_templates`.
+
+    Accepts:
+        target - Path of the zip file (or directory, if `zip` is None) to
+            store the compiled templates in
+        zip - Compression method of the zip file, as accepted by jinja2
+    """
+    jinja2_env.compile_templates(target, zip=zip)
 
 
+def use_precompiled_templates(path):
+    """Loads the resource templates from the templates precompiled with
+    `compile_templates` found at the given path. Passing in None goes back to
+    loading the templates from the package.
+    """
+    global jinja2_env
+    if path is None:
+        loader = PackageLoader('mocurly', 'templates')
+    else:
+        loader = ModuleLoader(path)
+    jinja2_env = _create_jinja2_env(loader)
+    _render_functions.clear()
+
+
+@timed('deserialize')
 def deserialize(xml):
     """Deserialize the XML string into an object
 
@@ -83,34 +194,75 @@ def deserialize(xml):
         Tuple of object_type and the object as a dictionary. The type can be
         used to resolve what endpoint or object store to route to.
     """
-    parsed_xml = minidom.parseString(xml)
-    # only know of xml input with 1 child node, since thats all there is to
-    # recurly
-    assert len(parsed_xml.childNodes) == 1
-    root = parsed_xml.firstChild
-    if root.hasAttribute('type') and root.getAttribute('type') == 'array':
-        return _deserialize_list(root)
-    else:
-        return _deserialize_item(root)
+    return _Deserializer().parse(xml)
 
 
-def _deserialize_list(root):
-    """Deserializes a list of objects into their dictionary form.
+class _Element(object):
+    """An element that is being parsed by the deserializer
     """
-    return [_deserialize_item(node)[1] for node in root.childNodes]
-
-
-def _deserialize_item(root):
-    object_type = root.tagName
-    obj = {}
-    for node in root.childNodes:
-        if node.hasAttribute('nil'):
-            obj[node.tagName] = None
-        elif len(node.childNodes) == 1 and node.childNodes[0].nodeType == minidom.Node.TEXT_NODE:
-            obj[node.tagName] = node.firstChild.nodeValue
-        elif node.hasAttribute('type') and node.getAttribute('type') == 'array':
-            obj[node.tagName] = _deserialize_list(node)
+    __slots__ = ('tag', 'is_nil', 'is_array', 'children', 'text')
+
+    def __init__(self, tag, attrs):
+        self.tag = tag
+        self.is_nil = 'nil' in attrs
+        self.is_array = attrs.get('type') == 'array'
+        self.children = []
+        self.text = []
+
+    def value(self):
+        """Converts the element into its value: None for nil elements, the text
+        for elements that only contain text, a list for arrays and a dictionary
+        keyed by the tag of the child elements otherwise.
+        """
+        if self.is_nil:
+            return None
+        if not self.children and self.text:
+            return ''.join(self.text)
+        if self.is_array:
+            return self.list_value()
+        return self.item_value()
+
+    def list_value(self):
+        return [child.item_value() if child.children else child.value() for child in self.children]
+
+    def item_value(self):
+        return dict((child.tag, child.value()) for child in self.children)
+
+
+class _Deserializer(object):
+    """Deserializes XML into objects using expat, building the objects as the
+    elements are parsed instead of building a DOM first.
+    """
+    def __init__(self):
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+        self.stack = []
+        self.root = None
+
+    def parse(self, xml):
+        self.parser.Parse(xml, True)
+        root = self.root
+        # only know of xml input with 1 root element, since thats all there is
+        # to recurly
+        assert root is not None
+        if root.is_array:
+            return root.list_value()
+        return root.tag, root.item_value()
+
+    def start_element(self, tag, attrs):
+        element = _Element(tag, attrs)
+        if self.stack:
+            self.stack[-1].children.append(element)
         else:
-            child_object_type, child_object = _deserialize_item(node)
-            obj[node.tagName] = child_object
-    return object_type, obj
+            self.root = element
+        self.stack.append(element)
+
+    def end_element(self, tag):
+        self.stack.pop()
+
+    def character_data(self, data):
+        if self.stack:
+            self.stack[-1].text.append(data)
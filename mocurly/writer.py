@@ -0,0 +1,564 @@
+"""Native XML writer for resource objects
+
+Writes the XML representation of resource objects straight into a single
+buffer, driven by a schema per resource, instead of rendering the jinja2
+templates. Each schema mirrors the structure of its template in templates/,
+including the whitespace jinja2 leaves around block tags, so that the output is
+byte-identical to the rendered templates and the two serializers can be used
+interchangeably.
+"""
+from markupsafe import escape
+
+# Sentinel for fields that are missing from the object, which are rendered
+# like undefined variables in the templates
+_missing = object()
+
+
+def _lookup(obj, path):
+    for name in path:
+        try:
+            obj = obj[name]
+        except (KeyError, TypeError, IndexError):
+            return _missing
+    return obj
+
+
+def _truthy(value):
+    return value is not _missing and bool(value)
+
+
+class Value(object):
+    """Writes a field of the object, escaped and surrounded by the given
+    markup.
+    """
+    def __init__(self, prefix, path, suffix):
+        self.prefix = prefix
+        self.path = path
+        self.suffix = suffix
+
+    def write(self, out, obj):
+        value = _lookup(obj, self.path)
+        out.append(self.prefix)
+        if value is not _missing:
+            out.append(escape(value))
+        out.append(self.suffix)
+
+
+class Boolean(Value):
+    """Writes a field of the object as `true` or `false`, surrounded by the
+    given markup.
+    """
+    def write(self, out, obj):
+        out.append(self.prefix)
+        out.append('true' if _truthy(_lookup(obj, self.path)) else 'false')
+        out.append(self.suffix)
+
+
+class Text(object):
+    """Writes static markup.
+    """
+    def __init__(self, text):
+        self.text = text
+
+    def write(self, out, obj):
+        out.append(self.text)
+
+
+class CurrencyAmount(object):
+    """Writes a (currency, amount) pair of a per currency amount field.
+    """
+    def write(self, out, obj):
+        currency, value = obj
+        currency = escape(currency)
+        out.append('<')
+        out.append(currency)
+        out.append(' type="integer">')
+        out.append(escape(value))
+        out.append('</')
+        out.append(currency)
+        out.append('>')
+
+
+class Include(object):
+    """Writes the object using the schema of another template.
+    """
+    def __init__(self, template):
+        self.template = template
+
+    def write(self, out, obj):
+        schemas[self.template].write(out, obj)
+
+
+class Line(object):
+    """A line of the template, made up of the given nodes.
+    """
+    def __init__(self, indent, *nodes):
+        self.indent = ' ' * indent
+        self.nodes = nodes
+        self.end = '\n'
+
+    def write(self, out, obj):
+        out.append(self.indent)
+        for node in self.nodes:
+            node.write(out, obj)
+        out.append(self.end)
+
+
+class Block(object):
+    """Base class for the block tags of the templates.
+
+    Like in jinja2, the indentation before the opening tag and the newline after
+    the closing tag are always written, while the newline after the opening
+    tag and the indentation before the closing tag are only written along with
+    the body of the block.
+    """
+    def __init__(self, indent):
+        self.indent = ' ' * indent
+
+    def write_body(self, out, lines, obj):
+        out.append('\n')
+        for line in lines:
+            line.write(out, obj)
+        out.append(self.indent)
+
+
+class If(Block):
+    """`{% if %}` block, where the condition is either the path of a field to
+    check, or a function of the object.
+    """
+    def __init__(self, indent, condition, then_lines, else_lines=None):
+        super(If, self).__init__(indent)
+        if isinstance(condition, tuple):
+            path = condition
+            condition = lambda obj: _truthy(_lookup(obj, path))
+        self.condition = condition
+        self.then_lines = then_lines
+        self.else_lines = else_lines
+
+    def write(self, out, obj):
+        out.append(self.indent)
+        if self.condition(obj):
+            self.write_body(out, self.then_lines, obj)
+        elif self.else_lines is not None:
+            self.write_body(out, self.else_lines, obj)
+        out.append('\n')
+
+
+class For(Block):
+    """`{% for %}` block over a list field, or over the items of a dictionary
+    field if `items` is set. The body is written with each element as the
+    object.
+    """
+    def __init__(self, indent, path, lines, items=False):
+        super(For, self).__init__(indent)
+        self.path = path
+        self.lines = lines
+        self.items = items
+
+    def write(self, out, obj):
+        out.append(self.indent)
+        elements = _lookup(obj, self.path)
+        if elements is not _missing:
+            if self.items:
+                elements = elements.items()
+            for element in elements:
+                self.write_body(out, self.lines, element)
+        out.append('\n')
+
+
+class With(Block):
+    """`{% with %}` block, where the body is written with the given field as
+    the object.
+    """
+    def __init__(self, indent, path, lines):
+        super(With, self).__init__(indent)
+        self.path = path
+        self.lines = lines
+
+    def write(self, out, obj):
+        out.append(self.indent)
+        self.write_body(out, self.lines, _lookup(obj, self.path))
+        out.append('\n')
+
+
+class Schema(object):
+    """Schema of a whole template. Like jinja2, the trailing newline of the
+    template is not written.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        lines[-1].end = ''
+
+    def write(self, out, obj):
+        for line in self.lines:
+            line.write(out, obj)
+
+
+def element(tag, path=None, attrs=''):
+    """`<tag>{{ obj.path }}</tag>`, where the path defaults to the tag
+    """
+    if path is None:
+        path = (tag,)
+    return Value('<{0}{1}>'.format(tag, attrs), path, '</{0}>'.format(tag))
+
+
+def boolean(tag, path=None):
+    """`<tag type="boolean">{% if obj.path %}true{% else %}false{% endif %}</tag>`
+    """
+    if path is None:
+        path = (tag,)
+    return Boolean('<{0} type="boolean">'.format(tag), path, '</{0}>'.format(tag))
+
+
+def link(tag, uri, attrs=''):
+    """`<tag href="{{ obj.uris.uri }}"/>`
+    """
+    return Value('<{0}{1} href="'.format(tag, attrs), ('uris', uri), '"/>')
+
+
+def optional_link(indent, tag, uri):
+    """A link that is only written when the object has the uri
+    """
+    return If(indent, ('uris', uri), [Line(indent + 4, link(tag, uri))])
+
+
+def nillable(indent, tag, path=None, attrs='', nil_attrs=' nil="nil"'):
+    """A field that is written as a nil element when it is not set
+    """
+    if path is None:
+        path = (tag,)
+    return If(indent, path,
+              [Line(indent + 4, element(tag, path, attrs))],
+              [Line(indent + 4, Text('<{0}{1}></{0}>'.format(tag, nil_attrs)))])
+
+
+def currency_amounts(indent, path):
+    """A per currency amount field, written as an element per currency
+    """
+    return For(indent, path, [Line(indent + 4, CurrencyAmount())], items=True)
+
+
+INTEGER = ' type="integer"'
+DATETIME = ' type="datetime"'
+BOOLEAN = ' type="boolean"'
+FLOAT = ' type="float"'
+
+schemas = {}
+
+schemas['account.xml'] = Schema([
+    Line(0, Value('<account href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('adjustments', 'adjustments_uri')),
+    optional_link(4, 'billing_info', 'billing_info_uri'),
+    Line(4, link('invoices', 'invoices_uri')),
+    Line(4, link('redemptions', 'redemption_uri')),
+    Line(4, link('subscriptions', 'subscriptions_uri')),
+    Line(4, link('transactions', 'transactions_uri')),
+    Line(4, element('account_code')),
+    Line(4, element('state')),
+    nillable(4, 'username'),
+    nillable(4, 'email'),
+    nillable(4, 'first_name'),
+    nillable(4, 'last_name'),
+    nillable(4, 'company_name'),
+    nillable(4, 'vat_number'),
+    nillable(4, 'tax_exempt', attrs=BOOLEAN),
+    If(4, ('address',), [
+        Line(8, Text('<address>')),
+        nillable(12, 'address1', ('address', 'address1')),
+        nillable(12, 'address2', ('address', 'address2')),
+        nillable(12, 'city', ('address', 'city')),
+        nillable(12, 'state', ('address', 'state')),
+        nillable(12, 'zip', ('address', 'zip')),
+        nillable(12, 'country', ('address', 'country')),
+        nillable(12, 'phone', ('address', 'phone')),
+        Line(8, Text('</address>')),
+    ], [
+        Line(8, Text('<address nil="nil"></address>')),
+    ]),
+    nillable(4, 'accept_language'),
+    Line(4, element('hosted_login_token')),
+    Line(4, element('created_at', attrs=DATETIME)),
+    Line(0, Text('</account>')),
+])
+
+schemas['add_on.xml'] = Schema([
+    Line(0, Value('<add_on href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('plan', 'plan_uri')),
+    Line(4, element('add_on_code')),
+    Line(4, element('name')),
+    Line(4, boolean('display_quantity_on_hosted_page')),
+    Line(4, element('default_quantity', attrs=INTEGER)),
+    Line(4, Text('<unit_amount_in_cents>')),
+    currency_amounts(8, ('unit_amount_in_cents',)),
+    Line(4, Text('</unit_amount_in_cents>')),
+    Line(4, element('created_at', attrs=DATETIME)),
+    Line(0, Text('</add_on>')),
+])
+
+schemas['adjustment.xml'] = Schema([
+    Line(0, Value('<adjustment type="', ('type',), '" href="'), Value('', ('uris', 'object_uri'), '">')),
+    Line(4, link('account', 'account_uri')),
+    Line(4, link('invoice', 'invoice_uri')),
+    Line(4, element('uuid')),
+    Line(4, element('description')),
+    nillable(4, 'accounting_code'),
+    Line(4, element('product_code')),
+    Line(4, element('origin')),
+    Line(4, element('unit_amount_in_cents', attrs=INTEGER)),
+    Line(4, element('quantity', attrs=INTEGER)),
+    Line(4, element('discount_in_cents', attrs=INTEGER)),
+    Line(4, element('tax_in_cents', attrs=INTEGER)),
+    Line(4, element('total_in_cents', attrs=INTEGER)),
+    Line(4, element('currency')),
+    Line(4, element('tax_exempt', attrs=BOOLEAN)),
+    Line(4, Text('<tax_details type="array">')),
+    Line(8, Text('<!-- TODO -->')),
+    Line(4, Text('</tax_details>')),
+    Line(4, element('start_date', attrs=DATETIME)),
+    nillable(4, 'end_date', attrs=DATETIME),
+    Line(4, element('created_at', attrs=DATETIME)),
+    Line(0, Text('</adjustment>')),
+])
+
+schemas['billing_info.xml'] = Schema([
+    Line(0, Value('<billing_info href="', ('uris', 'object_uri'), '" type="credit_card">')),
+    Line(4, link('account', 'account_uri')),
+    nillable(4, 'first_name'),
+    nillable(4, 'last_name'),
+    nillable(4, 'company'),
+    nillable(4, 'address1'),
+    nillable(4, 'address2'),
+    nillable(4, 'city'),
+    nillable(4, 'state'),
+    nillable(4, 'zip'),
+    nillable(4, 'country'),
+    nillable(4, 'phone'),
+    nillable(4, 'vat_number'),
+    nillable(4, 'ip_address'),
+    nillable(4, 'ip_address_country'),
+    nillable(4, 'card_type'),
+    nillable(4, 'year', attrs=INTEGER),
+    nillable(4, 'month', attrs=INTEGER),
+    nillable(4, 'first_six'),
+    nillable(4, 'last_four'),
+    nillable(4, 'paypal_billing_agreement_id'),
+    Line(0, Text('</billing_info>')),
+])
+
+schemas['coupon.xml'] = Schema([
+    Line(0, Value('<coupon href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('redemptions', 'redemptions_uri')),
+    Line(4, element('coupon_code')),
+    Line(4, element('name')),
+    Line(4, element('state')),
+    Line(4, element('discount_type')),
+    If(4, lambda coupon: _lookup(coupon, ('discount_type',)) == 'percent', [
+        Line(8, element('discount_percent', attrs=INTEGER)),
+    ], [
+        Line(8, Text('<discount_in_cents>')),
+        currency_amounts(12, ('discount_in_cents',)),
+        Line(8, Text('</discount_in_cents>')),
+    ]),
+    nillable(4, 'redeem_by_date', attrs=DATETIME),
+    Line(4, boolean('single_use')),
+    nillable(4, 'applies_for_months'),
+    If(4, ('max_redemptions',), [
+        Line(4, element('max_redemptions', attrs=INTEGER)),
+    ], [
+        Line(8, Text('<max_redemptions nil="nil"></max_redemptions>')),
+    ]),
+    Line(4, boolean('applies_to_all_plans')),
+    Line(4, element('created_at', attrs=DATETIME)),
+    If(4, lambda coupon: not _truthy(_lookup(coupon, ('applies_to_all_plans',))), [
+        Line(8, Text('<plan_codes type="array">')),
+        For(12, ('plan_codes',), [Line(16, element('plan_code', ()))]),
+        Line(8, Text('</plan_codes>')),
+    ]),
+    Line(4, Value('<a name="redeem" href="', ('uris', 'redeem_uri'), '" method="post"/>')),
+    Line(0, Text('</coupon>')),
+])
+
+schemas['invoice.xml'] = Schema([
+    Line(0, Value('<invoice href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('account', 'account_uri')),
+    optional_link(4, 'subscription', 'subscription_uri'),
+    optional_link(4, 'original_invoice', 'original_invoice_uri'),
+    Line(4, element('uuid')),
+    Line(4, element('state')),
+    Line(4, element('invoice_number', attrs=INTEGER)),
+    nillable(4, 'po_number'),
+    nillable(4, 'vat_number'),
+    Line(4, element('subtotal_in_cents', attrs=INTEGER)),
+    Line(4, element('tax_in_cents', attrs=INTEGER)),
+    Line(4, element('total_in_cents', attrs=INTEGER)),
+    Line(4, element('currency')),
+    Line(4, element('created_at', attrs=DATETIME)),
+    nillable(4, 'closed_at'),
+    Line(4, element('tax_type')),
+    Line(4, element('tax_rate', attrs=FLOAT)),
+    Line(4, element('net_terms', attrs=INTEGER)),
+    Line(4, element('collection_method')),
+    Line(4, link('redemption', 'redemption_uri')),
+    Line(4, Text('<line_items type="array">')),
+    For(8, ('line_items',), [Line(12, Include('adjustment.xml'))]),
+    Line(4, Text('</line_items>')),
+    Line(4, Text('<transactions type="array">')),
+    For(8, ('transactions',), [Line(12, Include('transaction.xml'))]),
+    Line(4, Text('</transactions>')),
+    Line(0, Text('</invoice>')),
+])
+
+schemas['plan.xml'] = Schema([
+    Line(0, Value('<plan href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('add_ons', 'add_ons_uri')),
+    Line(4, element('plan_code')),
+    Line(4, element('name')),
+    nillable(4, 'description'),
+    nillable(4, 'success_url'),
+    nillable(4, 'cancel_url'),
+    Line(4, Text('<display_donation_amounts type="boolean">false</display_donation_amounts>')),
+    Line(4, element('display_quantity', attrs=BOOLEAN)),
+    Line(4, Text('<display_phone_number type="boolean">false</display_phone_number>')),
+    Line(4, Text('<bypass_hosted_confirmation type="boolean">false</bypass_hosted_confirmation>')),
+    Line(4, element('unit_name')),
+    Line(4, Text('<payment_page_tos_link nil="nil"></payment_page_tos_link>')),
+    Line(4, element('plan_interval_length', attrs=INTEGER)),
+    Line(4, element('plan_interval_unit')),
+    Line(4, element('trial_interval_length', attrs=INTEGER)),
+    Line(4, element('trial_interval_unit')),
+    nillable(4, 'accounting_code'),
+    Line(4, element('created_at', attrs=DATETIME)),
+    Line(4, boolean('tax_exempt')),
+    Line(4, Text('<unit_amount_in_cents>')),
+    currency_amounts(8, ('unit_amount_in_cents',)),
+    Line(4, Text('</unit_amount_in_cents>')),
+    Line(4, Text('<setup_fee_in_cents>')),
+    If(8, ('setup_fee_in_cents',), [
+        currency_amounts(12, ('setup_fee_in_cents',)),
+    ]),
+    Line(4, Text('</setup_fee_in_cents>')),
+    Line(0, Text('</plan>')),
+])
+
+schemas['redemption.xml'] = Schema([
+    Line(0, Value('<redemption href="', ('uris', 'object_uri'), '">')),
+    Line(2, link('coupon', 'coupon_uri')),
+    Line(2, link('account', 'account_uri')),
+    Line(2, element('single_use', ('coupon', 'single_use'), BOOLEAN)),
+    Line(2, element('currency')),
+    Line(2, element('created_at', attrs=DATETIME)),
+    Line(0, Text('</redemption>')),
+])
+
+schemas['subscription.xml'] = Schema([
+    Line(0, Value('<subscription href="', ('uris', 'object_uri'), '">')),
+    Line(4, link('account', 'account_uri')),
+    optional_link(4, 'invoice', 'invoice_uri'),
+    Line(4, Value('<plan href="', ('uris', 'plan_uri'), '">')),
+    Line(8, element('plan_code', ('plan', 'plan_code'))),
+    Line(8, element('name', ('plan', 'plan_name'))),
+    Line(4, Text('</plan>')),
+    Line(4, element('uuid')),
+    Line(4, element('state')),
+    Line(4, element('unit_amount_in_cents', attrs=INTEGER)),
+    Line(4, element('currency')),
+    Line(4, element('quantity', attrs=INTEGER)),
+    Line(4, element('activated_at', attrs=DATETIME)),
+    nillable(4, 'canceled_at'),
+    nillable(4, 'expires_at'),
+    Line(4, element('current_period_started_at', attrs=DATETIME)),
+    nillable(4, 'current_period_ends_at', attrs=DATETIME),
+    nillable(4, 'trial_started_at'),
+    nillable(4, 'trial_ends_at'),
+    Line(4, element('tax_in_cents', attrs=INTEGER)),
+    Line(4, element('tax_type')),
+    Line(4, element('tax_rate', attrs=FLOAT)),
+    Line(4, Text('<po_number nil="nil"></po_number>')),
+    Line(4, Text('<net_terms type="integer">0</net_terms>')),
+    Line(4, element('collection_method')),
+    Line(4, Text('<subscription_add_ons type="array">')),
+    For(8, ('subscription_add_ons',), [
+        Line(12, Text('<subscription_add_on>')),
+        Line(16, element('add_on_code')),
+        Line(16, element('quantity')),
+        Line(16, element('unit_amount_in_cents')),
+        Line(12, Text('</subscription_add_on>')),
+    ]),
+    Line(4, Text('</subscription_add_ons>')),
+    Line(4, Value('<a name="cancel" href="', ('uris', 'cancel_uri'), '" method="put"/>')),
+    Line(4, Value('<a name="reactivate" href="', ('uris', 'reactivate_uri'), '" method="put"/>')),
+    Line(4, Value('<a name="terminate" href="', ('uris', 'terminate_uri'), '" method="put"/>')),
+    Line(0, Text('</subscription>')),
+])
+
+schemas['transaction.xml'] = Schema([
+    Line(0, Value('<transaction href="', ('uris', 'object_uri'), '" type="'), Value('', ('type',), '">')),
+    Line(4, link('account', 'account_uri')),
+    optional_link(4, 'invoice', 'invoice_uri'),
+    optional_link(4, 'subscription', 'subscription_uri'),
+    optional_link(4, 'original_transaction', 'original_transaction_uri'),
+    Line(4, element('uuid')),
+    Line(4, element('action')),
+    Line(4, element('amount_in_cents', attrs=INTEGER)),
+    Line(4, element('tax_in_cents', attrs=INTEGER)),
+    Line(4, element('currency')),
+    Line(4, element('status')),
+    Line(4, element('payment_method')),
+    nillable(4, 'reference'),
+    Line(4, element('source')),
+    Line(4, boolean('recurring')),
+    Line(4, boolean('test')),
+    Line(4, boolean('voidable')),
+    Line(4, boolean('refundable')),
+    nillable(4, 'cvv_result', attrs=' code=""', nil_attrs=' code="" nil="nil"'),
+    nillable(4, 'avs_result', attrs=' code=""', nil_attrs=' code="" nil="nil"'),
+    nillable(4, 'avs_result_street', attrs=' code=""', nil_attrs=' code="" nil="nil"'),
+    nillable(4, 'avs_result_postal', attrs=' code=""', nil_attrs=' code="" nil="nil"'),
+    Line(4, element('created_at', attrs=DATETIME)),
+    Line(4, Text('<details>')),
+    With(8, ('account',), [Line(12, Include('account.xml'))]),
+    Line(4, Text('</details>')),
+    Line(0),
+    If(4, ('transaction_error',), [
+        With(8, ('transaction_error',), [Line(12, Include('transaction_error.xml'))]),
+    ]),
+    Line(4, Value('<a name="refund" href="', ('uris', 'object_uri'), '" method="delete" />')),
+    Line(0, Text('</transaction>')),
+])
+
+schemas['transaction_error.xml'] = Schema([
+    Line(0, Text('<transaction_error>')),
+    Line(4, element('error_code')),
+    Line(4, element('error_category')),
+    Line(4, element('merchant_message', ('merchant',))),
+    Line(4, element('customer_message', ('customer',))),
+    Line(0, Text('</transaction_error>')),
+    Line(0, Value('<error field="transaction.account.base" symbol="', ('error_category',), '">'), Value('', ('customer',), '</error>')),
+])
+
+
+def render(template, obj):
+    """Writes the object using the schema of the given template.
+
+    Returns:
+        An XML string, identical to the rendered template
+    """
+    out = []
+    schemas[template].write(out, obj)
+    return ''.join(out)
+
+
+def render_list(template, object_type_plural, object_list):
+    """Writes the list of objects using the schema of the given template, into
+    a single buffer.
+
+    Returns:
+        A tuple of the XML string and the number of objects, as returned by
+        `utils.serialize_list`
+    """
+    schema = schemas[template]
+    out = ['<{0} type="array">'.format(object_type_plural)]
+    for obj in object_list:
+        schema.write(out, obj)
+    out.append('</{0}>'.format(object_type_plural))
+    return ''.join(out), len(object_list)
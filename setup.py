@@ -4,7 +4,7 @@ install_requires = open('requirements.txt').read().split()
 
 setup(
     name='mocurly',
-    packages=find_packages(exclude=("tests", "tests.*")),
+    packages=find_packages(exclude=("tests", "tests.*", "benchmarks", "benchmarks.*")),
     package_data={'mocurly': ['templates/*.xml']},
     version='0.2.3',
     description='A library that allows your python tests to easily mock out the recurly library',
@@ -15,5 +15,6 @@ setup(
     download_url='https://github.com/Captricity/mocurly/tarball/v0.2.3',
     keywords = ['testing'],
     install_requires=install_requires,
+    extras_require={'columnar': ['numpy']},
     test_suite='tests'
 )
@@ -307,6 +307,99 @@ class TestAccount(unittest.TestCase):
         self.assertEqual(len(accounts), 3)
         self.assertEqual(set([account.account_code for account in accounts]), set(['foo', 'bar', 'blah']))
 
+    def test_list_account_pagination(self):
+        self.base_account_data['hosted_login_token'] = 'abcd1234'
+        self.base_account_data['created_at'] = '2014-08-11'
+        for i in range(5):
+            self.base_account_data['account_code'] = 'account{0}'.format(i)
+            mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+
+        accounts = recurly.Account.all(per_page=2)
+        self.assertEqual(len(accounts), 2)
+        self.assertEqual([account.account_code for account in accounts], ['account0', 'account1', 'account2', 'account3', 'account4'])
+        self.assertEqual(recurly.Account.count(), 5)
+
+        # pages stay stable while objects are added and deleted
+        accounts = recurly.Account.all(per_page=2)
+        mocurly.backend.accounts_backend.delete_object('account1')
+        self.base_account_data['account_code'] = 'account5'
+        mocurly.backend.accounts_backend.add_object('account5', self.base_account_data)
+        # iterating over a page walks all the following pages, so only look
+        # at the page itself
+        page_codes = lambda page: [page[i].account_code for i in range(len(page))]
+        second_page = accounts.next_page()
+        self.assertEqual(page_codes(second_page), ['account2', 'account3'])
+        self.assertEqual(page_codes(second_page.next_page()), ['account4', 'account5'])
+        self.assertEqual(page_codes(second_page.first_page()), ['account0', 'account2'])
+
+    def test_invoice_list_pagination(self):
+        mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+        for invoice_number in range(1000, 1003):
+            mocurly.backend.invoices_backend.add_object(str(invoice_number), {
+                'account': self.base_account_data['account_code'],
+                'uuid': str(invoice_number),
+                'invoice_number': str(invoice_number),
+            })
+
+        account = recurly.Account.get(self.base_account_data['account_code'])
+        invoices = account.invoices(per_page=2)
+        self.assertEqual(len(invoices), 2)
+        self.assertEqual([invoice.invoice_number for invoice in invoices], [1000, 1001, 1002])
+
+    def test_list_account_query(self):
+        self.base_account_data['hosted_login_token'] = 'abcd1234'
+        for i, state in enumerate(['active', 'closed', 'active', 'active']):
+            self.base_account_data['account_code'] = 'account{0}'.format(i)
+            self.base_account_data['state'] = state
+            self.base_account_data['created_at'] = '2014-08-1{0}T00:00:00+00:00'.format(4 - i)
+            mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+
+        codes = lambda accounts: [account.account_code for account in accounts]
+        self.assertEqual(codes(recurly.Account.all(state='active')), ['account0', 'account2', 'account3'])
+        self.assertEqual(codes(recurly.Account.all(sort='created_at', order='asc')), ['account3', 'account2', 'account1', 'account0'])
+        self.assertEqual(codes(recurly.Account.all(state='active', begin_time='2014-08-12T00:00:00Z', per_page=1)), ['account0', 'account2'])
+        self.assertEqual(recurly.Account.count(state='closed'), 1)
+        self.assertRaises(recurly.errors.BadRequestError, recurly.Account.all, sort='account_code')
+        self.assertRaises(recurly.errors.BadRequestError, recurly.Account.all, end_time='yesterday')
+
+    def test_invoice_list_query(self):
+        mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+        for invoice_number, state in [(1000, 'collected'), (1001, 'open'), (1002, 'collected')]:
+            mocurly.backend.invoices_backend.add_object(str(invoice_number), {
+                'account': self.base_account_data['account_code'],
+                'uuid': str(invoice_number),
+                'invoice_number': str(invoice_number),
+                'state': state,
+                'created_at': '2014-08-11T00:00:00+00:00',
+            })
+
+        account = recurly.Account.get(self.base_account_data['account_code'])
+        invoices = account.invoices(state='collected', order='desc')
+        self.assertEqual([invoice.invoice_number for invoice in invoices], [1002, 1000])
+
+    def test_nested_list_filters(self):
+        mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+        for plan_code in ('gold', 'silver'):
+            mocurly.backend.plans_backend.add_object(plan_code, {'plan_code': plan_code, 'name': plan_code})
+        for uuid, plan_code, state in [('foo', 'gold', 'active'), ('bar', 'silver', 'active'), ('baz', 'gold', 'expired')]:
+            mocurly.backend.subscriptions_backend.add_object(uuid, {
+                'uuid': uuid,
+                'account': self.base_account_data['account_code'],
+                'plan_code': plan_code,
+                'state': state,
+                'quantity': 1,
+                'currency': 'USD',
+                'created_at': '2014-08-11T00:00:00+00:00',
+            })
+
+        # query parameters other than the paging and query ones filter the
+        # records by their fields, on top of the query
+        account = recurly.Account.get(self.base_account_data['account_code'])
+        uuids = lambda subscriptions: [subscription.uuid for subscription in subscriptions]
+        self.assertEqual(uuids(account.subscriptions(plan_code='gold')), ['foo', 'baz'])
+        self.assertEqual(uuids(account.subscriptions(plan_code='gold', state='active')), ['foo'])
+        self.assertEqual(uuids(account.subscriptions(plan_code='bronze')), [])
+
     def test_invoice_list(self):
         mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
         base_invoice_data = {
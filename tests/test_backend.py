@@ -0,0 +1,276 @@
+import unittest
+import datetime
+import threading
+
+from dateutil.tz import tzoffset
+
+import mocurly.backend
+
+
+class TestBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = mocurly.backend.TransactionBackend()
+        self.base_transaction_data = {
+                'uuid': 'foo',
+                'account': 'blah',
+                'amount_in_cents': 100,
+                'currency': 'USD'
+            }
+
+    def test_index_lookup(self):
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.base_transaction_data['uuid'] = 'bar'
+        self.backend.add_object('bar', self.base_transaction_data)
+        self.base_transaction_data['uuid'] = 'baz'
+        self.base_transaction_data['account'] = 'other'
+        self.backend.add_object('baz', self.base_transaction_data)
+
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'blah')], ['foo', 'bar'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'other')], ['baz'])
+        self.assertEqual(self.backend.list_objects_by('account', 'missing'), [])
+        self.assertEqual(self.backend.list_objects_by('subscription', 'blah'), [])
+
+    def test_index_lookup_with_filter(self):
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.base_transaction_data['uuid'] = 'bar'
+        self.base_transaction_data['amount_in_cents'] = 200
+        self.backend.add_object('bar', self.base_transaction_data)
+
+        out = self.backend.list_objects_by('account', 'blah', lambda t: t['amount_in_cents'] > 100)
+        self.assertEqual([t['uuid'] for t in out], ['bar'])
+
+    def test_index_maintenance(self):
+        self.backend.add_object('foo', self.base_transaction_data)
+
+        self.backend.update_object('foo', {'account': 'other', 'subscription': 'sub'})
+        self.assertEqual(self.backend.list_objects_by('account', 'blah'), [])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'other')], ['foo'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('subscription', 'sub')], ['foo'])
+
+        # re-adding an object replaces its index entries
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.assertEqual(self.backend.list_objects_by('account', 'other'), [])
+        self.assertEqual(self.backend.list_objects_by('subscription', 'sub'), [])
+        self.assertEqual(len(self.backend.list_objects_by('account', 'blah')), 1)
+
+        self.backend.delete_object('foo')
+        self.assertEqual(self.backend.list_objects_by('account', 'blah'), [])
+
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.backend.clear_all()
+        self.assertEqual(self.backend.list_objects_by('account', 'blah'), [])
+
+    def test_unhashable_values_are_not_indexed(self):
+        self.base_transaction_data['account'] = {'account_code': 'blah'}
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.assertEqual(self.backend.list_objects_by('account', 'blah'), [])
+        self.backend.delete_object('foo')
+        self.assertFalse(self.backend.has_object('foo'))
+
+    def test_layers(self):
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.base_transaction_data['uuid'] = 'bar'
+        self.backend.add_object('bar', self.base_transaction_data)
+        frozen = self.backend.freeze()
+        records, positions, indexes, next_position = frozen
+
+        self.base_transaction_data['uuid'] = 'baz'
+        self.backend.add_object('baz', self.base_transaction_data)
+        self.backend.update_object('foo', {'account': 'other'})
+        self.backend.delete_object('bar')
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects()], ['foo', 'baz'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'blah')], ['baz'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'other')], ['foo'])
+
+        # the frozen records are left untouched
+        self.assertEqual(list(records), ['foo', 'bar'])
+        self.assertEqual(records['foo']['account'], 'blah')
+        self.assertEqual(indexes['account'], {'blah': set(['foo', 'bar'])})
+
+        self.backend.load_records(*frozen)
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'blah')], ['foo', 'bar'])
+        self.assertFalse(self.backend.has_object('baz'))
+        self.backend.add_object('baz', self.base_transaction_data)
+        self.assertEqual(self.backend.positions['baz'], next_position)
+
+    def test_pages(self):
+        for uuid in ['foo', 'bar', 'baz']:
+            self.base_transaction_data['uuid'] = uuid
+            self.backend.add_object(uuid, self.base_transaction_data)
+
+        page = mocurly.backend.Page(per_page=2)
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects(page=page)], ['foo', 'bar'])
+        self.assertEqual(page.total, 3)
+        self.assertIsNotNone(page.next_cursor)
+
+        # re-adding an object keeps its position, while deleting the last
+        # object of the page does not affect the next page
+        self.backend.add_object('foo', self.base_transaction_data)
+        self.backend.delete_object('bar')
+        page = mocurly.backend.Page(per_page=2, cursor=page.next_cursor)
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'blah', page=page)], ['baz'])
+        self.assertEqual(page.total, 2)
+        self.assertIsNone(page.next_cursor)
+
+    def add_transactions(self, times):
+        for uuid, created_at in times:
+            self.base_transaction_data['uuid'] = uuid
+            self.base_transaction_data['created_at'] = created_at
+            self.base_transaction_data['status'] = 'success'
+            self.backend.add_object(uuid, self.base_transaction_data)
+
+    def test_query_sort(self):
+        self.add_transactions([('foo', '2014-01-03T00:00:00+00:00'),
+                               ('bar', '2014-01-01T00:00:00Z'),
+                               ('baz', '2014-01-02T00:00:00.5+00:00')])
+
+        def uuids(sort='created_at', **kwargs):
+            query = mocurly.backend.Query(sort=sort, **kwargs)
+            return [t['uuid'] for t in self.backend.list_objects(query=query)]
+        self.assertEqual(uuids(), ['foo', 'baz', 'bar'])
+        self.assertEqual(uuids(order='asc'), ['bar', 'baz', 'foo'])
+        self.assertEqual(uuids(begin_time='2014-01-02T00:00:00Z'), ['foo', 'baz'])
+        self.assertEqual(uuids(end_time=datetime.datetime(2014, 1, 2, 9, tzinfo=tzoffset(None, 10 * 3600))), ['bar'])
+
+        # the index is kept up to date once built
+        self.add_transactions([('qux', '2014-01-02T12:00:00Z')])
+        self.backend.delete_object('foo')
+        self.assertEqual(uuids(order='asc'), ['bar', 'baz', 'qux'])
+
+        # updated objects are stamped, and come last by update time
+        self.backend.update_object('bar', {'amount_in_cents': 200})
+        self.assertIn('updated_at', self.backend.get_object('bar'))
+        self.assertEqual(uuids(sort='updated_at'), ['bar', 'qux', 'baz'])
+
+    def test_query_states(self):
+        self.add_transactions([('foo', '2014-01-01T00:00:00Z'), ('bar', '2014-01-02T00:00:00Z')])
+        self.backend.update_object('foo', {'status': 'void'})
+
+        query = mocurly.backend.Query(states=['void'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects(query=query)], ['foo'])
+        query = mocurly.backend.Query(states=['void', 'success'])
+        self.assertEqual([t['uuid'] for t in self.backend.list_objects_by('account', 'blah', query=query)], ['foo', 'bar'])
+        query = mocurly.backend.Query(states=['declined'])
+        self.assertEqual(self.backend.list_objects(query=query), [])
+
+    def test_query_pages(self):
+        self.add_transactions([(str(i), '2014-01-%02dT00:00:00Z' % (i % 5 + 1)) for i in range(10)])
+        for order in ['asc', 'desc']:
+            for filter_pred in [mocurly.backend._match_all, lambda t: t['uuid'] != '3']:
+                query = mocurly.backend.Query(sort='created_at', order=order)
+                expected = [t['uuid'] for t in self.backend.list_objects(filter_pred, query=query)]
+                listed = []
+                page = mocurly.backend.Page(per_page=3)
+                while True:
+                    listed.extend(t['uuid'] for t in self.backend.list_objects(filter_pred, page=page, query=query))
+                    self.assertEqual(page.total, len(expected))
+                    if page.next_cursor is None:
+                        break
+                    page = mocurly.backend.Page(per_page=3, cursor=page.next_cursor)
+                self.assertEqual(listed, expected)
+
+    def test_identity_map(self):
+        self.backend.add_object('foo', self.base_transaction_data)
+
+        # outside of an identity map every lookup reads a new copy
+        self.assertIsNot(self.backend.lookup_object('foo'), self.backend.lookup_object('foo'))
+
+        with mocurly.backend.identity_map():
+            transaction = self.backend.lookup_object('foo')
+            with mocurly.backend.identity_map():
+                self.assertIs(self.backend.lookup_object('foo'), transaction)
+
+            # writes are picked up by the next lookup
+            self.backend.update_object('foo', {'amount_in_cents': 200})
+            updated_transaction = self.backend.lookup_object('foo')
+            self.assertIsNot(updated_transaction, transaction)
+            self.assertEqual(updated_transaction['amount_in_cents'], 200)
+            self.assertIs(self.backend.lookup_object('foo'), updated_transaction)
+
+            self.backend.delete_object('foo')
+            self.assertRaises(KeyError, self.backend.lookup_object, 'foo')
+
+    def test_copy_on_write_reads(self):
+        self.backend.copy_on_write = True
+        self.backend.add_object('foo', self.base_transaction_data)
+
+        # the stored record is unaffected by writes to the caller's object
+        self.base_transaction_data['amount_in_cents'] = 200
+        transaction = self.backend.get_object('foo')
+        self.assertEqual(transaction['amount_in_cents'], 100)
+
+        # nor by writes through the view that was read
+        transaction['amount_in_cents'] = 300
+        transaction['uris'] = {}
+        del transaction['currency']
+        self.assertEqual(transaction['amount_in_cents'], 300)
+        self.assertEqual(self.backend.get_object('foo')['amount_in_cents'], 100)
+        self.assertFalse('uris' in self.backend.get_object('foo'))
+        self.assertEqual(self.backend.get_object('foo')['currency'], 'USD')
+
+        listed = self.backend.list_objects()[0]
+        listed['amount_in_cents'] = 400
+        self.assertEqual(self.backend.list_objects_by('account', 'blah')[0]['amount_in_cents'], 100)
+
+    def test_copy_on_write_updates(self):
+        self.backend.copy_on_write = True
+        self.backend.add_object('foo', self.base_transaction_data)
+        before = self.backend.get_object('foo')
+
+        after = self.backend.update_object('foo', {'amount_in_cents': 200})
+
+        # updates store a new version, leaving earlier reads untouched
+        self.assertEqual(before['amount_in_cents'], 100)
+        self.assertEqual(after['amount_in_cents'], 200)
+        self.assertEqual(self.backend.get_object('foo')['amount_in_cents'], 200)
+        self.assertEqual(dict(after), dict(self.backend.get_object('foo')))
+        self.assertEqual(after.copy(), self.backend.get_object('foo'))
+
+    def test_invoice_number_allocation(self):
+        invoices_backend = mocurly.backend.InvoiceBackend()
+        self.assertEqual(invoices_backend.allocate_invoice_number(), '1000')
+        self.assertEqual(invoices_backend.allocate_invoice_number(), '1001')
+
+        # directly added invoices push the counter past their number
+        invoices_backend.add_object('1234', {'invoice_number': '1234'})
+        self.assertEqual(invoices_backend.allocate_invoice_number(), '1235')
+        invoices_backend.add_object('1100', {'invoice_number': '1100'})
+        self.assertEqual(invoices_backend.allocate_invoice_number(), '1236')
+
+        invoices_backend.clear_all()
+        self.assertEqual(invoices_backend.allocate_invoice_number(), '1000')
+
+    def test_invoice_number_allocation_is_thread_safe(self):
+        invoices_backend = mocurly.backend.InvoiceBackend()
+        allocated = []
+
+        def allocate():
+            for i in range(1000):
+                allocated.append(invoices_backend.allocate_invoice_number())
+        threads = [threading.Thread(target=allocate) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(allocated)), 4000)
+
+    def test_states(self):
+        state = mocurly.backend.State()
+        other_state = mocurly.backend.State()
+        with mocurly.backend.using_state(state):
+            mocurly.backend.transactions_backend.add_object('foo', self.base_transaction_data)
+            self.assertTrue(mocurly.backend.transactions_backend.has_object('foo'))
+
+            seen_by_thread = []
+
+            def check():
+                with mocurly.backend.using_state(other_state):
+                    seen_by_thread.append(mocurly.backend.transactions_backend.has_object('foo'))
+            thread = threading.Thread(target=check)
+            thread.start()
+            thread.join()
+            self.assertEqual(seen_by_thread, [False])
+
+        self.assertTrue(state.transactions_backend.has_object('foo'))
+        self.assertFalse(other_state.transactions_backend.has_object('foo'))
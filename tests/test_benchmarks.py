@@ -0,0 +1,35 @@
+import unittest
+import six
+import recurly
+recurly.API_KEY = 'blah'
+
+from benchmarks.__main__ import run, compare
+from benchmarks.scenarios import SCENARIOS
+from mocurly.core import _get_router
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_every_route_has_a_scenario(self):
+        self.assertEqual(sorted(route.name for route in _get_router().routes.values()),
+                         sorted(scenario.route for scenario in SCENARIOS))
+
+    def test_run_and_compare(self):
+        report = run([3], 2, routes=['GET /accounts/:pk', 'DELETE /accounts/:pk', 'PUT /subscriptions/:pk/terminate'],
+                     log=six.StringIO())
+        results = report['results']['3']
+        self.assertEqual(sorted(results), ['DELETE /accounts/:pk', 'GET /accounts/:pk', 'PUT /subscriptions/:pk/terminate'])
+        for result in results.values():
+            self.assertEqual(sum(result['statuses'].values()), 2)
+            self.assertTrue(all(int(status) < 300 for status in result['statuses']))
+            self.assertTrue(result['p50_ms'] <= result['p99_ms'])
+
+        self.assertEqual(compare(report, report, 0.25), [])
+        baseline = {'results': {'3': dict((route, dict(result, p50_ms=result['p50_ms'] / 10)) for route, result in results.items())}}
+        self.assertEqual(len(compare(report, baseline, 0.25)), 3)
+
+    def test_clock_scenario(self):
+        report = run([3], 2, routes=['advance(months=1)'], log=six.StringIO())
+        result = report['results']['3']['advance(months=1)']
+        # every subscription of the dataset is renewed by every run
+        self.assertEqual(result['renewals'], 6)
+        self.assertTrue(result['us_per_renewal'] > 0)
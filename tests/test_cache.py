@@ -0,0 +1,126 @@
+import unittest
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly.core
+import mocurly.backend
+import mocurly.endpoints
+from mocurly.cache import xml_cache
+
+
+class TestXMLCache(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.core.mocurly(xml_cache=True)
+        self.mocurly_.start()
+
+        self.base_account_data = {
+                'account_code': 'blah',
+                'email': 'foo@bar.com',
+                'first_name': 'Foo',
+                'last_name': 'Bar',
+                'hosted_login_token': 'abcd1234',
+                'created_at': '2014-08-11'
+            }
+        mocurly.backend.accounts_backend.add_object(self.base_account_data['account_code'], self.base_account_data)
+
+        self.uris_calls = 0
+        original_uris = mocurly.endpoints.accounts_endpoint.uris
+
+        def counting_uris(obj):
+            self.uris_calls += 1
+            return original_uris(obj)
+        mocurly.endpoints.accounts_endpoint.uris = counting_uris
+
+    def tearDown(self):
+        del mocurly.endpoints.accounts_endpoint.uris
+        self.mocurly_.stop()
+
+    def test_unchanged_objects_are_served_from_cache(self):
+        self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+        self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+        self.assertEqual(len(recurly.Account.all()), 1)
+        self.assertEqual(self.uris_calls, 1)
+
+    def test_writes_invalidate_the_cache(self):
+        recurly.Account.get('blah')
+        mocurly.backend.accounts_backend.update_object('blah', {'email': 'bar@foo.com'})
+        self.assertEqual(recurly.Account.get('blah').email, 'bar@foo.com')
+        self.assertEqual(self.uris_calls, 2)
+
+        mocurly.backend.accounts_backend.delete_object('blah')
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'blah')
+
+    def test_related_writes_invalidate_the_cache(self):
+        self.assertFalse(hasattr(recurly.Account.get('blah'), 'billing_info'))
+        mocurly.backend.billing_info_backend.add_object('blah', {'account': 'blah', 'first_name': 'Foo'})
+        self.assertEqual(recurly.Account.get('blah').billing_info.first_name, 'Foo')
+
+    def test_embedded_writes_invalidate_the_cache(self):
+        mocurly.backend.transactions_backend.add_object('foo', {
+                'uuid': 'foo',
+                'account': 'blah',
+                'amount_in_cents': 100,
+                'currency': 'USD',
+                'created_at': '2014-08-11'
+            })
+        self.assertEqual(recurly.Transaction.get('foo').details.account.email, 'foo@bar.com')
+        mocurly.backend.accounts_backend.update_object('blah', {'email': 'bar@foo.com'})
+        self.assertEqual(recurly.Transaction.get('foo').details.account.email, 'bar@foo.com')
+
+    def test_related_writes_invalidate_all_listed_objects(self):
+        for uuid in ('foo', 'bar'):
+            mocurly.backend.transactions_backend.add_object(uuid, {
+                    'uuid': uuid,
+                    'account': 'blah',
+                    'amount_in_cents': 100,
+                    'currency': 'USD',
+                    'created_at': '2014-08-11'
+                })
+        # the transactions share their account, whose billing info is linked
+        # from the XML of each of them
+        self.assertFalse(any('/billing_info' in xml for xml in self._listed_transactions_xml()))
+        mocurly.backend.billing_info_backend.add_object('blah', {'account': 'blah', 'first_name': 'Foo'})
+        self.assertTrue(all('/billing_info' in xml for xml in self._listed_transactions_xml()))
+        mocurly.backend.billing_info_backend.delete_object('blah')
+        self.assertFalse(any('/billing_info' in xml for xml in self._listed_transactions_xml()))
+
+    def _listed_transactions_xml(self):
+        # like a request, which hydrates the shared account once
+        with mocurly.backend.identity_map():
+            out, count = mocurly.endpoints.transactions_endpoint.list()
+        xmls = out.split('</transaction>')[:-1]
+        self.assertEqual(len(xmls), 2)
+        return xmls
+
+    def test_writes_between_read_and_serialization(self):
+        # another thread writes to the object after it was read, but before
+        # its XML is generated
+        account = mocurly.backend.accounts_backend.get_object('blah')
+        mocurly.backend.accounts_backend.update_object('blah', {'email': 'bar@foo.com'})
+        xml = mocurly.endpoints.accounts_endpoint.serialize(account, cache=True)
+        self.assertTrue('bar@foo.com' in xml)
+        self.assertEqual(recurly.Account.get('blah').email, 'bar@foo.com')
+
+        # or deletes it, in which case its XML is not cached
+        account = mocurly.backend.accounts_backend.get_object('blah')
+        mocurly.backend.accounts_backend.delete_object('blah')
+        xml = mocurly.endpoints.accounts_endpoint.serialize(account, cache=True)
+        self.assertTrue('bar@foo.com' in xml)
+        self.assertEqual(len(xml_cache.entries), 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        xml_cache.max_entries = 2
+        for account_code in ('foo', 'bar'):
+            mocurly.backend.accounts_backend.add_object(account_code, dict(self.base_account_data, account_code=account_code))
+        recurly.Account.get('blah')
+        recurly.Account.get('foo')
+        recurly.Account.get('blah')
+        recurly.Account.get('bar')
+        self.assertEqual([key[1] for key in xml_cache.entries], ['blah', 'bar'])
+        self.assertEqual(self.uris_calls, 3)
+
+    def test_cache_is_cleared_on_reset(self):
+        recurly.Account.get('blah')
+        self.assertEqual(len(xml_cache.entries), 1)
+        mocurly.core.reset()
+        self.assertEqual(len(xml_cache.entries), 0)
@@ -0,0 +1,142 @@
+import unittest
+import datetime
+import recurly
+from dateutil.relativedelta import relativedelta
+recurly.API_KEY = 'blah'
+
+import mocurly
+import mocurly.backend
+import mocurly.errors
+from mocurly.utils import current_time, parse_time
+
+
+class TestClock(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly()
+        self.mocurly_.start()
+        mocurly.seed(accounts=[{'account_code': 'blah'}],
+                     plans=[{'plan_code': 'gold', 'name': 'Gold Plan',
+                             'unit_amount_in_cents': {'USD': 1000},
+                             'plan_interval_length': 1, 'plan_interval_unit': 'months'},
+                            {'plan_code': 'trial', 'name': 'Trial Plan',
+                             'unit_amount_in_cents': {'USD': 500},
+                             'plan_interval_length': 1, 'plan_interval_unit': 'months',
+                             'trial_interval_length': 14, 'trial_interval_unit': 'days'}])
+
+    def tearDown(self):
+        self.mocurly_.stop()
+
+    def subscribe(self, plan_code='gold', **kwargs):
+        subscription = recurly.Subscription(plan_code=plan_code, currency='USD',
+                                            account=recurly.Account(account_code='blah'), **kwargs)
+        subscription.save()
+        return subscription
+
+    def invoice_totals(self):
+        return [invoice.total_in_cents for invoice in recurly.Account.get('blah').invoices(sort='created_at', order='asc')]
+
+    def test_advance(self):
+        before = current_time()
+        mocurly.advance(days=30)
+        self.assertTrue(current_time() - before >= datetime.timedelta(days=30))
+        self.assertTrue(current_time() - before < datetime.timedelta(days=31))
+        account = recurly.Account(account_code='foo')
+        account.save()
+        self.assertTrue(account.created_at >= before + datetime.timedelta(days=30))
+
+        self.assertRaises(ValueError, mocurly.advance, days=-1)
+
+        # the clock is part of the state of the context
+        mocurly.reset()
+        self.assertTrue(current_time() - before < datetime.timedelta(days=1))
+
+    def test_renewals(self):
+        subscription = self.subscribe()
+        period_ends_at = subscription.current_period_ends_at
+        mocurly.advance(months=3)
+
+        subscription = recurly.Subscription.get(subscription.uuid)
+        self.assertEqual(subscription.state, 'active')
+        self.assertEqual(subscription.current_period_started_at, period_ends_at + relativedelta(months=2))
+        self.assertEqual(subscription.current_period_ends_at, period_ends_at + relativedelta(months=3))
+        self.assertEqual(self.invoice_totals(), [1000, 1000, 1000, 1000])
+
+        # the charges are dated at the time of the renewal
+        invoice = subscription.invoice()
+        self.assertEqual(invoice.created_at, subscription.current_period_started_at)
+        self.assertEqual(invoice.line_items[-1].start_date, subscription.current_period_started_at)
+        self.assertEqual(invoice.line_items[-1].end_date, subscription.current_period_ends_at)
+
+    def test_trial_end(self):
+        subscription = self.subscribe('trial')
+        self.assertEqual(self.invoice_totals(), [0])
+        mocurly.advance(days=13)
+        self.assertEqual(self.invoice_totals(), [0])
+        mocurly.advance(days=2)
+        self.assertEqual(self.invoice_totals(), [0, 500])
+        subscription = recurly.Subscription.get(subscription.uuid)
+        self.assertEqual(subscription.current_period_started_at, parse_time(subscription.trial_ends_at))
+
+    def test_canceled_subscriptions_expire(self):
+        subscription = self.subscribe()
+        subscription.cancel()
+        mocurly.advance(days=10)
+        self.assertEqual(recurly.Subscription.get(subscription.uuid).state, 'canceled')
+        mocurly.advance(months=1)
+        self.assertEqual(recurly.Subscription.get(subscription.uuid).state, 'expired')
+        self.assertEqual(self.invoice_totals(), [1000])
+
+        # reactivated subscriptions renew instead
+        subscription = self.subscribe()
+        subscription.cancel()
+        subscription.reactivate()
+        mocurly.advance(months=1)
+        self.assertEqual(recurly.Subscription.get(subscription.uuid).state, 'active')
+        self.assertEqual(len(self.invoice_totals()), 3)
+
+    def test_future_subscriptions_start(self):
+        starts_at = (current_time() + relativedelta(days=5)).replace(microsecond=0)
+        subscription = self.subscribe(starts_at=starts_at)
+        self.assertEqual(subscription.state, 'future')
+        mocurly.advance(days=6)
+        subscription = recurly.Subscription.get(subscription.uuid)
+        self.assertEqual(subscription.state, 'active')
+        self.assertEqual(subscription.current_period_started_at, starts_at)
+        self.assertEqual(self.invoice_totals(), [1000])
+
+    def test_declined_renewals(self):
+        subscription = self.subscribe()
+        self.mocurly_.register_transaction_failure('blah', mocurly.errors.TRANSACTION_DECLINED)
+        self.mocurly_.advance(months=1)
+        self.assertEqual(recurly.Subscription.get(subscription.uuid).state, 'expired')
+        self.assertEqual(self.invoice_totals(), [1000])
+
+
+class TestSchedule(unittest.TestCase):
+    def test_next_event(self):
+        backend = mocurly.backend.SubscriptionBackend()
+        backend.add_object('foo', {'state': 'active', 'current_period_ends_at': '2014-03-01T00:00:00+00:00'})
+        backend.add_object('bar', {'state': 'active', 'current_period_ends_at': '2014-02-01T00:00:00+00:00'})
+        backend.add_object('baz', {'state': 'expired', 'current_period_ends_at': '2014-01-01T00:00:00+00:00'})
+        backend.add_object('qux', {'state': 'future', 'activated_at': '2014-01-15T00:00:00Z'})
+
+        # rescheduled and deleted subscriptions leave stale entries behind
+        backend.update_object('foo', {'state': 'canceled', 'expires_at': '2014-01-20T00:00:00+00:00'})
+        backend.delete_object('qux')
+
+        self.assertEqual(backend.next_event('2013-12-31T00:00:00Z'), None)
+        self.assertEqual(backend.next_event('2014-12-31T00:00:00Z'), 'foo')
+        self.assertEqual(backend.next_event('2014-12-31T00:00:00Z'), 'bar')
+        self.assertEqual(backend.next_event('2014-12-31T00:00:00Z'), None)
+
+        # events are scheduled again when the subscription changes
+        backend.update_object('bar', {'current_period_ends_at': '2014-03-01T00:00:00+00:00'})
+        self.assertEqual(backend.next_event('2014-02-28T00:00:00Z'), None)
+        self.assertEqual(backend.next_event('2014-03-01T00:00:00Z'), 'bar')
+
+    def test_next_event_after_load(self):
+        backend = mocurly.backend.SubscriptionBackend()
+        backend.add_object('foo', {'state': 'active', 'current_period_ends_at': '2014-03-01T00:00:00+00:00'})
+        records, positions, indexes, next_position = backend.freeze()
+        backend.load_records(records, positions, indexes, next_position)
+        self.assertEqual(backend.next_event('2014-12-31T00:00:00Z'), 'foo')
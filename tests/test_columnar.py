@@ -0,0 +1,145 @@
+import unittest
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+import mocurly.backend
+from mocurly.columnar import ColumnStore, sum_records, numpy, INTEGER, TIME, BOOLEAN, CATEGORY, OBJECT
+
+SCHEMA = {'uuid': OBJECT,
+          'account': CATEGORY,
+          'status': CATEGORY,
+          'currency': CATEGORY,
+          'amount_in_cents': INTEGER,
+          'created_at': TIME,
+          'test': BOOLEAN}
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self.records = [
+            ('foo', {'uuid': 'foo', 'account': 'blah', 'status': 'success', 'currency': 'USD',
+                     'amount_in_cents': 100, 'created_at': '2014-01-01T00:00:00+00:00', 'test': True}),
+            # values that do not fit their columns, and fields without a column
+            ('bar', {'uuid': 'bar', 'account': 'blah', 'status': 'void', 'currency': 'EUR',
+                     'amount_in_cents': '200', 'created_at': '2014-01-01T00:00:00Z', 'test': 'false',
+                     'details': {'foo': 'bar'}}),
+            ('baz', {'uuid': 'baz', 'account': None, 'status': 'success', 'currency': 'USD',
+                     'amount_in_cents': '0300'}),
+            ('qux', {'uuid': 'qux', 'account': 'other', 'status': 'declined', 'currency': 'USD'}),
+        ]
+        self.store = ColumnStore(SCHEMA, self.records)
+
+    def test_round_trip(self):
+        self.assertEqual(list(self.store), ['foo', 'bar', 'baz', 'qux'])
+        self.assertEqual(len(self.store), 4)
+        for uuid, record in self.records:
+            self.assertTrue(uuid in self.store)
+            self.assertEqual(self.store[uuid], record)
+        self.assertFalse('missing' in self.store)
+        self.assertRaises(KeyError, lambda: self.store['missing'])
+
+        # rows grow past the initial capacity
+        store = ColumnStore(SCHEMA, (('%d' % i, {'amount_in_cents': i}) for i in range(1000)))
+        self.assertEqual(store['999'], {'amount_in_cents': 999})
+        self.assertTrue(store.nbytes() > 0)
+
+    def test_update_and_delete(self):
+        self.store['foo'] = {'uuid': 'foo', 'amount_in_cents': 150, 'extra': 1}
+        self.assertEqual(self.store['foo'], {'uuid': 'foo', 'amount_in_cents': 150, 'extra': 1})
+
+        del self.store['bar']
+        self.assertEqual(list(self.store), ['foo', 'baz', 'qux'])
+        self.assertRaises(KeyError, lambda: self.store['bar'])
+
+        # the row of the deleted record is reused, without its values
+        self.store['new'] = {'uuid': 'new'}
+        self.assertEqual(self.store['new'], {'uuid': 'new'})
+        self.assertEqual(len(self.store.row_uuids), 4)
+        self.assertEqual(list(self.store), ['foo', 'baz', 'qux', 'new'])
+
+    def test_totals(self):
+        records = [record for uuid, record in self.records]
+        for by in (None, 'account', 'currency', 'status'):
+            for filter_field, filter_values in ((None, None), ('status', ['success']), ('status', ['missing'])):
+                self.assertEqual(self.store.totals('amount_in_cents', by, filter_field, filter_values),
+                                 sum_records(records, 'amount_in_cents', by, filter_field, filter_values))
+        self.assertEqual(self.store.totals('amount_in_cents'), 600)
+        self.assertEqual(self.store.totals('amount_in_cents', 'currency'), {'USD': 400, 'EUR': 200})
+        self.assertEqual(self.store.totals('amount_in_cents', 'account', 'status', ['success']), {'blah': 100, None: 300})
+
+
+class TestColumnarBackend(unittest.TestCase):
+    def setUp(self):
+        self.backend = mocurly.backend.TransactionBackend()
+
+    def add_transactions(self):
+        for i in range(10):
+            self.backend.add_object('t%d' % i, {'uuid': 't%d' % i,
+                                                'account': 'blah' if i % 2 else 'other',
+                                                'status': 'success' if i % 3 else 'void',
+                                                'currency': 'USD',
+                                                'amount_in_cents': i * 100})
+
+    def test_totals(self):
+        self.add_transactions()
+        self.assertEqual(self.backend.totals('amount_in_cents'), 4500)
+        self.assertEqual(self.backend.totals('amount_in_cents', by='account'), {'blah': 2500, 'other': 2000})
+        self.assertEqual(self.backend.totals('amount_in_cents', by='account', states=['void']), {'blah': 1200, 'other': 600})
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_switch(self):
+        self.add_transactions()
+        records = self.backend.list_objects()
+        totals = self.backend.totals('amount_in_cents', by='account', states=['success'])
+
+        self.backend.set_columnar(True)
+        self.assertTrue(isinstance(self.backend.datastore, ColumnStore))
+        self.assertEqual(self.backend.list_objects(), records)
+        self.assertEqual(self.backend.totals('amount_in_cents', by='account', states=['success']), totals)
+
+        self.backend.update_object('t1', {'amount_in_cents': 1000})
+        self.assertEqual(self.backend.get_object('t1')['amount_in_cents'], 1000)
+        self.assertEqual(self.backend.list_objects_by('account', 'blah')[0]['uuid'], 't1')
+        self.backend.delete_object('t1')
+        self.assertFalse(self.backend.has_object('t1'))
+
+        self.backend.set_columnar(False)
+        self.assertFalse(isinstance(self.backend.datastore, ColumnStore))
+        self.assertEqual(len(self.backend.list_objects()), 9)
+
+        # backends without a schema keep a dictionary per record
+        accounts = mocurly.backend.AccountBackend()
+        accounts.set_columnar(True)
+        self.assertFalse(isinstance(accounts.datastore, ColumnStore))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestColumnarContext(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly(columnar=True)
+        self.mocurly_.start()
+
+    def tearDown(self):
+        self.mocurly_.stop()
+
+    def test_transactions(self):
+        self.assertTrue(isinstance(mocurly.backend.transactions_backend.datastore, ColumnStore))
+        mocurly.seed(accounts=[{'account_code': 'blah', 'billing_info': {'first_name': 'Foo', 'last_name': 'Bar'}}])
+        for amount in (100, 200, 300):
+            transaction = recurly.Transaction(amount_in_cents=amount, currency='USD',
+                                              account=recurly.Account(account_code='blah'))
+            transaction.save()
+        mocurly.backend.transactions_backend.update_object(transaction.uuid, {'status': 'void'})
+
+        self.assertEqual([t.amount_in_cents for t in recurly.Account.get('blah').transactions(sort='created_at', order='asc')],
+                         [100, 200, 300])
+        self.assertEqual(recurly.Transaction.get(transaction.uuid).status, 'void')
+        self.assertEqual(mocurly.backend.transactions_backend.totals('amount_in_cents', by='account', states=['success']),
+                         {'blah': 300})
+        self.assertEqual(mocurly.backend.invoices_backend.totals('total_in_cents', by='currency'), {'USD': 600})
+
+        # the storage mode is kept across resets
+        mocurly.reset()
+        self.assertTrue(isinstance(mocurly.backend.transactions_backend.datastore, ColumnStore))
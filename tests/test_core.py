@@ -1,10 +1,14 @@
 import unittest
 import ssl
+import threading
 import recurly
 recurly.API_KEY = 'blah'
+from httpretty import HTTPretty
 
 import mocurly
+import mocurly.core
 import mocurly.backend
+import mocurly.errors
 
 class TestCore(unittest.TestCase):
     def setUp(self):
@@ -28,6 +32,18 @@ class TestCore(unittest.TestCase):
             self.assertTrue(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
         foo()
 
+    def test_decorator_with_options(self):
+        @mocurly.mocurly(copy_on_write=True)
+        def foo():
+            self.assertTrue(mocurly.backend.accounts_backend.copy_on_write)
+            recurly.Account(**self.base_account_data).save()
+            account = recurly.Account.get(self.base_account_data['account_code'])
+            self.assertEqual(account.email, self.base_account_data['email'])
+        foo()
+
+        with mocurly.mocurly():
+            self.assertFalse(mocurly.backend.accounts_backend.copy_on_write)
+
     def test_decorate_class_method(self):
         class Demo(object):
             @mocurly.mocurly
@@ -51,6 +67,127 @@ class TestCore(unittest.TestCase):
         self.assertTrue(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
         mocurly_.stop()
 
+    def test_nested_contexts(self):
+        with mocurly.mocurly():
+            recurly.Account(**self.base_account_data).save()
+            with mocurly.mocurly():
+                self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'blah')
+                recurly.Account(account_code='foo').save()
+            # the outer context still mocks the requests once the inner one exits
+            self.assertTrue(HTTPretty.is_enabled())
+            self.assertEqual([account.account_code for account in recurly.Account.all()], ['blah'])
+            recurly.Account(account_code='bar').save()
+            self.assertEqual(len(recurly.Account.all()), 2)
+        self.assertFalse(HTTPretty.is_enabled())
+
+    def test_session_install(self):
+        mocurly.install()
+        try:
+            router = mocurly.core._router
+            # requests outside of a context go to the session context
+            recurly.Account(**self.base_account_data).save()
+            self.assertTrue(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
+
+            mocurly.reset()
+            self.assertFalse(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
+
+            for i in range(2):
+                with mocurly.mocurly():
+                    self.assertFalse(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
+                    recurly.Account(**self.base_account_data).save()
+                    self.assertTrue(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
+                # the routes stay registered across contexts
+                self.assertTrue(HTTPretty.is_enabled())
+                self.assertIs(mocurly.core._router, router)
+        finally:
+            mocurly.uninstall()
+        self.assertFalse(HTTPretty.is_enabled())
+
+    def test_base_layer(self):
+        mocurly.install()
+        try:
+            recurly.Account(**self.base_account_data).save()
+            mocurly.core._active_instance.register_transaction_failure('blah', mocurly.errors.TRANSACTION_DECLINED)
+            mocurly.set_base_layer()
+
+            for i in range(2):
+                with mocurly.mocurly():
+                    self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+                    self.assertRaises(recurly.ValidationError,
+                                      recurly.Transaction(account=recurly.Account(account_code='blah'), amount_in_cents=100, currency='USD').save)
+                    account = recurly.Account.get('blah')
+                    account.email = 'bar@foo.com'
+                    account.save()
+                    recurly.Account(account_code='foo').save()
+                    self.assertEqual(len(recurly.Account.all()), 2)
+                    mocurly.backend.accounts_backend.delete_object('blah')
+                    self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'blah')
+
+            mocurly.clear_base_layer()
+            mocurly.reset()
+            self.assertFalse(mocurly.backend.accounts_backend.has_object(self.base_account_data['account_code']))
+        finally:
+            mocurly.clear_base_layer()
+            mocurly.uninstall()
+
+    def test_parallel_contexts(self):
+        count = 4
+        ready = []
+        all_ready = threading.Condition()
+        results = {}
+        errors = []
+
+        def wait_for_all(i):
+            # wait for all contexts to be active at the same time
+            with all_ready:
+                if i in ready:
+                    return
+                ready.append(i)
+                all_ready.notify_all()
+                while len(ready) < count:
+                    all_ready.wait()
+
+        def run(i):
+            account_code = 'account{0}'.format(i)
+            context = mocurly.mocurly(serializer='native' if i % 2 else 'jinja2')
+            try:
+                with context:
+                    recurly.Account(account_code=account_code).save()
+                    if i % 2:
+                        context.register_transaction_failure(account_code, mocurly.errors.TRANSACTION_DECLINED)
+                    wait_for_all(i)
+                    transaction = recurly.Transaction(account=recurly.Account(account_code=account_code), amount_in_cents=100, currency='USD')
+                    try:
+                        transaction.save()
+                        declined = False
+                    except recurly.ValidationError:
+                        declined = True
+                    results[account_code] = ([account.account_code for account in recurly.Account.all()],
+                                             [account['account_code'] for account in mocurly.backend.accounts_backend.list_objects()],
+                                             mocurly.backend.current_state().serializer,
+                                             declined)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                wait_for_all(i)
+
+        mocurly.install()
+        try:
+            threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            mocurly.uninstall()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), count)
+        for i in range(count):
+            account_code = 'account{0}'.format(i)
+            serializer = 'native' if i % 2 else 'jinja2'
+            self.assertEqual(results[account_code], ([account_code], [account_code], serializer, bool(i % 2)))
+
     def test_timeout(self):
         mocurly_ = mocurly.mocurly()
         mocurly_.start()
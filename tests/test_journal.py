@@ -0,0 +1,96 @@
+import unittest
+import ssl
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+from mocurly.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def record(self, journal, method, route, pk=None, account=None, status=200):
+        journal.record(method, '/path', route, pk, account, b'', status, '')
+
+    def test_find(self):
+        journal = Journal()
+        self.record(journal, 'POST', 'POST /accounts', account='blah')
+        self.record(journal, 'GET', 'GET /accounts/:pk', pk='blah', account='blah')
+        self.record(journal, 'GET', 'GET /accounts/:pk', pk='foo', status=404)
+        self.record(journal, 'POST', 'POST /subscriptions', account='blah')
+
+        self.assertEqual(len(journal), 4)
+        self.assertEqual([entry.sequence for entry in journal.find()], [0, 1, 2, 3])
+        self.assertEqual([entry.sequence for entry in journal.find(method='GET')], [1, 2])
+        self.assertEqual([entry.sequence for entry in journal.find(method='POST', account='blah')], [0, 3])
+        self.assertEqual([entry.sequence for entry in journal.find(route='GET /accounts/:pk', pk='foo')], [2])
+        self.assertEqual(journal.find(route='POST /subscriptions', account='foo'), [])
+        self.assertEqual(journal.count(account='blah'), 3)
+        self.assertEqual(journal.count(method='GET', pk='blah'), 1)
+        self.assertEqual(journal.last(method='POST').route, 'POST /subscriptions')
+        self.assertIsNone(journal.last(method='DELETE'))
+        self.assertRaises(TypeError, journal.find, status=200)
+
+        journal.clear()
+        self.assertEqual(len(journal), 0)
+        self.assertEqual(journal.find(account='blah'), [])
+
+    def test_eviction(self):
+        journal = Journal(max_size=3)
+        for i in range(10):
+            self.record(journal, 'GET' if i % 2 else 'POST', 'GET /accounts/:pk', pk='account{0}'.format(i % 4))
+
+        self.assertEqual([entry.sequence for entry in journal], [7, 8, 9])
+        self.assertEqual([entry.sequence for entry in journal.find(method='GET')], [7, 9])
+        self.assertEqual([entry.sequence for entry in journal.find(pk='account1')], [9])
+        # the indexes only hold the entries that are still in the journal
+        self.assertEqual(sorted(journal.indexes['pk']), ['account0', 'account1', 'account3'])
+        self.assertEqual(sum(len(bucket) for bucket in journal.indexes['method'].values()), 3)
+
+    def test_disabled(self):
+        journal = Journal(max_size=0)
+        self.record(journal, 'GET', 'GET /accounts')
+        self.assertEqual(len(journal), 0)
+
+
+class TestContextJournal(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly()
+        self.mocurly_.start()
+
+    def tearDown(self):
+        self.mocurly_.stop()
+
+    def test_requests_are_journaled(self):
+        recurly.Account(account_code='blah', email='foo@bar.com').save()
+        recurly.Plan(plan_code='gold', name='Gold Plan', unit_amount_in_cents=recurly.Money(USD=1000)).save()
+        recurly.Subscription(plan_code='gold', currency='USD', account=recurly.Account(account_code='blah')).save()
+        recurly.Account.get('blah').invoices()
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'foo')
+
+        journal = self.mocurly_.journal
+        self.assertEqual(journal.count(route='POST /subscriptions', account='blah'), 1)
+        self.assertEqual(journal.count(route='GET /accounts/:pk/invoices', pk='blah'), 1)
+        self.assertEqual(journal.count(account='blah'), 4)
+
+        entry = journal.last(route='POST /subscriptions')
+        self.assertEqual(entry.method, 'POST')
+        self.assertEqual(entry.status, 200)
+        self.assertIn(b'<plan_code>gold</plan_code>', entry.request_body)
+        self.assertIn('<state>active</state>', entry.response_body)
+
+        entry = journal.last(pk='foo')
+        self.assertEqual((entry.route, entry.status, entry.account), ('GET /accounts/:pk', 404, None))
+
+    def test_timeouts_are_journaled(self):
+        self.mocurly_.start_timeout()
+        self.assertRaises(ssl.SSLError, recurly.Account.get, 'blah')
+        self.mocurly_.stop_timeout()
+        self.assertEqual(self.mocurly_.journal.last().status, 'timeout')
+        self.assertEqual(self.mocurly_.journal.last().pk, 'blah')
+
+    def test_journal_size(self):
+        context = mocurly.mocurly(journal_size=2)
+        with context:
+            for i in range(3):
+                recurly.Account(account_code='account{0}'.format(i)).save()
+        self.assertEqual([entry.account for entry in context.journal], ['account1', 'account2'])
@@ -0,0 +1,68 @@
+import unittest
+import ssl
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+import mocurly.metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly()
+        self.mocurly_.start()
+
+    def tearDown(self):
+        self.mocurly_.stop()
+
+    def test_stats(self):
+        recurly.Account(account_code='blah', email='foo@bar.com').save()
+        recurly.Account.get('blah')
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'foo')
+
+        stats = self.mocurly_.stats()
+        self.assertEqual(sorted(stats), ['GET /accounts/:pk', 'POST /accounts'])
+        retrieve_stats = stats['GET /accounts/:pk']
+        self.assertEqual(retrieve_stats['count'], 2)
+        self.assertEqual(retrieve_stats['statuses'], {200: 1, 404: 1})
+        self.assertTrue(retrieve_stats['response_bytes'] > 0)
+
+        create_stats = stats['POST /accounts']
+        self.assertEqual(create_stats['statuses'], {200: 1})
+        for phase in mocurly.metrics.PHASES:
+            latency = create_stats['latency'][phase]
+            self.assertEqual(latency['count'], 1)
+            self.assertEqual(latency['buckets'][-1], (float('inf'), 1))
+        self.assertTrue(create_stats['latency']['deserialize']['sum'] > 0)
+        self.assertTrue(create_stats['latency']['serialize']['sum'] > 0)
+
+    def test_timeout_and_unmatched_requests(self):
+        self.mocurly_.start_timeout()
+        self.assertRaises(ssl.SSLError, recurly.Account.get, 'blah')
+        self.mocurly_.stop_timeout()
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'blah/foo/bar/baz')
+
+        stats = self.mocurly_.stats()
+        self.assertEqual(stats['GET /accounts/:pk']['statuses'], {'timeout': 1})
+        self.assertEqual(stats[mocurly.metrics.UNMATCHED_ROUTE]['statuses'], {404: 1})
+
+    def test_contexts_have_their_own_metrics(self):
+        recurly.Account(account_code='blah').save()
+        with mocurly.mocurly():
+            recurly.Account(account_code='foo').save()
+        self.assertEqual(self.mocurly_.stats()['POST /accounts']['count'], 1)
+
+    def test_prometheus(self):
+        metrics = mocurly.metrics.Metrics()
+        metrics.record('GET /accounts/:pk', 200, 10, {'total': 0.002, 'deserialize': 0.0, 'handler': 0.0015, 'serialize': 0.0005})
+        metrics.record('GET /accounts/:pk', 404, 0, {'total': 0.2, 'deserialize': 0.0, 'handler': 0.2, 'serialize': 0.0})
+        text = metrics.to_prometheus()
+        self.assertIn('mocurly_requests_total{route="GET /accounts/:pk",status="200"} 1\n', text)
+        self.assertIn('mocurly_requests_total{route="GET /accounts/:pk",status="404"} 1\n', text)
+        self.assertIn('mocurly_response_bytes_total{route="GET /accounts/:pk"} 10\n', text)
+        self.assertIn('mocurly_request_duration_seconds_bucket{route="GET /accounts/:pk",phase="total",le="0.0025"} 1\n', text)
+        self.assertIn('mocurly_request_duration_seconds_bucket{route="GET /accounts/:pk",phase="total",le="+Inf"} 2\n', text)
+        self.assertIn('mocurly_request_duration_seconds_count{route="GET /accounts/:pk",phase="handler"} 2\n', text)
+
+        metrics.clear()
+        self.assertEqual(metrics.stats(), {})
@@ -0,0 +1,87 @@
+import unittest
+import random
+import socket
+import time
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+from mocurly.network import NetworkModel, Fixed, Uniform, LogNormal, Percentiles
+
+
+class TestNetworkModel(unittest.TestCase):
+    def test_distributions(self):
+        rng = random.Random(0)
+        self.assertEqual(Fixed(0.1).sample(rng), 0.1)
+        for _ in range(100):
+            self.assertTrue(0.1 <= Uniform(0.1, 0.2).sample(rng) <= 0.2)
+            self.assertTrue(LogNormal(0.1, 0.5).sample(rng) > 0)
+
+        samples = sorted(LogNormal(0.1, 0.5).sample(rng) for _ in range(1001))
+        self.assertAlmostEqual(samples[500], 0.1, delta=0.01)
+
+    def test_percentiles(self):
+        percentiles = Percentiles({50: 0.1, 90: 0.5, 99: 2.0})
+        rng = random.Random(0)
+        samples = sorted(percentiles.sample(rng) for _ in range(1000))
+        self.assertEqual(samples[0], 0.1)
+        self.assertEqual(samples[-1], 2.0)
+        self.assertTrue(0.1 < samples[700] < 0.5)
+        self.assertTrue(0.5 < samples[950] < 2.0)
+        self.assertRaises(ValueError, Percentiles, {})
+
+    def test_delay(self):
+        network = NetworkModel(latency=0.1, routes={'GET /accounts': Uniform(1, 2)}, bandwidth=1000)
+        self.assertEqual(network.delay('GET /accounts/:pk', 0), 0.1)
+        self.assertAlmostEqual(network.delay('GET /accounts/:pk', 500), 0.6)
+        self.assertTrue(1.5 <= network.delay('GET /accounts', 500) <= 2.5)
+        self.assertEqual(NetworkModel().delay('GET /accounts', 500), 0)
+
+    def test_seeded(self):
+        def delays(seed):
+            network = NetworkModel(latency=LogNormal(0.1, 1), seed=seed)
+            return [network.delay('GET /accounts', 0) for _ in range(10)]
+        self.assertEqual(delays(42), delays(42))
+        self.assertNotEqual(delays(42), delays(43))
+
+
+class TestLatency(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly()
+        self.mocurly_.start()
+        recurly.Account(account_code='blah').save()
+
+    def tearDown(self):
+        recurly.SOCKET_TIMEOUT_SECONDS = None
+        self.mocurly_.stop()
+
+    def time_request(self):
+        start = time.time()
+        recurly.Account.get('blah')
+        return time.time() - start
+
+    def test_latency(self):
+        self.mocurly_.start_latency(NetworkModel(routes={'GET /accounts/:pk': 0.2}))
+        self.assertTrue(self.time_request() >= 0.2)
+        self.mocurly_.stop_latency()
+        self.assertTrue(self.time_request() < 0.2)
+
+    def test_bandwidth(self):
+        self.mocurly_.start_latency(NetworkModel(bandwidth=5000))
+        self.assertTrue(self.time_request() >= 0.1)
+
+    def test_client_timeout(self):
+        recurly.SOCKET_TIMEOUT_SECONDS = 0.05
+        self.mocurly_.start_latency(NetworkModel(routes={'PUT /accounts/:pk': 0.2}))
+        account = recurly.Account.get('blah')
+        account.email = 'foo@bar.com'
+        self.assertRaises(socket.timeout, account.save)
+        # Like a real timeout, the request was handled nonetheless
+        self.mocurly_.stop_latency()
+        time.sleep(0.2)
+        self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+
+    def test_option(self):
+        with mocurly.mocurly(network=NetworkModel(latency=0.2)):
+            recurly.Account(account_code='blah').save()
+            self.assertTrue(self.time_request() >= 0.2)
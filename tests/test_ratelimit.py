@@ -0,0 +1,85 @@
+import unittest
+import base64
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+from mocurly.ratelimit import RateLimiter, ManualClock, api_key_of
+
+
+class FakeRequest(object):
+    def __init__(self, authorization=None):
+        self.headers = {'Authorization': authorization} if authorization else {}
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = ManualClock(1000)
+        limiter = RateLimiter(limit=10, period=10, clock=clock)
+        for remaining in range(9, -1, -1):
+            allowed, headers = limiter.acquire('blah')
+            self.assertTrue(allowed)
+            self.assertEqual(headers['X-RateLimit-Remaining'], str(remaining))
+        self.assertEqual(headers['X-RateLimit-Limit'], '10')
+        self.assertEqual(headers['X-RateLimit-Reset'], '1010')
+
+        allowed, headers = limiter.acquire('blah')
+        self.assertFalse(allowed)
+        self.assertEqual(headers['X-RateLimit-Remaining'], '0')
+        # Other API keys have their own bucket
+        self.assertTrue(limiter.acquire('foo')[0])
+
+        # The bucket refills at one token per second
+        clock.advance(2.5)
+        self.assertEqual(limiter.remaining('blah'), 2)
+        clock.advance(60)
+        self.assertEqual(limiter.remaining('blah'), 10)
+
+        limiter.acquire('blah')
+        limiter.reset()
+        self.assertEqual(limiter.remaining('blah'), 10)
+
+    def test_api_key_of(self):
+        basic = 'Basic ' + base64.b64encode(b'blah:').decode('ascii')
+        self.assertEqual(api_key_of(FakeRequest(basic)), 'blah')
+        self.assertEqual(api_key_of(FakeRequest('Bearer foo')), 'foo')
+        self.assertIsNone(api_key_of(FakeRequest()))
+
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.mocurly()
+        self.mocurly_.start()
+        self.clock = ManualClock(1000)
+        self.mocurly_.start_rate_limit(RateLimiter(limit=3, period=60, clock=self.clock))
+
+    def tearDown(self):
+        recurly.API_KEY = 'blah'
+        self.mocurly_.stop()
+
+    def rate_limit_headers(self):
+        response = recurly.Resource.http_request(recurly.base_uri() + 'accounts/blah')
+        response.read()
+        return response.getheader('X-RateLimit-Limit'), response.getheader('X-RateLimit-Remaining')
+
+    def test_rate_limit(self):
+        recurly.Account(account_code='blah').save()
+        self.assertEqual(self.rate_limit_headers(), ('3', '1'))
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'foo')
+
+        with self.assertRaises(recurly.errors.UnexpectedStatusError) as cm:
+            recurly.Account.get('blah')
+        self.assertEqual(cm.exception.status, 429)
+        self.assertEqual(cm.exception.symbol, 'rate_limit_exceeded')
+        self.assertEqual(self.mocurly_.stats()['GET /accounts/:pk']['statuses'], {200: 1, 404: 1, 429: 1})
+
+        # Requests with another API key are not limited
+        recurly.API_KEY = 'foo'
+        recurly.Account.get('blah')
+        recurly.API_KEY = 'blah'
+
+        self.clock.advance(20)
+        self.assertEqual(self.rate_limit_headers(), ('3', '0'))
+
+        self.mocurly_.stop_rate_limit()
+        recurly.Account.get('blah')
@@ -0,0 +1,50 @@
+import unittest
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly.core
+from mocurly.router import Router
+from mocurly.endpoints import endpoints
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = Router(endpoints)
+
+    def resolve(self, method, path):
+        resolved = self.router.resolve(method, recurly.base_uri() + path)
+        if resolved is None:
+            return None
+        route, args = resolved
+        return route.name, args
+
+    def test_crud_routes(self):
+        self.assertEqual(self.resolve('GET', 'accounts'), ('GET /accounts', []))
+        self.assertEqual(self.resolve('HEAD', 'accounts'), ('HEAD /accounts', []))
+        self.assertEqual(self.resolve('POST', 'accounts'), ('POST /accounts', []))
+        self.assertEqual(self.resolve('GET', 'accounts/blah'), ('GET /accounts/:pk', ['blah']))
+        self.assertEqual(self.resolve('PUT', 'accounts/blah'), ('PUT /accounts/:pk', ['blah']))
+        self.assertEqual(self.resolve('DELETE', 'accounts/blah'), ('DELETE /accounts/:pk', ['blah']))
+
+    def test_details_routes(self):
+        self.assertEqual(self.resolve('GET', 'accounts/blah/invoices'), ('GET /accounts/:pk/invoices', ['blah']))
+        self.assertEqual(self.resolve('GET', 'accounts/blah/redemptions'), ('GET /accounts/:pk/redemptions', ['blah']))
+        self.assertEqual(self.resolve('HEAD', 'accounts/blah/invoices'), ('HEAD /accounts/:pk/invoices', ['blah']))
+        self.assertIsNone(self.resolve('HEAD', 'accounts/blah/billing_info'))
+        self.assertEqual(self.resolve('DELETE', 'accounts/blah/redemptions/foo'), ('DELETE /accounts/:pk/redemptions/:pk', ['blah', 'foo']))
+        self.assertEqual(self.resolve('PUT', 'subscriptions/foo/cancel'), ('PUT /subscriptions/:pk/cancel', ['foo']))
+
+    def test_querystring_and_quoting(self):
+        self.assertEqual(self.resolve('GET', 'accounts/blah%2Bfoo?per_page=10'), ('GET /accounts/:pk', ['blah+foo']))
+
+    def test_unknown_routes(self):
+        self.assertIsNone(self.resolve('GET', 'foo'))
+        self.assertIsNone(self.resolve('PATCH', 'accounts'))
+        self.assertIsNone(self.resolve('GET', 'accounts/'))
+        self.assertIsNone(self.resolve('GET', 'accounts/blah/foo'))
+        self.assertIsNone(self.resolve('GET', 'accounts/blah/redemptions/foo/bar'))
+        self.assertIsNone(self.router.resolve('GET', 'https://example.com/accounts'))
+
+    def test_unknown_route_responds_not_found(self):
+        with mocurly.core.mocurly():
+            self.assertRaises(recurly.NotFoundError, recurly.Resource.element_for_url, recurly.base_uri() + 'foo')
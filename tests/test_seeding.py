@@ -0,0 +1,136 @@
+import unittest
+import datetime
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+import mocurly.core
+import mocurly.backend
+
+# Fields that are generated (ids and timestamps), and thus differ between runs
+VOLATILE_FIELDS = ('uuid', 'invoice', 'transactions', 'line_items', 'subscription', 'hosted_login_token',
+                   'created_at', 'updated_at', 'activated_at', 'trial_started_at', 'current_period_started_at', 'current_period_ends_at',
+                   'start_date', 'end_date')
+
+
+def backends_state():
+    return [[dict((k, v) for k, v in record.items() if k not in VOLATILE_FIELDS)
+             for record in backend.list_objects()]
+            for backend in mocurly.backend.backends]
+
+
+class TestSeeding(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.core.mocurly()
+        self.mocurly_.start()
+
+        self.accounts_data = [
+                {
+                    'account_code': 'blah',
+                    'email': 'foo@bar.com',
+                    'first_name': 'Foo',
+                    'billing_info': {'first_name': 'Foo', 'last_name': 'Bar', 'number': '4111-1111-1111-1111', 'currency': 'USD'}
+                },
+                {
+                    'account_code': 'foo',
+                    'email': 'bar@foo.com',
+                    'tax_exempt': False
+                }
+            ]
+        self.plans_data = [
+                {
+                    'plan_code': 'gold',
+                    'name': 'Gold Plan',
+                    'unit_amount_in_cents': recurly.Money(USD=1000, EUR=800)
+                },
+                {
+                    'plan_code': 'trial',
+                    'name': 'Trial Plan',
+                    'unit_amount_in_cents': recurly.Money(USD=500)
+                }
+            ]
+        self.add_ons_data = [
+                {
+                    'plan_code': 'gold',
+                    'add_on_code': 'extra',
+                    'name': 'Extra',
+                    'unit_amount_in_cents': recurly.Money(USD=100)
+                }
+            ]
+        self.coupons_data = [
+                {
+                    'coupon_code': 'discount',
+                    'name': 'Discount',
+                    'discount_type': 'percent',
+                    'discount_percent': 10
+                }
+            ]
+        self.subscriptions_data = [
+                {
+                    'plan_code': 'gold',
+                    'account': {'account_code': 'blah'},
+                    'currency': 'USD',
+                    'subscription_add_ons': [{'add_on_code': 'extra', 'quantity': 1}]
+                },
+                {
+                    'plan_code': 'trial',
+                    'account': {'account_code': 'foo'},
+                    'currency': 'USD',
+                    'trial_ends_at': datetime.datetime(2100, 1, 1)
+                }
+            ]
+
+    def tearDown(self):
+        self.mocurly_.stop()
+
+    def test_seed(self):
+        mocurly.seed(accounts=self.accounts_data,
+                     plans=self.plans_data,
+                     add_ons=self.add_ons_data,
+                     coupons=self.coupons_data,
+                     subscriptions=self.subscriptions_data)
+
+        self.assertEqual(len(recurly.Account.all()), 2)
+        self.assertEqual(recurly.Account.get('blah').billing_info.last_four, '1111')
+        self.assertEqual(recurly.Plan.get('gold').unit_amount_in_cents['EUR'], 800)
+        self.assertEqual(len(recurly.Plan.get('gold').add_ons()), 1)
+        self.assertEqual(recurly.Coupon.get('discount').discount_percent, 10)
+
+        subscription = recurly.Account.get('blah').subscriptions()[0]
+        self.assertEqual(subscription.state, 'active')
+        invoice = subscription.invoice()
+        self.assertEqual(invoice.total_in_cents, 1100)
+        self.assertEqual(len(invoice.line_items), 2)
+        self.assertEqual(recurly.Account.get('foo').invoices()[0].total_in_cents, 0)
+
+        # the given data is left untouched
+        self.assertEqual(self.subscriptions_data[0]['account'], {'account_code': 'blah'})
+
+    def test_seed_matches_api(self):
+        for account in self.accounts_data:
+            account = account.copy()
+            if 'billing_info' in account:
+                account['billing_info'] = recurly.BillingInfo(**account['billing_info'])
+            recurly.Account(**account).save()
+        for plan in self.plans_data:
+            recurly.Plan(**plan).save()
+        for add_on in self.add_ons_data:
+            add_on = add_on.copy()
+            recurly.Plan.get(add_on.pop('plan_code')).create_add_on(recurly.AddOn(**add_on))
+        for coupon in self.coupons_data:
+            recurly.Coupon(**coupon).save()
+        for subscription in self.subscriptions_data:
+            subscription = subscription.copy()
+            subscription['account'] = recurly.Account(**subscription['account'])
+            if 'subscription_add_ons' in subscription:
+                subscription['subscription_add_ons'] = [recurly.SubscriptionAddOn(**add_on) for add_on in subscription['subscription_add_ons']]
+            recurly.Subscription(**subscription).save()
+        api_state = backends_state()
+
+        mocurly.core.reset()
+        mocurly.seed(accounts=self.accounts_data,
+                     plans=self.plans_data,
+                     add_ons=self.add_ons_data,
+                     coupons=self.coupons_data,
+                     subscriptions=self.subscriptions_data)
+        self.assertEqual(backends_state(), api_state)
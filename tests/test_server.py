@@ -0,0 +1,155 @@
+import unittest
+import socket
+import subprocess
+import sys
+import threading
+import time
+import recurly
+recurly.API_KEY = 'blah'
+from six.moves import http_client
+
+import mocurly
+import mocurly.backend
+import mocurly.errors
+from mocurly.server import MocurlyServer, configure_client
+from mocurly.ratelimit import RateLimiter, ManualClock
+from mocurly.network import NetworkModel
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.recurly_config = (recurly.BASE_URI, recurly.SUBDOMAIN, recurly.VALID_DOMAINS)
+        self.mocurly_ = mocurly.mocurly()
+        self.server = MocurlyServer(('127.0.0.1', 0), self.mocurly_)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+        self.base_account_data = {
+                'account_code': 'blah',
+                'email': 'foo@bar.com',
+                'first_name': 'Foo',
+                'last_name': 'Bar'
+            }
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        recurly.BASE_URI, recurly.SUBDOMAIN, recurly.VALID_DOMAINS = self.recurly_config
+
+    def test_client(self):
+        self.assertEqual(recurly.base_uri(), 'http://127.0.0.1:{0}/v2/'.format(self.server.server_address[1]))
+
+        recurly.Account(**self.base_account_data).save()
+        self.assertTrue(mocurly.backend.accounts_backend.has_object('blah'))
+        account = recurly.Account.get('blah')
+        self.assertEqual(account.email, 'foo@bar.com')
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'foo')
+
+        for i in range(5):
+            recurly.Account(account_code='account{0}'.format(i)).save()
+        self.assertEqual(len(list(recurly.Account.all(per_page=2))), 6)
+        self.assertEqual(recurly.Account.count(), 6)
+
+        self.mocurly_.register_transaction_failure('blah', mocurly.errors.TRANSACTION_DECLINED)
+        transaction = recurly.Transaction(account=recurly.Account(account_code='blah'), amount_in_cents=100, currency='USD')
+        self.assertRaises(recurly.ValidationError, transaction.save)
+
+    def test_keep_alive(self):
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        for i in range(3):
+            connection.request('GET', '/v2/accounts')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader('X-Records'), '0')
+            response.read()
+        connection.close()
+
+    def test_timeout(self):
+        self.mocurly_.start_timeout()
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        connection.request('GET', '/v2/accounts')
+        self.assertRaises((http_client.HTTPException, socket.error), connection.getresponse)
+        connection.close()
+
+    def test_timeout_filter(self):
+        self.mocurly_.start_timeout(lambda request: 'X-Timeout' in request.headers and request.parsed_body == 'body')
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        connection.request('POST', '/v2/accounts', body='body', headers={'X-Timeout': '1'})
+        self.assertRaises((http_client.HTTPException, socket.error), connection.getresponse)
+        connection.close()
+
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        connection.request('GET', '/v2/accounts')
+        self.assertEqual(connection.getresponse().status, 200)
+        connection.close()
+
+    def test_metrics(self):
+        recurly.Account(**self.base_account_data).save()
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.getheader('Content-Type').startswith('text/plain'))
+        self.assertIn(b'mocurly_requests_total{route="POST /accounts",status="200"} 1\n', response.read())
+        connection.close()
+
+    def test_rate_limit(self):
+        self.mocurly_.start_rate_limit(RateLimiter(limit=1, clock=ManualClock()))
+        recurly.Account(**self.base_account_data).save()
+        response = recurly.Resource.http_request(recurly.base_uri() + 'accounts/blah')
+        self.assertEqual(response.status, 429)
+        self.assertEqual(response.getheader('X-RateLimit-Remaining'), '0')
+        self.assertIn(b'rate_limit_exceeded', response.read())
+
+    def test_bandwidth(self):
+        for i in range(10):
+            recurly.Account(account_code='account{0}'.format(i), email='foo@bar.com').save()
+        self.mocurly_.start_latency(NetworkModel(bandwidth=40000))
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        start = time.time()
+        connection.request('GET', '/v2/accounts')
+        response = connection.getresponse()
+        first_byte = time.time() - start
+        body = response.read()
+        transfer = time.time() - start
+        connection.close()
+
+        # the body trickles in, rather than arriving all at once after the
+        # time to transfer it
+        self.assertTrue(transfer >= len(body) / 40000.0 * 0.9)
+        self.assertTrue(first_byte < transfer / 2)
+
+    def test_internal_error(self):
+        connection = http_client.HTTPConnection(*self.server.server_address)
+        connection.request('PUT', '/v2/subscriptions/nope/cancel')
+        response = connection.getresponse()
+        self.assertEqual(response.status, 500)
+        self.assertIn(b'internal_server_error', response.read())
+        connection.close()
+
+
+class TestServeCommand(unittest.TestCase):
+    def setUp(self):
+        self.recurly_config = (recurly.BASE_URI, recurly.SUBDOMAIN, recurly.VALID_DOMAINS)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.process = subprocess.Popen([sys.executable, '-m', 'mocurly', 'serve', '--port', str(self.port)],
+                                        stdout=subprocess.PIPE)
+        # wait for the server to announce itself
+        self.process.stdout.readline()
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+        recurly.BASE_URI, recurly.SUBDOMAIN, recurly.VALID_DOMAINS = self.recurly_config
+
+    def test_serve(self):
+        configure_client(('127.0.0.1', self.port))
+        recurly.Account(account_code='blah', email='foo@bar.com').save()
+        self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+        # the state lives in the server process
+        self.assertFalse(mocurly.backend.accounts_backend.has_object('blah'))
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+import recurly
+recurly.API_KEY = 'blah'
+
+import mocurly
+import mocurly.core
+import mocurly.backend
+import mocurly.errors
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.mocurly_ = mocurly.core.mocurly()
+        self.mocurly_.start()
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.snapshot_dir, 'snapshot')
+
+        recurly.Account(account_code='blah', email='foo@bar.com').save()
+        recurly.Account(account_code='foo', email='bar@foo.com').save()
+        account = recurly.Account(account_code='blah')
+        recurly.Transaction(account=account, amount_in_cents=100, currency='USD').save()
+        self.mocurly_.register_transaction_failure('foo', mocurly.errors.TRANSACTION_DECLINED)
+
+    def tearDown(self):
+        self.mocurly_.stop()
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_save_and_load(self):
+        account_xml = recurly.Account.get('blah').as_log_output()
+        invoices = recurly.Account.get('blah').invoices()
+        mocurly.save_snapshot(self.snapshot_path)
+        mocurly.core.reset()
+        self.assertRaises(recurly.NotFoundError, recurly.Account.get, 'blah')
+
+        mocurly.load_snapshot(self.snapshot_path)
+        self.assertEqual(recurly.Account.get('blah').as_log_output(), account_xml)
+        self.assertEqual(len(recurly.Account.all()), 2)
+        loaded_invoices = recurly.Account.get('blah').invoices()
+        self.assertEqual([invoice.invoice_number for invoice in loaded_invoices], [invoices[0].invoice_number])
+        self.assertEqual(loaded_invoices[0].transactions[0].amount_in_cents, 100)
+
+        # the invoice counter and the registered failures carry over
+        recurly.Transaction(account=recurly.Account(account_code='blah'), amount_in_cents=200, currency='USD').save()
+        self.assertEqual(sorted(invoice.invoice_number for invoice in recurly.Account.get('blah').invoices()),
+                         [invoices[0].invoice_number, invoices[0].invoice_number + 1])
+        self.assertRaises(recurly.ValidationError,
+                          recurly.Transaction(account=recurly.Account(account_code='foo'), amount_in_cents=200, currency='USD').save)
+
+    def test_records_are_decoded_lazily(self):
+        mocurly.save_snapshot(self.snapshot_path)
+        mocurly.core.reset()
+        mocurly.load_snapshot(self.snapshot_path)
+
+        records = mocurly.backend.accounts_backend.datastore.base
+        self.assertEqual(records.decoded, {})
+        self.assertTrue(mocurly.backend.accounts_backend.has_object('blah'))
+        self.assertEqual(mocurly.backend.accounts_backend.get_object('blah')['email'], 'foo@bar.com')
+        self.assertEqual(list(records.decoded), ['blah'])
+
+    def test_writes_after_load(self):
+        mocurly.save_snapshot(self.snapshot_path)
+        mocurly.core.reset()
+        mocurly.load_snapshot(self.snapshot_path)
+
+        recurly.Account(account_code='baz').save()
+        account = recurly.Account.get('blah')
+        account.email = 'baz@foo.com'
+        account.save()
+        mocurly.backend.accounts_backend.delete_object('foo')
+
+        self.assertEqual(recurly.Account.get('blah').email, 'baz@foo.com')
+        self.assertEqual([account.account_code for account in recurly.Account.all()], ['blah', 'baz'])
+        self.assertEqual(len(mocurly.backend.accounts_backend.datastore), 2)
+
+        # the snapshot itself is left untouched
+        mocurly.load_snapshot(self.snapshot_path)
+        self.assertEqual(recurly.Account.get('blah').email, 'foo@bar.com')
+        self.assertEqual([account.account_code for account in recurly.Account.all()], ['blah', 'foo'])
+
+    def test_not_a_snapshot(self):
+        with open(self.snapshot_path, 'wb') as f:
+            f.write(b'foo' * 10)
+        self.assertRaises(ValueError, mocurly.load_snapshot, self.snapshot_path)
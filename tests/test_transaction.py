@@ -1,9 +1,11 @@
 import unittest
+import threading
 import recurly
 recurly.API_KEY = 'blah'
 
 import mocurly.core
 import mocurly.backend
+import mocurly.endpoints
 import mocurly.errors
 
 FULL = 0
@@ -259,6 +261,61 @@ class TestTransaction(unittest.TestCase):
         self.assertEqual(len(transactions), 2)
         self.assertEqual(set([transaction.uuid for transaction in transactions]), set(['1234', 'abcd']))
 
+    def test_transaction_list_hydrates_account_once(self):
+        for transaction_id in ['1234', 'abcd', 'efgh']:
+            self._directly_create_transaction_without_invoice(transaction_id=transaction_id)
+
+        account_reads = []
+        accounts_backend = mocurly.backend.accounts_backend
+        original_read = accounts_backend._read
+        accounts_backend._read = lambda record: account_reads.append(record) or original_read(record)
+        try:
+            transactions = recurly.Transaction.all()
+        finally:
+            del accounts_backend._read
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual(set(transaction.details.account.account_code for transaction in transactions), set(['blah']))
+        self.assertEqual(len(account_reads), 1)
+
+    def test_concurrent_transactions(self):
+        mocurly.backend.accounts_backend.add_object('foo', dict(self.base_account_data, account_code='foo', uuid='foo'))
+        raw = mocurly.endpoints.BaseRecurlyEndpoint.RAW
+        errors = []
+        done = threading.Event()
+
+        def create_transactions(account_code):
+            try:
+                for i in range(100):
+                    transaction = dict(self.base_transaction_data, account={'account_code': account_code})
+                    mocurly.endpoints.transactions_endpoint.create(transaction, format=raw)
+            except Exception as exc:
+                errors.append(exc)
+
+        def list_invoices():
+            # invoices are never seen before they are complete
+            try:
+                while not done.is_set():
+                    for invoice in mocurly.endpoints.accounts_endpoint.get_invoices_list('blah', format=raw):
+                        self.assertIn('line_items', invoice)
+            except Exception as exc:
+                errors.append(exc)
+
+        writers = [threading.Thread(target=create_transactions, args=(account_code,)) for account_code in ['blah', 'blah', 'foo', 'foo']]
+        reader = threading.Thread(target=list_invoices)
+        reader.start()
+        for thread in writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        reader.join()
+
+        self.assertEqual(errors, [])
+        invoices = mocurly.backend.invoices_backend.list_objects()
+        self.assertEqual(len(invoices), 400)
+        self.assertEqual(len(set(invoice['invoice_number'] for invoice in invoices)), 400)
+        self.assertEqual(len(mocurly.backend.invoices_backend.list_objects_by('account', 'foo')), 200)
+
 
     def _directly_create_transaction_without_invoice(self, transaction_id='1234'):
         """
@@ -0,0 +1,229 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mocurly.core
+import mocurly.backend
+import mocurly.utils
+import mocurly.writer
+
+
+class TestSerialization(unittest.TestCase):
+    def setUp(self):
+        self.base_account_data = {
+                'account_code': 'blah',
+                'email': 'foo@bar.com',
+                'first_name': 'Foo',
+                'last_name': 'Bar',
+                'hosted_login_token': 'abcd1234',
+                'created_at': '2014-08-11',
+                'uris': {'object_uri': 'https://api.recurly.com/v2/accounts/blah'}
+            }
+
+    def test_render_functions_are_cached(self):
+        render = mocurly.utils.get_render_function('account.xml')
+        self.assertIs(mocurly.utils.get_render_function('account.xml'), render)
+        self.assertEqual(mocurly.utils.serialize('account.xml', 'account', self.base_account_data),
+                         render(account=self.base_account_data))
+
+    def test_precompiled_templates(self):
+        expected_account_xml = mocurly.utils.serialize('account.xml', 'account', self.base_account_data)
+
+        target_dir = tempfile.mkdtemp()
+        try:
+            target = os.path.join(target_dir, 'templates.zip')
+            mocurly.utils.compile_templates(target)
+            mocurly.utils.use_precompiled_templates(target)
+            try:
+                self.assertEqual(mocurly.utils.serialize('account.xml', 'account', self.base_account_data), expected_account_xml)
+            finally:
+                mocurly.utils.use_precompiled_templates(None)
+        finally:
+            shutil.rmtree(target_dir)
+        self.assertEqual(mocurly.utils.serialize('account.xml', 'account', self.base_account_data), expected_account_xml)
+
+
+class TestNativeWriter(unittest.TestCase):
+    def setUp(self):
+        self.account = {
+                'account_code': 'blah',
+                'state': 'active',
+                'email': 'foo@bar.com',
+                'first_name': 'Foo & Co',
+                'last_name': '<Bar>',
+                'tax_exempt': False,
+                'hosted_login_token': 'abcd1234',
+                'created_at': '2014-08-11',
+                'uris': {
+                    'object_uri': 'https://api.recurly.com/v2/accounts/blah',
+                    'billing_info_uri': 'https://api.recurly.com/v2/accounts/blah/billing_info'
+                }
+            }
+        self.transaction = {
+                'uuid': 'foo',
+                'type': 'credit_card',
+                'action': 'purchase',
+                'amount_in_cents': 1000,
+                'currency': 'USD',
+                'status': 'success',
+                'test': True,
+                'voidable': True,
+                'cvv_result': 'M',
+                'account': self.account,
+                'uris': {
+                    'object_uri': 'https://api.recurly.com/v2/transactions/foo',
+                    'invoice_uri': 'https://api.recurly.com/v2/invoices/1000'
+                }
+            }
+
+    def assertSameXml(self, template, object_type, obj):
+        expected = mocurly.utils.serialize(template, object_type, obj)
+        self.assertEqual(mocurly.writer.render(template, obj), expected)
+
+    def test_account(self):
+        self.assertSameXml('account.xml', 'account', self.account)
+        self.account['address'] = {'address1': '123 Main St', 'city': 'San Francisco'}
+        del self.account['uris']['billing_info_uri']
+        self.assertSameXml('account.xml', 'account', self.account)
+
+    def test_transaction(self):
+        self.assertSameXml('transaction.xml', 'transaction', self.transaction)
+        self.transaction['status'] = 'declined'
+        self.transaction['transaction_error'] = {
+                'error_code': 'fraud_ip_address',
+                'error_category': 'fraud',
+                'merchant': 'Fraud "detected"',
+                'customer': 'Declined'
+            }
+        self.assertSameXml('transaction.xml', 'transaction', self.transaction)
+
+    def test_invoice(self):
+        adjustment = {
+                'uuid': 'bar',
+                'type': 'charge',
+                'description': 'Charge',
+                'unit_amount_in_cents': 1000,
+                'tax_exempt': False,
+                'end_date': '2014-09-11',
+                'uris': {'object_uri': 'https://api.recurly.com/v2/adjustments/bar'}
+            }
+        invoice = {
+                'uuid': '1000',
+                'invoice_number': '1000',
+                'line_items': [adjustment, adjustment],
+                'transactions': [self.transaction],
+                'uris': {'object_uri': 'https://api.recurly.com/v2/invoices/1000'}
+            }
+        self.assertSameXml('invoice.xml', 'invoice', invoice)
+
+    def test_plan_and_add_on(self):
+        plan = {
+                'plan_code': 'gold',
+                'name': 'Gold',
+                'unit_amount_in_cents': {'USD': 1000, 'EUR': 800},
+                'uris': {'object_uri': 'https://api.recurly.com/v2/plans/gold'}
+            }
+        self.assertSameXml('plan.xml', 'plan', plan)
+        plan['setup_fee_in_cents'] = {'USD': 100}
+        self.assertSameXml('plan.xml', 'plan', plan)
+
+        add_on = {
+                'add_on_code': 'extra',
+                'display_quantity_on_hosted_page': True,
+                'unit_amount_in_cents': {'USD': 100},
+                'uris': {'object_uri': 'https://api.recurly.com/v2/plans/gold/add_ons/extra'}
+            }
+        self.assertSameXml('add_on.xml', 'add_on', add_on)
+
+    def test_coupon_and_redemption(self):
+        coupon = {
+                'coupon_code': 'off',
+                'discount_type': 'percent',
+                'discount_percent': 10,
+                'applies_to_all_plans': True,
+                'uris': {'object_uri': 'https://api.recurly.com/v2/coupons/off'}
+            }
+        self.assertSameXml('coupon.xml', 'coupon', coupon)
+        coupon.update({
+                'discount_type': 'dollars',
+                'discount_in_cents': {'USD': 100},
+                'max_redemptions': 10,
+                'applies_to_all_plans': False,
+                'plan_codes': ['gold', 'silver']
+            })
+        self.assertSameXml('coupon.xml', 'coupon', coupon)
+
+        redemption = {
+                'coupon': coupon,
+                'currency': 'USD',
+                'uris': {'object_uri': 'https://api.recurly.com/v2/accounts/blah/redemptions/foo'}
+            }
+        self.assertSameXml('redemption.xml', 'redemption', redemption)
+
+    def test_subscription_and_billing_info(self):
+        subscription = {
+                'uuid': 'foo',
+                'plan': {'plan_code': 'gold'},
+                'quantity': 1,
+                'subscription_add_ons': [{'add_on_code': 'extra', 'quantity': 2, 'unit_amount_in_cents': 100}],
+                'canceled_at': '2014-08-11',
+                'uris': {'object_uri': 'https://api.recurly.com/v2/subscriptions/foo'}
+            }
+        self.assertSameXml('subscription.xml', 'subscription', subscription)
+
+        billing_info = {
+                'first_name': 'Foo',
+                'year': 2020,
+                'month': 1,
+                'uris': {'object_uri': 'https://api.recurly.com/v2/accounts/blah/billing_info'}
+            }
+        self.assertSameXml('billing_info.xml', 'billing_info', billing_info)
+
+    def test_list(self):
+        expected = mocurly.utils.serialize_list('account.xml', 'accounts', 'account', [self.account, self.account])
+        self.assertEqual(mocurly.writer.render_list('account.xml', 'accounts', [self.account, self.account]), expected)
+
+    def test_serializer_selection(self):
+        self.assertRaises(ValueError, mocurly.utils.set_serializer, 'foo')
+        with mocurly.core.mocurly(serializer='native'):
+            self.assertEqual(mocurly.backend.current_state().serializer, 'native')
+            with mocurly.core.mocurly():
+                self.assertEqual(mocurly.backend.current_state().serializer, 'jinja2')
+            self.assertEqual(mocurly.backend.current_state().serializer, 'native')
+        self.assertEqual(mocurly.backend.current_state().serializer, 'jinja2')
+
+
+class TestDeserialization(unittest.TestCase):
+    def test_deserialize_item(self):
+        xml = ('<?xml version="1.0" encoding="UTF-8"?>'
+               '<account><account_code>blah</account_code><email nil="nil"></email>'
+               '<address><city>San Francisco</city><zip/></address>'
+               '<company_name>Foo &amp; Co</company_name></account>')
+        self.assertEqual(mocurly.utils.deserialize(xml), ('account', {
+                'account_code': 'blah',
+                'email': None,
+                'address': {'city': 'San Francisco', 'zip': {}},
+                'company_name': 'Foo & Co'
+            }))
+
+    def test_deserialize_arrays(self):
+        xml = ('<subscription><plan_code>gold</plan_code>'
+               '<subscription_add_ons type="array">'
+               '<subscription_add_on><add_on_code>foo</add_on_code><quantity>2</quantity></subscription_add_on>'
+               '<subscription_add_on><add_on_code>bar</add_on_code></subscription_add_on>'
+               '</subscription_add_ons><plan_codes type="array"><plan_code>gold</plan_code></plan_codes>'
+               '<adjustments type="array"></adjustments></subscription>')
+        self.assertEqual(mocurly.utils.deserialize(xml), ('subscription', {
+                'plan_code': 'gold',
+                'subscription_add_ons': [{'add_on_code': 'foo', 'quantity': '2'}, {'add_on_code': 'bar'}],
+                'plan_codes': ['gold'],
+                'adjustments': []
+            }))
+
+        xml = '<accounts type="array"><account><account_code>foo</account_code></account><account/></accounts>'
+        self.assertEqual(mocurly.utils.deserialize(xml), [{'account_code': 'foo'}, {}])
+
+    def test_deserialize_ignores_whitespace_between_elements(self):
+        xml = '<account>\n  <account_code>blah</account_code>\n  <email> foo@bar.com </email>\n</account>\n'
+        self.assertEqual(mocurly.utils.deserialize(xml), ('account', {'account_code': 'blah', 'email': ' foo@bar.com '}))